@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Admission control for interactive updates (text_router, on_callback).
+
+Every message or button press costs DB reads and several Bot API calls (confirmation,
+summary, pin, cleanup), so one flooding user or busy group could starve everyone else.
+Admission.check puts three gates in front of a handler:
+
+- repeated taps: the same user sending the same read-only button or callback data again
+  within `coalesce_seconds` is dropped (paging or report buttons double-tapped);
+- per-user and per-chat token buckets (groups only; a private chat is its user);
+- overload: `level()` reads the processor's pending-update count. At level 1 main skips
+  optional work (summary with tip, re-pin, cleanup); at level 2 read-only taps are shed
+  as well. Writes are only ever refused by the rate limits, never by load.
+
+Kept out of main like updates.py; counters go into the `metrics` dict handed in.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+ADMIT, DUPLICATE, LIMITED, SHED = "admit", "duplicate", "limited", "shed"
+
+class Buckets:
+    """Token buckets per key, refilled lazily on take. Keys idle long enough to be full
+    again carry no state, so the least recently used are simply forgotten."""
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.state: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [tokens, ts]
+
+    def take(self, key: Hashable, now: float) -> bool:
+        b = self.state.get(key)
+        if b is None:
+            b = self.state[key] = [self.burst, now]
+            if len(self.state) > self.max_keys:
+                self.state.popitem(last=False)
+        else:
+            self.state.move_to_end(key)
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] < 1.0:
+            return False
+        b[0] -= 1.0
+        return True
+
+class Admission:
+    def __init__(self, user_rate: float, user_burst: float, chat_rate: float, chat_burst: float,
+                 coalesce_seconds: float, soft_pending: int, hard_pending: int, metrics: Dict[str, float],
+                 warn_every: float = 30.0, max_keys: int = 100_000):
+        self.users = Buckets(user_rate, user_burst, max_keys)
+        self.chats = Buckets(chat_rate, chat_burst, max_keys)
+        self.coalesce_seconds = coalesce_seconds
+        self.soft_pending = soft_pending
+        self.hard_pending = max(hard_pending, soft_pending)
+        self.metrics = metrics
+        self.warn_every = warn_every
+        self.max_keys = max_keys
+        self.taps: "OrderedDict[tuple, float]" = OrderedDict()  # (uid, chat_id, tap) -> last seen
+        self.warned: "OrderedDict[int, float]" = OrderedDict()
+
+    def inc(self, name: str):
+        self.metrics[name] = self.metrics.get(name, 0.0) + 1
+
+    def level(self) -> int:
+        pending = self.metrics.get("updates_pending", 0)
+        return 2 if pending >= self.hard_pending else 1 if pending >= self.soft_pending else 0
+
+    def check(self, uid: int, chat_id: int, tap: Optional[str], read_only: bool,
+              now: Optional[float] = None) -> str:
+        """ADMIT, or why not. `tap` is the coalescing key (button text or callback data),
+        None for input that must never be merged."""
+        now = time.monotonic() if now is None else now
+        key = (uid, chat_id, tap)
+        if tap is not None:
+            last = self.taps.get(key)
+            if last is not None and now - last < self.coalesce_seconds:
+                self.inc("admission_coalesced_total")
+                return DUPLICATE
+        if read_only and self.level() >= 2:
+            self.inc("admission_shed_total")
+            return SHED
+        if not self.users.take(uid, now):
+            self.inc("admission_limited_user_total")
+            return LIMITED
+        if chat_id != uid and not self.chats.take(chat_id, now):
+            self.inc("admission_limited_chat_total")
+            return LIMITED
+        if tap is not None:  # the window runs from the tap that was let through
+            self.taps[key] = now
+            self.taps.move_to_end(key)
+            if len(self.taps) > self.max_keys:
+                self.taps.popitem(last=False)
+        self.inc("admission_admitted_total")
+        return ADMIT
+
+    def warn_once(self, uid: int, now: Optional[float] = None) -> bool:
+        """True at most once per warn_every seconds per user: a flood gets one reply, not one
+        per rejected message."""
+        now = time.monotonic() if now is None else now
+        last = self.warned.get(uid)
+        if last is not None and now - last < self.warn_every:
+            return False
+        self.warned[uid] = now
+        self.warned.move_to_end(uid)
+        if len(self.warned) > self.max_keys:
+            self.warned.popitem(last=False)
+        return True
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Online SQLite snapshots: backup API in small page steps, gzip, integrity check, rotation.
+
+Blocking by design; the bot calls these through asyncio.to_thread. Snapshot files are
+named finance-YYYYMMDD-HHMMSS[-tag].db.gz so that lexical order is chronological.
+"""
+import csv, gzip, io, os, shutil, sqlite3, tempfile, time, zipfile
+from datetime import datetime
+from typing import List, Optional
+
+PREFIX, SUFFIX = "finance-", ".db.gz"
+
+def snapshot_name(ts: Optional[float] = None, tag: str = "") -> str:
+    stamp = datetime.fromtimestamp(ts or time.time()).strftime("%Y%m%d-%H%M%S")
+    return PREFIX + stamp + (f"-{tag}" if tag else "") + SUFFIX
+
+def list_snapshots(dest_dir: str) -> List[str]:
+    """Snapshot file names, newest first."""
+    if not os.path.isdir(dest_dir):
+        return []
+    return sorted((f for f in os.listdir(dest_dir) if f.startswith(PREFIX) and f.endswith(SUFFIX)), reverse=True)
+
+def integrity_ok(path: str) -> bool:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return con.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    finally:
+        con.close()
+
+def create_snapshot(db_path: str, dest_dir: str, pages: int = 256, sleep: float = 0.005, tag: str = "") -> str:
+    """Copy the live DB `pages` pages at a time, so writers only wait for one short step.
+    The copy is verified before it is compressed; returns the snapshot path."""
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, raw = tempfile.mkstemp(suffix=".db", dir=dest_dir); os.close(fd)
+    try:
+        src = sqlite3.connect(db_path); dst = sqlite3.connect(raw)
+        try:
+            src.backup(dst, pages=pages, sleep=sleep)
+        finally:
+            dst.close(); src.close()
+        if not integrity_ok(raw):
+            raise RuntimeError("integrity check failed on fresh snapshot")
+        path = os.path.join(dest_dir, snapshot_name(tag=tag))
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(dest_dir, snapshot_name(tag=f"{tag}{n}" if tag else str(n))); n += 1
+        with open(raw, "rb") as fin, gzip.open(path + ".tmp", "wb", compresslevel=6) as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        os.replace(path + ".tmp", path)
+        return path
+    finally:
+        os.remove(raw)
+
+def rotate(dest_dir: str, keep_last: int, keep_days: int) -> List[str]:
+    """Keep the `keep_last` newest snapshots plus the newest one of each of the last
+    `keep_days` days; delete the rest. Returns removed names."""
+    names = list_snapshots(dest_dir)
+    keep = set(names[:keep_last])
+    days = []
+    for n in names:
+        day = n[len(PREFIX):len(PREFIX) + 8]
+        if day not in days:
+            days.append(day)
+            if len(days) <= keep_days:
+                keep.add(n)
+    removed = [n for n in names if n not in keep]
+    for n in removed:
+        os.remove(os.path.join(dest_dir, n))
+    return removed
+
+def unpack(snapshot_path: str, dest_dir: str) -> str:
+    """Decompress a snapshot next to it and verify it; the caller removes the returned file."""
+    fd, raw = tempfile.mkstemp(suffix=".db", dir=dest_dir); os.close(fd)
+    with gzip.open(snapshot_path, "rb") as fin, open(raw, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    if not integrity_ok(raw):
+        os.remove(raw)
+        raise RuntimeError(f"integrity check failed: {os.path.basename(snapshot_path)}")
+    return raw
+
+def restore(snapshot_path: str, db_path: str, dest_dir: str) -> str:
+    """Replace the live DB contents with a snapshot. A safety snapshot of the current state
+    is taken first and its path returned. Copying through the backup API keeps other open
+    connections valid: they simply see the restored data."""
+    raw = unpack(snapshot_path, dest_dir)
+    try:
+        safety = create_snapshot(db_path, dest_dir, tag="pre-restore")
+        src = sqlite3.connect(raw); dst = sqlite3.connect(db_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close(); src.close()
+    finally:
+        os.remove(raw)
+    return safety
+
+USER_TABLES = {
+    "tx": "SELECT * FROM tx WHERE user_id=? OR ledger_id=? ORDER BY ts",
+    "debts": "SELECT * FROM debts WHERE user_id=? OR ledger_id=? ORDER BY created_ts",
+    "budgets": "SELECT * FROM budgets WHERE user_id=? OR ledger_id=? ORDER BY id",
+}
+
+def export_user(snapshot_path: str, dest_dir: str, uid: int) -> bytes:
+    """One user's rows (own entries and their personal ledger) as a zip of CSV files."""
+    raw = unpack(snapshot_path, dest_dir)
+    try:
+        con = sqlite3.connect(raw)
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+            for table, sql in USER_TABLES.items():
+                try:
+                    cur = con.execute(sql, (uid, uid))
+                except sqlite3.OperationalError:
+                    continue  # snapshot predates the table or its ledger_id column
+                buf = io.StringIO()
+                w = csv.writer(buf)
+                w.writerow([d[0] for d in cur.description])
+                w.writerows(cur)
+                z.writestr(f"{table}.csv", buf.getvalue())
+        con.close()
+        return out.getvalue()
+    finally:
+        os.remove(raw)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Handler latency with the storage backend swapped out, and storage operations on their own.
+
+    python benchmarks/handlers.py [--rounds 300] [--rows 3000] [--only handlers|storage]
+
+Updates go through Application.process_update (all handler groups, PTB parsing and
+serialization) with a Bot API transport that answers locally, so nothing leaves the
+process. Each scenario runs once on MemoryStorage and once on SqliteStorage (a throwaway
+DB_PATH): the memory column is the bot-logic overhead, the difference is what storage
+costs. The storage section times the Storage methods directly, for benchmarking backend
+changes without the handlers. Both backends are seeded with the same --rows
+transactions spread over 90 days. WRITE_BATCH_MS defaults to 0 here, so sequential
+writes do not wait out the group-commit window, and admission limits are lifted.
+"""
+import argparse, asyncio, json, os, sys, tempfile, time
+
+TMP = tempfile.mkdtemp(prefix="bench-handlers-")
+for key, value in {"DB_PATH": os.path.join(TMP, "bench.db"), "ARCHIVE_DIR": os.path.join(TMP, "archive"),
+                   "CHART_CACHE_DIR": os.path.join(TMP, "charts"), "FX_RATES_PATH": os.path.join(TMP, "none.csv"),
+                   "WRITE_BATCH_MS": "0", "ALLOWED_USER_IDS": "", "ADMIT_USER_BURST": "1e12",
+                   "ADMIT_COALESCE_MS": "0"}.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as bot  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+UID = 1001
+CATEGORIES = ["Еда", "Транспорт", "Дом", "Связь", "Развлечения"]
+
+def local_request():
+    """BaseRequest that answers every Bot API method in-process with a minimal result."""
+    from telegram.request import BaseRequest
+
+    class LocalRequest(BaseRequest):
+        message_id = 0
+
+        async def initialize(self): pass
+        async def shutdown(self): pass
+
+        async def do_request(self, url, method, request_data=None, **kw):
+            name = url.rsplit("/", 1)[-1]
+            params = request_data.parameters if request_data else {}
+            if name == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            elif name.startswith("send") or name.startswith("edit"):
+                LocalRequest.message_id += 1
+                result = {"message_id": LocalRequest.message_id, "date": int(time.time()),
+                          "chat": {"id": params.get("chat_id", UID), "type": "private"}, "text": ""}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return LocalRequest()
+
+def text_update(n: int, text: str) -> dict:
+    return {"update_id": n, "message": {"message_id": n, "date": int(time.time()), "text": text,
+                                        "chat": {"id": UID, "type": "private"},
+                                        "from": {"id": UID, "is_bot": False, "first_name": "Bench"}}}
+
+def callback_update(n: int, data: str) -> dict:
+    return {"update_id": n, "callback_query": {"id": str(n), "chat_instance": "1", "data": data,
+                                               "from": {"id": UID, "is_bot": False, "first_name": "Bench"},
+                                               "message": {"message_id": 1, "date": int(time.time()), "text": "",
+                                                           "chat": {"id": UID, "type": "private"}}}}
+
+# (label, [text or ("cb", callback data)]); a scenario's steps run in order, timed together
+SCENARIOS = [
+    ("balance button", [bot.BALANCE_BTN]),
+    ("free-text expense", ["обед 45000"]),
+    ("multi-line entry (3)", ["обед 45000\nтакси 12000\nзарплата 5000000"]),
+    ("history page 1", [bot.HISTORY_BTN]),
+    ("expense dialog", [bot.EXPENSE_BTN, "Еда", "25000"]),
+    ("debt add dialog", [bot.DEBTS_BTN, "➕ Мне должны", "50 usd Ahmed", bot.BACK_BTN]),
+    ("debts by person (cb)", [("cb", "dls:net:0")]),
+    ("history page 3 (cb)", [("cb", "hist:next:2")]),
+]
+
+async def seed(store, rows: int):
+    now = bot.ts_now()
+    for j in range(rows):  # oldest first, so ids follow ts as they do in production
+        await store.add_txs(UID, UID, [("expense" if j % 7 else "income", 1000.0 + j, "uzs" if j % 5 else "usd",
+                                        CATEGORIES[j % len(CATEGORIES)], "")], now - (rows - j) * 90 * 86400 // rows)
+    for j in range(20):
+        await store.add_debt(UID, UID, "owed" if j % 2 else "owes", 100.0 + j, "usd", f"Name {j % 8}",
+                             f"name {j % 8}", "", now - j * 3600)
+    store.set_budget(UID, UID, "Еда", "uzs", 2_000_000.0, "month", now)
+
+def use_store(store):
+    bot.STORE = store
+    bot.LEDGERS.clear()
+    for cache in (bot._chat_settings, bot._pins, bot._group_ledgers):
+        cache.clear()
+    bot._known_members.clear()
+
+async def bench_handlers(app, rounds: int) -> dict:
+    from telegram import Update
+    out, n = {}, 0
+    for label, steps in SCENARIOS:
+        app.drop_user_data(UID)
+        times = []
+        for _ in range(rounds + 5):
+            t0 = time.perf_counter()
+            for step in steps:
+                n += 1
+                data = callback_update(n, step[1]) if isinstance(step, tuple) else text_update(n, step)
+                await app.process_update(Update.de_json(data, app.bot))
+            times.append(time.perf_counter() - t0)
+        times = sorted(times[5:])
+        out[label] = (times[len(times) // 2], times[int(len(times) * .95)])
+    return out
+
+async def bench_storage(store, rounds: int) -> dict:
+    start, end = bot.month_bounds_now()
+    ops = [
+        ("add_txs (1 row)", lambda: store.add_txs(UID, UID, [("expense", 1.0, "uzs", "Еда", "")], bot.ts_now())),
+        ("last_txs (page 3)", lambda: store.last_txs(UID, 10, 20)),
+        ("ledger_totals", lambda: store.ledger_totals(UID)),
+        ("expense_totals (month)", lambda: store.expense_totals(UID, start, end)),
+        ("report_buckets (month)", lambda: store.report_buckets(UID, start, end, bot.tz_spans(None, start, end))),
+        ("debt_groups (net)", lambda: store.debt_groups(UID, None, 15, 0)),
+        ("chat_settings", lambda: store.chat_settings(UID)),
+    ]
+    out = {}
+    for label, op in ops:
+        times = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            res = op()
+            if asyncio.iscoroutine(res):
+                await res
+            times.append(time.perf_counter() - t0)
+        times.sort()
+        out[label] = (times[len(times) // 2], times[int(len(times) * .95)])
+    return out
+
+def report(title: str, results: dict):
+    print(f"\n{title} (median / p95, µs)")
+    print(f"  {'':<26}{'memory':>18}{'sqlite':>18}{'storage share':>15}")
+    for label, (mem_p50, mem_p95) in results["memory"].items():
+        sql_p50, sql_p95 = results["sqlite"][label]
+        share = 1 - mem_p50 / sql_p50 if sql_p50 else 0.0
+        print(f"  {label:<26}{mem_p50 * 1e6:>9.0f} /{mem_p95 * 1e6:>7.0f}{sql_p50 * 1e6:>9.0f} /{sql_p95 * 1e6:>7.0f}{share:>14.0%}")
+
+async def run(args):
+    bot.boot()
+    app = bot.build_app("1:bench", request=local_request())
+    handlers, storage = {}, {}
+    async with app:
+        for name, store in (("memory", MemoryStorage()), ("sqlite", bot.SqliteStorage())):
+            await seed(store, args.rows)
+            await bot.WRITES.close()
+            use_store(store)
+            if args.only in (None, "handlers"):
+                handlers[name] = await bench_handlers(app, args.rounds)
+            if args.only in (None, "storage"):
+                storage[name] = await bench_storage(store, args.rounds)
+        await bot.WRITES.close()
+    print(f"{args.rows} seeded transactions, {args.rounds} rounds, WRITE_BATCH_MS={bot.WRITE_BATCH_MS:g}")
+    if handlers:
+        report("handlers (per scenario, all steps)", handlers)
+    if storage:
+        report("storage operations", storage)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rounds", type=int, default=300)
+    ap.add_argument("--rows", type=int, default=3000)
+    ap.add_argument("--only", choices=["handlers", "storage"])
+    args = ap.parse_args()
+    try:
+        asyncio.run(run(args))
+    finally:
+        import shutil
+        shutil.rmtree(TMP, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Cold-start benchmark for main.py, based on `python -X importtime`.
+
+    python benchmarks/import_time.py [--runs 7] [--top 15]
+
+Each run is a fresh interpreter against a throwaway DB_PATH. Bytecode is compiled once
+into a private cache first, so the numbers match a deployed (warm .pyc) restart:
+
+  import  `import main` only (what the spawned chart worker and scripts pay)
+  boot    import + main.boot(): telegram imports, schema migrations, FX load
+"""
+import argparse, os, statistics, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = {
+    "import": "import main",
+    "boot": "import main; main.boot()",
+}
+
+def run(code: str, env: dict, importtime: bool = False) -> subprocess.CompletedProcess:
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    return subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+
+def parse_importtime(stderr: str, module: str):
+    """[(self_us, cumulative_us, name)] for `module` and everything it imported, from -X importtime.
+    Children are printed before their parent and indented deeper."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cum_us), name.rstrip()))
+    depth = lambda n: len(n) - len(n.lstrip())
+    for i, (_, _, name) in enumerate(rows):
+        if name.strip() == module:
+            j = i
+            while j > 0 and depth(rows[j - 1][2]) > depth(name):
+                j -= 1
+            return [(s, c, n.strip()) for s, c, n in rows[j:i + 1]]
+    return []
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=7)
+    ap.add_argument("--top", type=int, default=15, help="slowest top-level imports to list")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DB_PATH=os.path.join(tmp, "bench.db"), PYTHONPYCACHEPREFIX=os.path.join(tmp, "pyc"),
+                   FX_RATES_PATH=os.path.join(tmp, "none.csv"))
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        run(STAGES["boot"], env)  # compile .pyc and create the schema once
+
+        for stage, code in STAGES.items():
+            times = []
+            for _ in range(args.runs):
+                t0 = time.perf_counter()
+                run(code, env)
+                times.append((time.perf_counter() - t0) * 1000)
+            print(f"{stage:<7} median {statistics.median(times):7.1f} ms  min {min(times):7.1f} ms  ({args.runs} runs, incl. interpreter start)")
+
+        rows = parse_importtime(run(STAGES["import"], env, importtime=True).stderr, "main")
+        if rows:
+            main_row = rows[-1]
+            print(f"\nimport main: {main_row[1] / 1000:.1f} ms cumulative, {main_row[0] / 1000:.1f} ms in main itself")
+        top = sorted((r for r in rows if r[2] != "main"), key=lambda r: -r[1])[:args.top]
+        print("\nslowest modules under `import main` (cumulative ms):")
+        for self_us, cum_us, name in top:
+            print(f"  {cum_us / 1000:8.1f}  {name}")
+
+if __name__ == "__main__":
+    main()
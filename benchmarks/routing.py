@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Per-message routing overhead of text_router and on_callback, without Telegram or the DB.
+
+    python benchmarks/routing.py [--number 200000]
+
+Times TextMsg normalization plus resolve_text_route, and parse_callback, over a mix of
+menu buttons, dialog stages and free text. Handlers are not run; the point is that the
+cost stays flat as buttons and stages are added to the routing tables.
+"""
+import argparse, os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as bot  # noqa: E402
+
+def text_cases():
+    st = lambda stage, **kw: {"stage": stage, **kw}
+    return [
+        ("menu button", bot.BALANCE_BTN, {}),
+        ("free text amount", "обед 45000", {}),
+        ("unknown text", "привет", {}),
+        ("debts menu button", "📜 Мне должны", {"debts": st("menu")}),
+        ("debts amount stage", "5000 usd Ahmed", {"debts": st("await_amount", direction="owed")}),
+        ("budget category", "Еда", {"budget": st("choose_cat")}),
+        ("tx amount stage", "25000", {"flow": st("await_amount", ttype="expense", category="Еда")}),
+        ("back from dialog", bot.BACK_BTN, {"flow": st("choose_expense")}),
+        ("falls through dialogs", bot.HISTORY_BTN, {"budget": st("choose_cat"), "flow": st("choose_income")}),
+    ]
+
+CALLBACKS = ["hist:next:3", "dls:net:2", "dcp:17:owed", "report:month:chart", "settings:toggle:autopin", "bogus:1"]
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--number", type=int, default=200000)
+    args = ap.parse_args()
+    bot.load_telegram()
+    n = args.number
+    print(f"routes: {len(bot.BUTTON_ROUTES)} buttons, {len(bot.FSM_ROUTES)} dialog stages, "
+          f"{len(bot.CALLBACK_ROUTES)} callback prefixes")
+    print("\ntext_router (TextMsg + resolve_text_route):")
+    for label, txt, ud in text_cases():
+        t = timeit.timeit(lambda: bot.resolve_text_route(bot.TextMsg(txt, 1, 1, 1), ud), number=n)
+        handler = bot.resolve_text_route(bot.TextMsg(txt, 1, 1, 1), ud)
+        print(f"  {label:<24}{t / n * 1e9:8.0f} ns  -> {handler.__qualname__.split('.')[0]}")
+    print("\non_callback (parse_callback):")
+    for data in CALLBACKS:
+        t = timeit.timeit(lambda: bot.parse_callback(data), number=n)
+        print(f"  {data:<24}{t / n * 1e9:8.0f} ns")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Report charts drawn with reportlab.graphics.
+
+Runs inside a worker process, so it must not import main. The payload is
+plain data: {"title", "currency", "cats": [[name, amount]...], "days": [[label, amount]...]}.
+"""
+from typing import Tuple
+
+from reportlab.graphics.shapes import Drawing, String
+from reportlab.graphics.charts.barcharts import HorizontalBarChart
+from reportlab.graphics.charts.lineplots import LinePlot
+from reportlab.lib import colors
+
+WIDTH, HEIGHT = 640, 480
+
+def _fmt(v: float) -> str:
+    return f"{int(round(v)):,}".replace(",", " ")
+
+def build_drawing(payload: dict) -> Drawing:
+    d = Drawing(WIDTH, HEIGHT)
+    d.add(String(20, HEIGHT - 28, payload["title"], fontSize=16))
+    cur = payload.get("currency", "").upper()
+
+    cats = payload.get("cats") or []
+    if cats:
+        bc = HorizontalBarChart()
+        bc.x, bc.y, bc.width, bc.height = 150, 250, WIDTH - 190, 180
+        bc.data = [[v for _, v in reversed(cats)]]
+        bc.categoryAxis.categoryNames = [n[:18] for n, _ in reversed(cats)]
+        bc.categoryAxis.labels.fontSize = 9
+        bc.valueAxis.valueMin = 0
+        bc.valueAxis.labels.fontSize = 8
+        bc.valueAxis.labelTextFormat = _fmt
+        bc.bars[0].fillColor = colors.HexColor("#4e79a7")
+        d.add(bc)
+        d.add(String(20, 440, f"Расходы по категориям, {cur}", fontSize=10))
+
+    days = payload.get("days") or []
+    if len(days) > 1:
+        lp = LinePlot()
+        lp.x, lp.y, lp.width, lp.height = 70, 40, WIDTH - 110, 150
+        lp.data = [[(i, v) for i, (_, v) in enumerate(days)]]
+        lp.lines[0].strokeColor = colors.HexColor("#e15759")
+        lp.lines[0].strokeWidth = 1.5
+        lp.xValueAxis.valueMin, lp.xValueAxis.valueMax = 0, len(days) - 1
+        step = max(1, len(days) // 8)
+        lp.xValueAxis.valueSteps = list(range(0, len(days), step))
+        lp.xValueAxis.labelTextFormat = lambda i: days[int(i)][0] if 0 <= int(i) < len(days) else ""
+        lp.xValueAxis.labels.fontSize = 8
+        lp.yValueAxis.valueMin = 0
+        lp.yValueAxis.labels.fontSize = 8
+        lp.yValueAxis.labelTextFormat = _fmt
+        d.add(lp)
+        d.add(String(20, 205, f"Расходы по дням, {cur}", fontSize=10))
+    return d
+
+def render_report_chart(payload: dict) -> Tuple[bytes, str]:
+    """Returns (data, "png"), rasterized by rl_renderPM (see requirements.txt; rlPyCairo
+    works too). Only if neither backend imports: (data, "pdf"), sent as a document."""
+    d = build_drawing(payload)
+    try:
+        from reportlab.graphics import renderPM
+        return renderPM.drawToString(d, fmt="PNG", dpi=144, backend="_renderPM"), "png"
+    except Exception:
+        from reportlab.graphics import renderPDF
+        return renderPDF.drawToString(d), "pdf"
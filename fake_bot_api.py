@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Stand-in Telegram Bot API for running the bot end to end on one machine.
+
+    python fake_bot_api.py [--port 8081]
+    BOT_API_BASE_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake SHARDS=4 python main.py
+    python fake_bot_api.py --feed updates.jsonl [--port 8081]
+    curl 127.0.0.1:8081/stats
+
+Every method gets a minimal plausible result (send*/edit* return a message with a fresh
+message_id). Updates POSTed to /feed (what --feed does with a file of Update JSON, one per
+line) are handed out by getUpdates with long polling and offsets, like the real API.
+Calls are recorded: /stats counts them per method and per chat, /calls?chat_id=<id>
+returns one chat's calls in order. Works with polling and sharded mode; webhook mode
+needs only the outgoing methods, so replay_updates.py can drive it instead of --feed.
+"""
+import argparse, asyncio, json, time
+from typing import Any, Dict, List
+
+def run_server(port: int):
+    import tornado.web
+
+    updates: List[dict] = []
+    calls: List[Dict[str, Any]] = []
+    new_update = asyncio.Event()
+    state = {"message_id": 0}
+
+    def params(request) -> Dict[str, Any]:
+        if "json" in request.headers.get("Content-Type", ""):
+            return json.loads(request.body or b"{}")
+        out = {}
+        for k, v in request.body_arguments.items():  # urlencoded and multipart alike
+            raw = v[0].decode("utf-8", "replace")
+            try:
+                out[k] = json.loads(raw)
+            except ValueError:
+                out[k] = raw
+        for k in request.files:
+            out[k] = "<file>"
+        return out
+
+    class MethodHandler(tornado.web.RequestHandler):
+        async def post(self, token: str, method: str):
+            p = params(self.request)
+            if method == "getUpdates":
+                offset, timeout = int(p.get("offset") or 0), min(float(p.get("timeout") or 0), 50)
+                deadline = time.monotonic() + timeout
+                while True:
+                    updates[:] = [u for u in updates if u["update_id"] >= offset]  # offset confirms the rest
+                    batch = updates[:int(p.get("limit") or 100)]
+                    if batch or time.monotonic() >= deadline:
+                        break
+                    new_update.clear()
+                    try:
+                        await asyncio.wait_for(new_update.wait(), deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        pass
+                self.write({"ok": True, "result": batch})
+                return
+            calls.append({"method": method, "ts": time.time(), **p})
+            if method == "getMe":
+                result: Any = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+            elif method.startswith("send") or method.startswith("edit"):
+                state["message_id"] += 1
+                chat_id = p.get("chat_id", 0)
+                result = {"message_id": state["message_id"], "date": int(time.time()), "text": str(p.get("text", "")),
+                          "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"}}
+            else:
+                result = True
+            self.write({"ok": True, "result": result})
+
+        get = post
+
+    class FeedHandler(tornado.web.RequestHandler):
+        def post(self):
+            body = json.loads(self.request.body)
+            updates.extend(body if isinstance(body, list) else [body])
+            new_update.set()
+            self.write({"queued": len(updates)})
+
+    class StatsHandler(tornado.web.RequestHandler):
+        def get(self):
+            by_method: Dict[str, int] = {}
+            by_chat: Dict[str, int] = {}
+            for c in calls:
+                by_method[c["method"]] = by_method.get(c["method"], 0) + 1
+                if "chat_id" in c:
+                    by_chat[str(c["chat_id"])] = by_chat.get(str(c["chat_id"]), 0) + 1
+            self.write({"calls": len(calls), "pending_updates": len(updates), "methods": by_method, "chats": by_chat})
+
+    class CallsHandler(tornado.web.RequestHandler):
+        def get(self):
+            chat_id = self.get_query_argument("chat_id", None)
+            self.write({"calls": [c for c in calls if chat_id is None or str(c.get("chat_id")) == chat_id]})
+
+    async def main():
+        tornado.web.Application([(r"/bot([^/]+)/(\w+)", MethodHandler), (r"/feed", FeedHandler),
+                                 (r"/stats", StatsHandler), (r"/calls", CallsHandler)]).listen(port)
+        print(f"fake Bot API on http://127.0.0.1:{port}", flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+def feed(path: str, port: int):
+    import httpx
+    with open(path, encoding="utf-8") as f:
+        raw = f.read().strip()
+    items = json.loads(raw) if raw.startswith("[") else [json.loads(l) for l in raw.splitlines() if l.strip()]
+    r = httpx.post(f"http://127.0.0.1:{port}/feed", json=items, timeout=30)
+    print(f"fed {len(items)} updates: {r.json()}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--feed", help="queue the Update JSON in this file on a running server")
+    args = ap.parse_args()
+    if args.feed:
+        feed(args.feed, args.port)
+    else:
+        run_server(args.port)
+
+if __name__ == "__main__":
+    main()
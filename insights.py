@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Vectorized spending analytics for the nightly insights job.
+
+All functions take a (users x days) matrix of daily expenses in the base
+currency, oldest day first, and return one value per user.
+"""
+import numpy as np
+
+def daily_matrix(user_idx: np.ndarray, day_idx: np.ndarray, amounts: np.ndarray,
+                 n_users: int, n_days: int) -> np.ndarray:
+    m = np.zeros((n_users, n_days), dtype=np.float64)
+    np.add.at(m, (user_idx, day_idx), amounts)
+    return m
+
+def month_end_forecast(daily: np.ndarray, days_elapsed: int, days_in_month: int, window: int = 28) -> np.ndarray:
+    """Month-to-date spend plus the recent average daily spend for the days left."""
+    mtd = daily[:, -days_elapsed:].sum(axis=1) if days_elapsed else np.zeros(daily.shape[0])
+    rate = daily[:, -window:].mean(axis=1)
+    return mtd + rate * (days_in_month - days_elapsed)
+
+def week_change(daily: np.ndarray) -> np.ndarray:
+    """Relative change of the last 7 days vs the 7 before, NaN where the earlier week is empty."""
+    cur = daily[:, -7:].sum(axis=1)
+    prev = daily[:, -14:-7].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(prev > 0, (cur - prev) / prev, np.nan)
+
+def last_day_zscore(daily: np.ndarray, window: int = 28) -> np.ndarray:
+    """z-score of the last day against the `window` days before it, NaN for flat histories."""
+    hist = daily[:, -window - 1:-1]
+    mean = hist.mean(axis=1)
+    std = hist.std(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(std > 0, (daily[:, -1] - mean) / std, np.nan)
+
+def run_rate(spent: np.ndarray, days_elapsed, days_total) -> np.ndarray:
+    """Projected window total for each window-to-date amount at the current pace; the day
+    counts are scalars or one per amount (budgets with different windows)."""
+    return spent / np.maximum(1, days_elapsed) * days_total
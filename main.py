@@ -1,18 +1,77 @@
-import os, re, sqlite3, time, logging, csv, io, math
-from datetime import datetime, timedelta
-from typing import Optional, Tuple, List, Dict, Any
+from __future__ import annotations
+import os, re, sqlite3, time, logging, io, math, asyncio, signal
+from datetime import datetime, timedelta, timezone, time as dtime
+from typing import TYPE_CHECKING, Optional, Tuple, List, Dict, Any, Iterable
+from bisect import bisect_right
+from collections import OrderedDict
 from zoneinfo import ZoneInfo
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters
+from admission import ADMIT, DUPLICATE, SHED, Admission
+from shards import shard_db_path, shard_dir, shard_of
+from storage import SETTING_DEFAULTS, Storage
+from tracing import trace_handler, traced, traced_request
+
+# telegram + telegram.ext cost ~0.5 s of imports (httpx, tornado). They are bound by
+# load_telegram() at startup, so a bare `import main` (the spawned chart worker, scripts,
+# benchmarks) stays cheap; annotations are never evaluated.
+if TYPE_CHECKING:
+    from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+    from telegram import InlineQueryResultArticle, InputTextMessageContent
+    from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler, filters
+    from telegram.ext import InlineQueryHandler, ChosenInlineResultHandler
+
+def load_telegram():
+    global Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, MAIN_KB, BACK_KB
+    global InlineQueryResultArticle, InputTextMessageContent, InlineQueryHandler, ChosenInlineResultHandler
+    global Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler, filters
+    from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+    from telegram import InlineQueryResultArticle, InputTextMessageContent
+    from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler, filters
+    from telegram.ext import InlineQueryHandler, ChosenInlineResultHandler
+    MAIN_KB = main_kb()
+    BACK_KB = ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)]], resize_keyboard=True)
 
 # ---------------- Config ----------------
 PORT = int(os.environ.get("PORT", "8080"))
-DB_PATH = os.environ.get("DB_PATH", "finance.db")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+BOT_MODE = os.environ.get("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")
+WEBHOOK_PATH = "/" + os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "")
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))
+UPDATE_PENDING_LIMIT = int(os.environ.get("UPDATE_PENDING_LIMIT", "1024"))
+ADMIT_USER_RATE = float(os.environ.get("ADMIT_USER_RATE", "1"))  # messages/s sustained, per user
+ADMIT_USER_BURST = float(os.environ.get("ADMIT_USER_BURST", "10"))
+ADMIT_CHAT_RATE = float(os.environ.get("ADMIT_CHAT_RATE", "3"))  # per group chat
+ADMIT_CHAT_BURST = float(os.environ.get("ADMIT_CHAT_BURST", "30"))
+ADMIT_COALESCE_MS = float(os.environ.get("ADMIT_COALESCE_MS", "800"))
+LOAD_SHED_PENDING = int(os.environ.get("LOAD_SHED_PENDING", str(UPDATE_PENDING_LIMIT // 4)))
+SHARDS = int(os.environ.get("SHARDS", "1"))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "-1"))  # set by the front (shards.py) for its workers
+SHARD_SOCKET = os.environ.get("SHARD_SOCKET", "")
+DB_BASE_PATH = os.environ.get("DB_PATH", "finance.db")
+DB_PATH = shard_db_path(DB_BASE_PATH, SHARD_INDEX)
 TIMEZONE = ZoneInfo(os.environ.get("TZ", "Asia/Tashkent"))
+BASE_CURRENCY = os.environ.get("BASE_CURRENCY", "uzs").lower()
+FX_RATES_PATH = os.environ.get("FX_RATES_PATH", "fx_rates.csv")
+CHART_CACHE_DIR = os.environ.get("CHART_CACHE_DIR", "chart_cache")
+ARCHIVE_DIR = shard_dir(os.environ.get("ARCHIVE_DIR", "archive"), SHARD_INDEX)
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "730"))
+LEDGER_CACHE_MAX_KB = int(os.environ.get("LEDGER_CACHE_MAX_KB", "8192"))
+WRITE_BATCH_MS = float(os.environ.get("WRITE_BATCH_MS", "5"))
+WRITE_DURABILITY = os.environ.get("WRITE_DURABILITY", "normal").lower()  # full | normal | off
 ALLOWED_USER_IDS = {int(x) for x in os.environ.get("ALLOWED_USER_IDS", "").replace(";", ",").split(",") if x.strip().isdigit()}
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("ADMIN_USER_IDS", "").replace(";", ",").split(",") if x.strip().isdigit()}
+BACKUP_BASE_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_DIR = shard_dir(BACKUP_BASE_DIR, SHARD_INDEX)
+BACKUP_EVERY_HOURS = float(os.environ.get("BACKUP_EVERY_HOURS", "6"))
+BACKUP_KEEP_LAST = int(os.environ.get("BACKUP_KEEP_LAST", "8"))
+BACKUP_KEEP_DAYS = int(os.environ.get("BACKUP_KEEP_DAYS", "14"))
+DIGEST_RATE = float(os.environ.get("DIGEST_RATE", "20"))  # messages/s; Telegram allows ~30/s per bot
+STATS_EVERY_MINUTES = float(os.environ.get("STATS_EVERY_MINUTES", "10"))
+STATS_KEEP_DAYS = int(os.environ.get("STATS_KEEP_DAYS", "90"))
+INLINE_CACHE_SECONDS = int(os.environ.get("INLINE_CACHE_SECONDS", "15"))
 
 logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s | %(message)s", level=logging.INFO)
 log = logging.getLogger("bot")
@@ -29,17 +88,21 @@ EXPORT_BTN = "Экспорт 📂"
 BUDGET_BTN = "Бюджет 💡"
 SETTINGS_BTN = "⚙️ Настройки"
 CANCEL_BTN = "↩️ Отменить"
+DEBTS_BY_PERSON_BTN = "👥 По людям"
 
-MAIN_KB = ReplyKeyboardMarkup(
-    [
-        [KeyboardButton(INCOME_BTN), KeyboardButton(EXPENSE_BTN)],
-        [KeyboardButton(BALANCE_BTN), KeyboardButton(HISTORY_BTN)],
-        [KeyboardButton(REPORT_BTN), KeyboardButton(DEBTS_BTN)],
-        [KeyboardButton(BUDGET_BTN), KeyboardButton(EXPORT_BTN)],
-        [KeyboardButton(SETTINGS_BTN), KeyboardButton(CANCEL_BTN)],
-    ],
-    resize_keyboard=True
-)
+def main_kb() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        [
+            [KeyboardButton(INCOME_BTN), KeyboardButton(EXPENSE_BTN)],
+            [KeyboardButton(BALANCE_BTN), KeyboardButton(HISTORY_BTN)],
+            [KeyboardButton(REPORT_BTN), KeyboardButton(DEBTS_BTN)],
+            [KeyboardButton(BUDGET_BTN), KeyboardButton(EXPORT_BTN)],
+            [KeyboardButton(SETTINGS_BTN), KeyboardButton(CANCEL_BTN)],
+        ],
+        resize_keyboard=True
+    )
+
+MAIN_KB = BACK_KB = None  # built by load_telegram()
 
 EXPENSE_CATS = ["Еда", "Транспорт", "Дом", "Детское", "Здоровье", "Развлечения", "Спорт", "Прочее"]
 INCOME_CATS = ["Зарплата", "Подработка", "Подарок", "Прочее"]
@@ -60,7 +123,7 @@ def debts_menu_kb() -> ReplyKeyboardMarkup:
             [KeyboardButton("➕ Я должен"), KeyboardButton("➕ Мне должны")],
             [KeyboardButton("📜 Я должен"), KeyboardButton("📜 Мне должны")],
             [KeyboardButton("✖️ Закрыть долг"), KeyboardButton("➖ Уменьшить долг")],
-            [KeyboardButton("Экспорт долгов 📂")],
+            [KeyboardButton(DEBTS_BY_PERSON_BTN), KeyboardButton("Экспорт долгов 📂")],
             [KeyboardButton(BACK_BTN)]
         ],
         resize_keyboard=True
@@ -69,9 +132,11 @@ def debts_menu_kb() -> ReplyKeyboardMarkup:
 # ---------------- DB ----------------
 def init_db():
     con = sqlite3.connect(DB_PATH); c = con.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute("""CREATE TABLE IF NOT EXISTS tx(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
+        ledger_id INTEGER,
         ttype TEXT NOT NULL CHECK(ttype IN('income','expense')),
         amount REAL NOT NULL,
         currency TEXT NOT NULL,
@@ -83,6 +148,7 @@ def init_db():
     c.execute("""CREATE TABLE IF NOT EXISTS debts(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
+        ledger_id INTEGER,
         direction TEXT NOT NULL CHECK(direction IN('owes','owed')),
         amount REAL NOT NULL,
         currency TEXT NOT NULL,
@@ -96,6 +162,7 @@ def init_db():
     c.execute("""CREATE TABLE IF NOT EXISTS budgets(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
+        ledger_id INTEGER,
         category TEXT NOT NULL,
         currency TEXT NOT NULL,
         limit_amount REAL NOT NULL,
@@ -104,7 +171,8 @@ def init_db():
         created_ts INTEGER NOT NULL,
         updated_ts INTEGER NOT NULL
     )""")
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uniq_budget ON budgets(user_id, category, currency)")
+    # budget_set used to bind the literal 1 into `period`
+    c.execute("UPDATE budgets SET period='month' WHERE period='1'")
     c.execute("""CREATE TABLE IF NOT EXISTS settings(
         chat_id INTEGER PRIMARY KEY,
         autopin INTEGER NOT NULL DEFAULT 1,
@@ -113,13 +181,199 @@ def init_db():
         lang TEXT NOT NULL DEFAULT 'ru',
         updated_ts INTEGER NOT NULL
     )""")
+    if "tz" not in table_columns(c, "settings"):
+        c.execute("ALTER TABLE settings ADD COLUMN tz TEXT NOT NULL DEFAULT ''")  # '' = TIMEZONE
     c.execute("""CREATE TABLE IF NOT EXISTS pins(
         chat_id INTEGER PRIMARY KEY,
         message_id INTEGER NOT NULL
     )""")
+    init_ledgers(c)
+    init_counterparties(c)
+    init_stats(c)
+    init_digest(c)
+    c.execute("""CREATE TABLE IF NOT EXISTS insights(
+        ledger_id INTEGER PRIMARY KEY,
+        computed_ts INTEGER NOT NULL,
+        forecast REAL,
+        anomaly_z REAL,
+        tip TEXT NOT NULL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS chart_files(
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_ts INTEGER NOT NULL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS fx_rates(
+        day INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        rate REAL NOT NULL,
+        PRIMARY KEY(currency, day)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS tx_archived_totals(
+        ledger_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        ttype TEXT NOT NULL,
+        category TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        amount REAL NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY(ledger_id, user_id, period, ttype, category, currency)
+    )""")
+    init_fts(c)
     con.commit(); con.close()
-init_db()
-
+    for path in archive_paths():  # archives made before a tx_fts schema change migrate too
+        con = sqlite3.connect(path); init_fts(con.cursor()); con.commit(); con.close()
+
+# Ledgers: every tx/debt/budget row belongs to a ledger. A personal ledger's id is the
+# user id and a group chat's shared ledger id is the chat id (negative in Telegram),
+# so pre-ledger rows migrate with ledger_id = user_id.
+def table_columns(c: sqlite3.Cursor, table: str) -> List[str]:
+    return [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def init_ledgers(c: sqlite3.Cursor):
+    c.execute("""CREATE TABLE IF NOT EXISTS ledgers(
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL CHECK(kind IN('personal','group')),
+        title TEXT,
+        created_ts INTEGER NOT NULL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS ledger_members(
+        ledger_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        name TEXT,
+        joined_ts INTEGER NOT NULL,
+        PRIMARY KEY(ledger_id, user_id)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_members_user ON ledger_members(user_id)")
+    for table in ("tx", "debts", "budgets"):
+        if "ledger_id" not in table_columns(c, table):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN ledger_id INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tx_ledger_ts ON tx(ledger_id, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_debts_ledger ON debts(ledger_id, status, direction)")
+    for table in ("tx", "debts", "budgets"):
+        c.execute(f"UPDATE {table} SET ledger_id=user_id WHERE ledger_id IS NULL")
+    c.execute("DROP INDEX IF EXISTS uniq_budget")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uniq_budget_ledger ON budgets(ledger_id, category, currency)")
+    # insights used to be keyed by user_id; it is derived data, so just recreate it
+    if "user_id" in table_columns(c, "insights"):
+        c.execute("DROP TABLE insights")
+
+# Debts point at a per-ledger counterparty row (looked up by a case/space-insensitive key),
+# and every reduction or close is kept in debt_payments; debts.amount stays the outstanding sum.
+def counterparty_key(name: str) -> str:
+    return " ".join(name.split()).casefold()
+
+def init_counterparties(c: sqlite3.Cursor):
+    c.execute("""CREATE TABLE IF NOT EXISTS counterparties(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ledger_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        name_key TEXT NOT NULL,
+        created_ts INTEGER NOT NULL
+    )""")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uniq_counterparty ON counterparties(ledger_id, name_key)")
+    c.execute("""CREATE TABLE IF NOT EXISTS debt_payments(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        debt_id INTEGER NOT NULL,
+        ledger_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        ts INTEGER NOT NULL
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_debt ON debt_payments(debt_id, ts)")
+    if "counterparty_id" not in table_columns(c, "debts"):
+        c.execute("ALTER TABLE debts ADD COLUMN counterparty_id INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_debts_counterparty ON debts(ledger_id, status, counterparty_id)")
+    # casefold() is Unicode-aware, SQLite's lower() is not, so the backfill runs in Python
+    pending = c.execute("SELECT id, ledger_id, counterparty FROM debts WHERE counterparty_id IS NULL").fetchall()
+    ids: Dict[Tuple[int, str], int] = {}
+    for debt_id, lid, name in pending:
+        key = (lid, counterparty_key(name or ""))
+        if key not in ids:
+            c.execute("""INSERT INTO counterparties(ledger_id, name, name_key, created_ts) VALUES(?,?,?,?)
+                         ON CONFLICT(ledger_id, name_key) DO NOTHING""", (lid, (name or "").strip(), key[1], ts_now()))
+            ids[key] = c.execute("SELECT id FROM counterparties WHERE ledger_id=? AND name_key=?", key).fetchone()[0]
+        c.execute("UPDATE debts SET counterparty_id=? WHERE id=?", (ids[key], debt_id))
+
+# Usage aggregates behind /admin_stats, filled only by stats_job (see "Usage stats")
+def init_stats(c: sqlite3.Cursor):
+    c.execute("""CREATE TABLE IF NOT EXISTS stats_daily(
+        day TEXT NOT NULL, metric TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY(day, metric)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS stats_users(
+        day TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY(day, user_id)
+    ) WITHOUT ROWID""")
+    c.execute("""CREATE TABLE IF NOT EXISTS stats_chats(
+        day TEXT NOT NULL, chat_id INTEGER NOT NULL, updates INTEGER NOT NULL, PRIMARY KEY(day, chat_id)
+    ) WITHOUT ROWID""")
+    c.execute("""CREATE TABLE IF NOT EXISTS stats_handlers(
+        day TEXT NOT NULL, handler TEXT NOT NULL, n INTEGER NOT NULL, total_ms REAL NOT NULL, max_ms REAL NOT NULL,
+        PRIMARY KEY(day, handler)
+    ) WITHOUT ROWID""")
+    c.execute("CREATE TABLE IF NOT EXISTS stats_meta(key TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+# Weekly/monthly digests: opt-in per chat (settings.digest), delivered through a persisted outbox
+def init_digest(c: sqlite3.Cursor):
+    if "digest" not in table_columns(c, "settings"):
+        c.execute("ALTER TABLE settings ADD COLUMN digest TEXT NOT NULL DEFAULT 'off'")
+    c.execute("""CREATE TABLE IF NOT EXISTS digest_outbox(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        period_key TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_ts INTEGER NOT NULL,
+        created_ts INTEGER NOT NULL,
+        sent_ts INTEGER,
+        UNIQUE(chat_id, period_key)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON digest_outbox(next_ts) WHERE status='pending'")
+
+# Full-text index over tx.note/tx.category (external content, synced by triggers). The
+# ledger is indexed as a signed token (u123 personal, g123 for group -123) so MATCH can
+# narrow to one ledger's doclist before the join; the content is the tx_fts_src view.
+FTS_ENABLED = True
+FTS_LEDGER_KEY = "CASE WHEN {0} < 0 THEN 'g' || -{0} ELSE 'u' || {0} END"
+
+def fts_ledger_key(lid: int) -> str:
+    return f"g{-lid}" if lid < 0 else f"u{lid}"
+
+def init_fts(c: sqlite3.Cursor):
+    global FTS_ENABLED
+    existed = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tx_fts'").fetchone()
+    if existed and "ledger_key" not in table_columns(c, "tx_fts"):
+        for trg in ("tx_fts_ai", "tx_fts_ad", "tx_fts_au"):
+            c.execute(f"DROP TRIGGER IF EXISTS {trg}")
+        c.execute("DROP TABLE tx_fts")
+        existed = None
+    c.execute(f"""CREATE VIEW IF NOT EXISTS tx_fts_src AS
+                  SELECT id, note, category, {FTS_LEDGER_KEY.format('ledger_id')} AS ledger_key FROM tx""")
+    try:
+        c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS tx_fts USING fts5(
+            note, category, ledger_key,
+            content='tx_fts_src', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""")
+    except sqlite3.OperationalError as e:
+        FTS_ENABLED = False
+        log.warning(f"FTS5 unavailable, /find falls back to LIKE: {e}")
+        return
+    new_key, old_key = FTS_LEDGER_KEY.format("new.ledger_id"), FTS_LEDGER_KEY.format("old.ledger_id")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS tx_fts_ai AFTER INSERT ON tx BEGIN
+        INSERT INTO tx_fts(rowid, note, category, ledger_key) VALUES (new.id, new.note, new.category, {new_key});
+    END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS tx_fts_ad AFTER DELETE ON tx BEGIN
+        INSERT INTO tx_fts(tx_fts, rowid, note, category, ledger_key) VALUES ('delete', old.id, old.note, old.category, {old_key});
+    END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS tx_fts_au AFTER UPDATE ON tx BEGIN
+        INSERT INTO tx_fts(tx_fts, rowid, note, category, ledger_key) VALUES ('delete', old.id, old.note, old.category, {old_key});
+        INSERT INTO tx_fts(rowid, note, category, ledger_key) VALUES (new.id, new.note, new.category, {new_key});
+    END""")
+    if not existed:
+        c.execute("INSERT INTO tx_fts(tx_fts) VALUES('rebuild')")
 # ---------------- Utils ----------------
 CURRENCY_SIGNS = {
     "usd": ["$", "usd", "дол", "долл", "доллар", "доллары", "долларов", "бакс", "баксы", "bak", "dollar"],
@@ -174,309 +428,1902 @@ def fmt_amount(amount: float, currency: str) -> str:
 def ts_now() -> int:
     return int(time.time())
 
-def dt_fmt(ts: int) -> str:
-    dt = datetime.fromtimestamp(ts, tz=TIMEZONE)
-    return dt.strftime("%d.%m.%Y %H:%M")
-
-def week_bounds_now() -> Tuple[int, int]:
-    now = datetime.now(TIMEZONE)
-    start = datetime(now.year, now.month, now.day, tzinfo=TIMEZONE) - timedelta(days=now.weekday())
-    return int(start.timestamp()), int(now.timestamp())
-
-def month_bounds_now() -> Tuple[int, int]:
-    now = datetime.now(TIMEZONE)
-    start = datetime(now.year, now.month, 1, 0, 0, 0, tzinfo=TIMEZONE)
-    if now.month == 12:
-        next_month = datetime(now.year + 1, 1, 1, tzinfo=TIMEZONE)
-    else:
-        next_month = datetime(now.year, now.month + 1, 1, tzinfo=TIMEZONE)
-    return int(start.timestamp()), int(next_month.timestamp()) - 1
-
-def quarter_bounds_now() -> Tuple[int, int]:
-    now = datetime.now(TIMEZONE)
-    q = (now.month - 1) // 3
-    start_month = q * 3 + 1
-    start = datetime(now.year, start_month, 1, tzinfo=TIMEZONE)
-    return int(start.timestamp()), int(now.timestamp())
+# ---------------- Time zones and periods ----------------
+# A ledger reads and buckets time in its own zone: settings.tz of the chat whose id is the
+# ledger id (the user's private chat for a personal ledger, the group for a shared one),
+# TIMEZONE when unset (/tz). Period starts are memoized per (zone, period) and rebuilt
+# only once the period rolls over; the current UTC offset per (zone, UTC hour), since zones
+# change offset on whole UTC hours, and each zone's offset changes per (zone, year). Every
+# timestamp is bucketed with the offset in force at it: SQL gets the ranges between changes
+# (tz_spans, offset_sql). The *_bounds_now helpers keep their old (start, end) shapes.
+_periods: Dict[Tuple[str, str], Tuple[int, int]] = {}
+_offsets: Dict[str, Tuple[int, int]] = {}
+_transitions: Dict[Tuple[str, int], List[Tuple[int, int]]] = {}
+
+def parse_tz(name: str) -> Optional[ZoneInfo]:
+    """IANA name ("Europe/Berlin") or a whole-hour UTC offset ("UTC+5", "-3")."""
+    name = name.strip()
+    m = re.fullmatch(r"(?i)(?:utc|gmt)?\s*([+-])\s*(\d{1,2})", name)
+    if m:
+        hours = int(m.group(2))
+        if hours > 14: return None
+        # Etc/GMT signs are inverted: Etc/GMT-5 is UTC+5
+        name = "Etc/GMT" + ("" if hours == 0 else ("-" if m.group(1) == "+" else "+") + str(hours))
+    try:
+        return ZoneInfo(name)
+    except Exception:  # ZoneInfoNotFoundError, or a malformed key (ValueError)
+        return None
+
+def tz_label(tz: ZoneInfo) -> str:
+    if tz.key.startswith("Etc/GMT"):
+        return "UTC" + tz.key[7:].translate(str.maketrans("+-", "-+"))
+    return tz.key
+
+def period_bounds(period: str, tz: Optional[ZoneInfo] = None) -> Tuple[int, int]:
+    """(start, next start) of the current "day", "week", "month" or "quarter" in tz."""
+    tz = tz or TIMEZONE
+    key = (tz.key, period)
+    b = _periods.get(key)
+    now = time.time()
+    if b is None or not b[0] <= now < b[1]:
+        d = datetime.now(tz)
+        if period == "day":
+            start = datetime(d.year, d.month, d.day, tzinfo=tz)
+            nxt = start + timedelta(days=1)
+        elif period == "week":
+            start = datetime(d.year, d.month, d.day, tzinfo=tz) - timedelta(days=d.weekday())
+            nxt = start + timedelta(days=7)
+        else:
+            months = 3 if period == "quarter" else 1
+            m0 = (d.month - 1) // months * months
+            start = datetime(d.year, m0 + 1, 1, tzinfo=tz)
+            nxt = datetime(d.year + (m0 + months) // 12, (m0 + months) % 12 + 1, 1, tzinfo=tz)
+        b = _periods[key] = (int(start.timestamp()), int(nxt.timestamp()))
+    return b
+
+def week_bounds_now(tz: Optional[ZoneInfo] = None) -> Tuple[int, int]:
+    return period_bounds("week", tz)[0], ts_now()
+
+def month_bounds_now(tz: Optional[ZoneInfo] = None) -> Tuple[int, int]:
+    start, nxt = period_bounds("month", tz)
+    return start, nxt - 1
+
+def quarter_bounds_now(tz: Optional[ZoneInfo] = None) -> Tuple[int, int]:
+    return period_bounds("quarter", tz)[0], ts_now()
+
+def tz_offset(tz: Optional[ZoneInfo] = None, ts: Optional[int] = None) -> int:
+    """UTC offset in seconds of tz at ts (now by default)."""
+    tz = tz or TIMEZONE
+    hour = (ts_now() if ts is None else ts) // 3600
+    cached = _offsets.get(tz.key)
+    if cached and cached[0] == hour:
+        return cached[1]
+    off = int(datetime.fromtimestamp(hour * 3600, tz).utcoffset().total_seconds())
+    if ts is None:
+        _offsets[tz.key] = (hour, off)
+    return off
+
+def local_day(ts: int, tz: Optional[ZoneInfo] = None) -> int:
+    return (ts + tz_offset(tz, ts)) // 86400
+
+def day_start(day: int, tz: Optional[ZoneInfo] = None) -> int:
+    """UTC timestamp of the local midnight that starts local day `day` in tz."""
+    d = datetime.fromtimestamp(day * 86400, timezone.utc)
+    return int(datetime(d.year, d.month, d.day, tzinfo=tz or TIMEZONE).timestamp())
+
+def _zone_transitions(tz: ZoneInfo, year: int) -> List[Tuple[int, int]]:
+    """(ts, new offset) of every offset change of tz in the UTC year: sampled daily, each
+    change narrowed down to its UTC hour."""
+    key = (tz.key, year)
+    out = _transitions.get(key)
+    if out is None:
+        out = []
+        lo = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+        hi = int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+        prev = tz_offset(tz, lo)
+        for t in range(lo + 86400, hi + 86400, 86400):
+            t = min(t, hi)
+            off = tz_offset(tz, t)
+            if off == prev:
+                continue
+            a, b = (t - 86400) // 3600, t // 3600  # offset at hour a is prev, at hour b is off
+            while b - a > 1:
+                mid = (a + b) // 2
+                if tz_offset(tz, mid * 3600) == prev:
+                    a = mid
+                else:
+                    b = mid
+            out.append((b * 3600, off))
+            prev = off
+        _transitions[key] = out
+    return out
+
+def tz_spans(tz: Optional[ZoneInfo], start: int, end: int) -> List[Tuple[int, int, int]]:
+    """(lo, hi, offset) ranges covering start..end, each with one UTC offset of tz."""
+    tz = tz or TIMEZONE
+    y0, y1 = time.gmtime(start).tm_year, time.gmtime(max(start, end)).tm_year
+    spans, lo, off = [], start, tz_offset(tz, start)
+    for y in range(y0, y1 + 1):
+        for ts, new in _zone_transitions(tz, y):
+            if start < ts <= end:
+                spans.append((lo, ts - 1, off))
+                lo, off = ts, new
+    spans.append((lo, end, off))
+    return spans
+
+def offset_sql(spans: List[Tuple[int, int, int]], col: str = "ts") -> Tuple[str, list]:
+    """SQL expression for the offset at `col` over tz_spans ranges, and its parameters."""
+    if len(spans) == 1:
+        return "?", [spans[0][2]]
+    whens = " ".join(f"WHEN {col} <= ? THEN ?" for _ in spans[:-1])
+    return f"(CASE {whens} ELSE ? END)", [v for _, hi, off in spans[:-1] for v in (hi, off)] + [spans[-1][2]]
+
+def fmt_times(tss: Iterable[int], tz: Optional[ZoneInfo] = None, date_fmt: str = "%d.%m.%Y",
+              with_time: bool = True, seconds: bool = False) -> List[str]:
+    """Format timestamps in one zone: offsets are looked up once per UTC hour and the date
+    part once per local day; the time of day is arithmetic."""
+    tz = tz or TIMEZONE
+    offs: Dict[int, int] = {}
+    days: Dict[int, str] = {}
+    out = []
+    for ts in tss:
+        off = offs.get(ts // 3600)
+        if off is None:
+            off = offs[ts // 3600] = tz_offset(tz, ts)
+        day, secs = divmod(ts + off, 86400)
+        date = days.get(day)
+        if date is None:
+            date = days[day] = time.strftime(date_fmt, time.gmtime(day * 86400))
+        if not with_time:
+            out.append(date)
+        elif seconds:
+            out.append(f"{date} {secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}")
+        else:
+            out.append(f"{date} {secs // 3600:02d}:{secs % 3600 // 60:02d}")
+    return out
+
+def dt_fmt(ts: int, tz: Optional[ZoneInfo] = None) -> str:
+    return fmt_times((ts,), tz)[0]
+
+def ledger_tz(lid: int) -> ZoneInfo:
+    name = get_chat_settings(lid).get("tz")
+    return ZoneInfo(name) if name else TIMEZONE  # set_ledger_tz stores valid keys only
+
+# ---------------- Write batching ----------------
+# The hot-path inserts (add_tx, debt_add, settings, pins) go through one writer connection.
+# Writes arriving within WRITE_BATCH_MS of each other, or while the previous batch is
+# committing, share one transaction and one fsync; each write sits in its own savepoint so a
+# failing statement only fails its caller. WRITE_DURABILITY maps to PRAGMA synchronous:
+# full (fsync every commit), normal (WAL default: a power cut may lose the last commits,
+# never corrupts), off.
+WRITE_BATCH_MAX = 256
+SYNC_MODES = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+class WriteBatcher:
+    def __init__(self, window: float, max_batch: int = WRITE_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: List[Tuple[tuple, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flushing: Optional[asyncio.Task] = None
+        self.con: Optional[sqlite3.Connection] = None
+
+    async def write(self, *stmts: Tuple[str, tuple]) -> int:
+        """Run (sql, params) statements atomically in the next batch; returns the last one's lastrowid.
+        A list of param tuples runs the statement through executemany."""
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((stmts, fut))
+        if self.flushing is None:
+            if len(self.pending) >= self.max_batch:
+                self.start_flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.window, self.start_flush)
+        return await fut
+
+    def start_flush(self):
+        if self.timer:
+            self.timer.cancel(); self.timer = None
+        if self.flushing is None:
+            self.flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        try:
+            while self.pending:
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+                results = await asyncio.to_thread(self.commit, [stmts for stmts, _ in batch])
+                for (_, fut), res in zip(batch, results):
+                    if fut.done():
+                        continue
+                    if isinstance(res, BaseException): fut.set_exception(res)
+                    else: fut.set_result(res)
+        finally:
+            self.flushing = None
+
+    def commit(self, batch: List[tuple]) -> List[Any]:
+        t0 = time.perf_counter()
+        if self.con is None:
+            self.con = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+            self.con.execute(f"PRAGMA synchronous={SYNC_MODES.get(WRITE_DURABILITY, 'NORMAL')}")
+        c = self.con.cursor()
+        out: List[Any] = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for stmts in batch:
+                c.execute("SAVEPOINT w")
+                try:
+                    rowid = None
+                    for sql, params in stmts:
+                        if isinstance(params, list):  # executemany; it leaves lastrowid untouched
+                            c.executemany(sql, params)
+                            rowid = c.execute("SELECT last_insert_rowid()").fetchone()[0]
+                        else:
+                            c.execute(sql, params)
+                            rowid = c.lastrowid
+                    out.append(rowid)
+                    c.execute("RELEASE w")
+                except sqlite3.DatabaseError as e:
+                    c.execute("ROLLBACK TO w"); c.execute("RELEASE w")
+                    out.append(e)
+            c.execute("COMMIT")
+        except Exception as e:
+            if self.con.in_transaction:
+                c.execute("ROLLBACK")
+            return [e] * len(batch)
+        metric_inc("write_batches_total")
+        metric_inc("write_ops_total", len(batch))
+        metric_inc("write_commit_seconds_total", time.perf_counter() - t0)
+        return out
+
+    async def close(self):
+        """Flush whatever is queued and release the connection (shutdown hook)."""
+        self.start_flush()
+        while self.flushing:
+            await self.flushing
+        if self.con:
+            self.con.close(); self.con = None
+
+WRITES = WriteBatcher(WRITE_BATCH_MS / 1000.0)
 
 # ---------------- DB Ops ----------------
-def add_tx(uid: int, ttype: str, amount: float, currency: str, category: str, note: str = "") -> int:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("INSERT INTO tx(user_id, ttype, amount, currency, category, note, ts) VALUES(?,?,?,?,?,?,?)",
-              (uid, ttype, amount, currency, category, note, ts_now()))
-    con.commit(); rowid = c.lastrowid; con.close()
-    return rowid
+# All row access of the helpers below goes through STORE (see storage.py); the helpers add
+# tracing and keep the ledger cache and the per-chat caches in step with it.
+class SqliteStorage(Storage):
+    """The production backend: reads on short-lived connections, hot-path writes through
+    WRITES, deletes and debt payments on their own connection (they need RETURNING rows or
+    a read-then-write on the same connection)."""
+
+    def rows(self, sql: str, args: tuple = ()) -> List[tuple]:
+        con = sqlite3.connect(DB_PATH)
+        try:
+            return con.execute(sql, args).fetchall()
+        finally:
+            con.close()
 
-def delete_tx(uid: int, tx_id: int) -> bool:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("DELETE FROM tx WHERE id=? AND user_id=?", (tx_id, uid))
-    ok = c.rowcount > 0
-    con.commit(); con.close()
-    return ok
+    def one(self, sql: str, args: tuple = ()) -> Optional[tuple]:
+        rows = self.rows(sql, args)
+        return rows[0] if rows else None
 
-def last_txs(uid: int, limit: int = 10, offset: int = 0) -> List[tuple]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, ttype, amount, currency, category, note, ts
-                 FROM tx WHERE user_id=?
-                 ORDER BY ts DESC, id DESC
-                 LIMIT ? OFFSET ?""", (uid, limit, offset))
-    rows = c.fetchall(); con.close()
-    return rows
+    def commit(self, sql: str, args: tuple = ()) -> List[tuple]:
+        con = sqlite3.connect(DB_PATH)
+        try:
+            rows = con.execute(sql, args).fetchall()
+            con.commit()
+            return rows
+        finally:
+            con.close()
+
+    # ---- transactions
+    async def add_txs(self, uid, lid, rows, ts):
+        # the writer connection inserts them back to back inside one transaction, so the
+        # AUTOINCREMENT ids are consecutive
+        last = await WRITES.write(("INSERT INTO tx(user_id, ledger_id, ttype, amount, currency, category, note, ts) VALUES(?,?,?,?,?,?,?,?)",
+                                   [(uid, lid, *r, ts) for r in rows]))
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def delete_txs(self, uid, tx_ids):
+        return self.commit(f"""DELETE FROM tx WHERE user_id=? AND id IN ({','.join('?' * len(tx_ids))})
+                               RETURNING ledger_id, id, user_id, ttype, amount, currency, category, ts""", (uid, *tx_ids))
+
+    def last_txs(self, lid, limit, offset):
+        con = sqlite3.connect(DB_PATH); c = con.cursor()
+        c.execute("""SELECT id, ttype, amount, currency, category, note, ts
+                     FROM tx WHERE ledger_id=?
+                     ORDER BY ts DESC, id DESC
+                     LIMIT ? OFFSET ?""", (lid, limit, offset))
+        rows = c.fetchall()
+        if len(rows) < limit and archive_paths():
+            c.execute("SELECT COUNT(*) FROM tx WHERE ledger_id=?", (lid,))
+            rows += archive_last_txs(lid, limit - len(rows), max(0, offset - c.fetchone()[0]))
+        con.close()
+        return rows
+
+    def tx_between(self, lid, start, end):
+        return tx_rows_between(lid, start, end)
+
+    def ledger_totals(self, lid):
+        return self.rows("""SELECT user_id, currency, SUM(CASE WHEN ttype='income' THEN amount ELSE -amount END), SUM(n)
+                            FROM (SELECT user_id, ttype, amount, currency, 1 AS n FROM tx WHERE ledger_id=?
+                                  UNION ALL SELECT user_id, ttype, amount, currency, n FROM tx_archived_totals WHERE ledger_id=?)
+                            GROUP BY user_id, currency""", (lid, lid))
+
+    def expense_totals(self, lid, start, end):
+        return self.rows("""SELECT category, currency, SUM(amount) FROM tx
+                            WHERE ledger_id=? AND ttype='expense' AND ts BETWEEN ? AND ?
+                            GROUP BY category, currency""", (lid, start, end))
+
+    def expenses_by_day(self, lid, since, spans):
+        off, params = offset_sql(spans)
+        return self.rows(f"""SELECT (ts + {off}) / 86400 AS day, category, currency, SUM(amount) FROM tx
+                             WHERE ledger_id=? AND ttype='expense' AND ts >= ?
+                             GROUP BY day, category, currency ORDER BY day""", (*params, lid, since))
+
+    def report_buckets(self, lid, start, end, spans):
+        off, params = offset_sql(spans)
+        return self.rows(f"""SELECT (ts + {off}) / 86400 AS day, ttype, category, currency, SUM(amount)
+                             FROM tx WHERE ledger_id=? AND ts BETWEEN ? AND ?
+                             GROUP BY day, ttype, category, currency""", (*params, lid, start, end))
+
+    # ---- debts
+    async def add_debt(self, uid, lid, direction, amount, currency, name, name_key, note, ts):
+        return await WRITES.write(("""INSERT INTO counterparties(ledger_id, name, name_key, created_ts) VALUES(?,?,?,?)
+                                      ON CONFLICT(ledger_id, name_key) DO NOTHING""", (lid, name, name_key, ts)),
+                                  ("""INSERT INTO debts(user_id, ledger_id, direction, amount, currency, counterparty, counterparty_id,
+                                                        note, status, created_ts, updated_ts)
+                                      VALUES(?,?,?,?,?,?,(SELECT id FROM counterparties WHERE ledger_id=? AND name_key=?),?, 'open', ?, ?)""",
+                                   (uid, lid, direction, amount, currency, name, lid, name_key, note, ts, ts)))
+
+    def delete_debt(self, uid, debt_id):
+        rows = self.commit("DELETE FROM debts WHERE id=? AND user_id=? RETURNING ledger_id", (debt_id, uid))
+        return rows[0][0] if rows else None
+
+    def open_debts(self, lid):
+        return self.rows("""SELECT id, direction, amount, currency, counterparty, created_ts
+                            FROM debts WHERE ledger_id=? AND status='open'
+                            ORDER BY created_ts DESC, id DESC""", (lid,))
+
+    def debt_groups(self, lid, direction, limit, offset):
+        signed = "amount" if direction else "CASE WHEN d.direction='owed' THEN d.amount ELSE -d.amount END"
+        where, args = "d.ledger_id=? AND d.status='open'", [lid]
+        if direction:
+            where += " AND d.direction=?"; args.append(direction)
+        return self.rows(f"""SELECT cp.id, cp.name, d.currency, SUM({signed}) AS total, COUNT(*)
+                             FROM debts d JOIN counterparties cp ON cp.id = d.counterparty_id
+                             WHERE {where}
+                             GROUP BY cp.id, d.currency
+                             HAVING ABS(total) > 0.0001
+                             ORDER BY ABS(total) DESC, cp.name_key LIMIT ? OFFSET ?""", (*args, limit, offset))
+
+    def counterparty_debts(self, lid, cp_id):
+        con = sqlite3.connect(DB_PATH); c = con.cursor()
+        row = c.execute("SELECT name FROM counterparties WHERE id=? AND ledger_id=?", (cp_id, lid)).fetchone()
+        if not row:
+            con.close(); return None, [], []
+        c.execute("""SELECT id, direction, amount, currency, created_ts FROM debts
+                     WHERE ledger_id=? AND counterparty_id=? AND status='open'
+                     ORDER BY created_ts DESC, id DESC""", (lid, cp_id))
+        debts = c.fetchall()
+        c.execute("""SELECT p.debt_id, p.amount, d.currency, p.ts FROM debt_payments p JOIN debts d ON d.id = p.debt_id
+                     WHERE d.ledger_id=? AND d.counterparty_id=? ORDER BY p.ts DESC, p.id DESC LIMIT 5""", (lid, cp_id))
+        payments = c.fetchall(); con.close()
+        return row[0], debts, payments
+
+    def get_debt(self, lid, debt_id):
+        return self.one("SELECT amount, currency, status FROM debts WHERE id=? AND ledger_id=?", (debt_id, lid))
+
+    def pay_debt(self, lid, debt_id, uid, paid, remaining, ts):
+        con = sqlite3.connect(DB_PATH); c = con.cursor()
+        c.execute("INSERT INTO debt_payments(debt_id, ledger_id, user_id, amount, ts) VALUES(?,?,?,?,?)",
+                  (debt_id, lid, uid, paid, ts))
+        payment_id = c.lastrowid
+        if remaining <= 0:
+            c.execute("UPDATE debts SET status='closed', amount=0, updated_ts=? WHERE id=?", (ts, debt_id))
+        else:
+            c.execute("UPDATE debts SET amount=?, updated_ts=? WHERE id=?", (remaining, ts, debt_id))
+        con.commit(); con.close()
+        return payment_id
 
-def count_txs(uid: int) -> int:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("SELECT COUNT(*) FROM tx WHERE user_id=?", (uid,))
-    n = c.fetchone()[0]
-    con.close()
-    return int(n or 0)
+    def undo_payment(self, debt_id, amount, payment_id, ts):
+        con = sqlite3.connect(DB_PATH); c = con.cursor()
+        c.execute("UPDATE debts SET amount=?, status='open', updated_ts=? WHERE id=? RETURNING ledger_id",
+                  (amount, ts, debt_id))
+        row = c.fetchone()
+        if payment_id:
+            c.execute("DELETE FROM debt_payments WHERE id=? AND debt_id=?", (payment_id, debt_id))
+        con.commit(); con.close()
+        return row[0] if row else None
+
+    def debts_export(self, lid):
+        return self.rows("""SELECT d.id, d.direction, d.amount, COALESCE(SUM(p.amount), 0), d.currency, d.counterparty, d.status,
+                                   d.created_ts, d.updated_ts
+                            FROM debts d LEFT JOIN debt_payments p ON p.debt_id = d.id
+                            WHERE d.ledger_id=? GROUP BY d.id ORDER BY d.created_ts DESC""", (lid,))
+
+    # ---- budgets
+    def set_budget(self, uid, lid, category, currency, limit_amount, period, ts):
+        self.commit("""INSERT INTO budgets(user_id, ledger_id, category, currency, limit_amount, period, active, created_ts, updated_ts)
+                       VALUES(?,?,?,?,?,?,1,?,?)
+                       ON CONFLICT(ledger_id, category, currency) DO UPDATE SET
+                       limit_amount=excluded.limit_amount, period=excluded.period, active=1, updated_ts=excluded.updated_ts""",
+                    (uid, lid, category, currency, limit_amount, period, ts, ts))
+
+    def active_budgets(self, lid):
+        return self.rows("""SELECT id, category, currency, limit_amount, period, active FROM budgets
+                            WHERE ledger_id=? AND active=1 ORDER BY category""", (lid,))
+
+    # ---- ledgers
+    def group_ledger_enabled(self, chat_id):
+        return self.one("SELECT 1 FROM ledgers WHERE id=? AND kind='group'", (chat_id,)) is not None
+
+    def set_group_ledger(self, chat_id, enabled, title, ts):
+        if enabled:
+            self.commit("""INSERT INTO ledgers(id, kind, title, created_ts) VALUES(?, 'group', ?, ?)
+                           ON CONFLICT(id) DO UPDATE SET title=excluded.title""", (chat_id, title, ts))
+        else:
+            # rows keep ledger_id = chat_id, so re-enabling brings the history back
+            self.commit("DELETE FROM ledgers WHERE id=?", (chat_id,))
 
-def net_by_currency(uid: int) -> dict:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT currency, SUM(CASE WHEN ttype='income' THEN amount ELSE -amount END) as net
-                 FROM tx WHERE user_id=? GROUP BY currency""", (uid,))
-    res = {row[0]: row[1] or 0.0 for row in c.fetchall()}
-    con.close()
-    return res
+    def ensure_member(self, lid, uid, name, ts):
+        con = sqlite3.connect(DB_PATH); c = con.cursor()
+        if lid == uid:
+            c.execute("INSERT OR IGNORE INTO ledgers(id, kind, title, created_ts) VALUES(?, 'personal', ?, ?)", (lid, name, ts))
+        c.execute("""INSERT INTO ledger_members(ledger_id, user_id, name, joined_ts) VALUES(?,?,?,?)
+                     ON CONFLICT(ledger_id, user_id) DO UPDATE SET name=excluded.name""", (lid, uid, name, ts))
+        con.commit(); con.close()
+
+    def member_names(self, lid):
+        return {int(u): (n or str(u)) for u, n in self.rows("SELECT user_id, name FROM ledger_members WHERE ledger_id=?", (lid,))}
+
+    def insight_tip(self, lid):
+        return self.one("SELECT tip, computed_ts FROM insights WHERE ledger_id=?", (lid,))
+
+    # ---- settings & pins
+    def chat_settings(self, chat_id):
+        row = self.one("SELECT autopin, autoclean, group_silent, lang, digest, tz FROM settings WHERE chat_id=?", (chat_id,))
+        if not row:
+            return None
+        return {"autopin": int(row[0]), "autoclean": int(row[1]), "group_silent": int(row[2]), "lang": row[3],
+                "digest": row[4], "tz": row[5]}
+
+    async def set_chat_setting(self, chat_id, key, value, ts):
+        await WRITES.write(("""INSERT INTO settings(chat_id, autopin, autoclean, group_silent, lang, updated_ts)
+                               VALUES(?,1,1,1,'ru',?) ON CONFLICT(chat_id) DO NOTHING""", (chat_id, ts)),
+                           (f"UPDATE settings SET {key}=?, updated_ts=? WHERE chat_id=?", (value, ts, chat_id)))
+
+    def pinned_msg_id(self, chat_id):
+        row = self.one("SELECT message_id FROM pins WHERE chat_id=?", (chat_id,))
+        return int(row[0]) if row else None
+
+    async def set_pinned_msg_id(self, chat_id, message_id):
+        await WRITES.write(("""INSERT INTO pins(chat_id, message_id) VALUES(?,?)
+                               ON CONFLICT(chat_id) DO UPDATE SET message_id=excluded.message_id""", (chat_id, message_id)))
+
+    # ---- search
+    def search_txs(self, lid, q, before, limit):
+        where, args = ["tx.ledger_id=?"], [lid]
+        for bound in (q["min"], q["max"]):
+            if bound is not None: where.append(f"tx.amount{bound[0]}?"); args.append(bound[1])  # op from the regex only
+        if q["start"] is not None: where.append("tx.ts BETWEEN ? AND ?"); args += [q["start"], q["end"]]
+        if q["currency"]: where.append("tx.currency=?"); args.append(q["currency"])
+        if before: where.append("(tx.ts<? OR (tx.ts=? AND tx.id<?))"); args += [before[0], before[0], before[1]]
+        src = "tx"
+        if q["terms"]:
+            if FTS_ENABLED:
+                src = "tx_fts JOIN tx ON tx.id = tx_fts.rowid"
+                where.insert(0, "tx_fts MATCH ?"); args.insert(0, fts_match_expr(lid, q["terms"]))
+            else:
+                for t in q["terms"]:
+                    where.append("(tx.note LIKE ? OR tx.category LIKE ?)"); args += [f"%{t}%", f"%{t}%"]
+        sql = f"""SELECT tx.id, tx.ttype, tx.amount, tx.currency, tx.category, tx.note, tx.ts
+                  FROM {src} WHERE {' AND '.join(where)}
+                  ORDER BY tx.ts DESC, tx.id DESC LIMIT ?"""
+        rows: List[tuple] = []
+        # archived rows are all older than hot ones, so the keyset order carries straight on
+        for path in [DB_PATH, *archive_paths()]:
+            con = sqlite3.connect(path)
+            rows += con.execute(sql, (*args, limit - len(rows))).fetchall()
+            con.close()
+            if len(rows) >= limit:
+                break
+        return rows
+
+    # ---- FX rates & chart cache
+    def fx_rates(self):
+        return self.rows("SELECT currency, day, rate FROM fx_rates ORDER BY currency, day")
+
+    def put_fx_rates(self, rows):
+        fx_upsert(DB_PATH, rows)
+
+    def chart_file(self, key):
+        return self.one("SELECT kind, file_id FROM chart_files WHERE key=?", (key,))
+
+    def set_chart_file(self, key, kind, file_id, ts):
+        self.commit("""INSERT INTO chart_files(key, kind, file_id, created_ts) VALUES(?,?,?,?)
+                       ON CONFLICT(key) DO UPDATE SET kind=excluded.kind, file_id=excluded.file_id""",
+                    (key, kind, file_id, ts))
+
+# Still on their own SQLite connections, outside STORE: init_db (migrations), the archive
+# job, compute_insights, build_digests and the digest outbox, aggregate_stats and
+# admin_stats_text (/admin_stats, every shard's file), backups, and fx_write's copies of a
+# rate into the other shards' files. archive_last_txs and tx_rows_between are only
+# reached through SqliteStorage.
+STORE: Storage = SqliteStorage()
+
+def ledger_after_write(lid: int, before: Optional["LedgerState"]) -> Optional["LedgerState"]:
+    """The cached ledger to patch after an awaited write, given the entry cached when the
+    write started. An entry loaded while the write was in flight may or may not already hold
+    the new rows, so it is dropped (the next read reloads) rather than patched."""
+    st = LEDGERS.peek(lid)
+    if st is not None and st is not before:
+        LEDGERS.invalidate(lid)
+        return None
+    return st
+
+@traced("db.add_tx")
+async def add_tx(uid: int, ttype: str, amount: float, currency: str, category: str, note: str = "",
+                 lid: Optional[int] = None) -> int:
+    lid = uid if lid is None else lid
+    ts = ts_now()
+    before = LEDGERS.peek(lid)
+    rowid, = await STORE.add_txs(uid, lid, [(ttype, amount, currency, category, note)], ts)
+    st = ledger_after_write(lid, before)
+    if st:
+        st.add_tx(rowid, uid, ttype, amount, currency, category, note, ts)
+        LEDGERS.resize(st)
+    return rowid
 
-def debt_add(uid: int, direction: str, amount: float, currency: str, counterparty: str, note: str = "") -> int:
+@traced("db.add_txs")
+async def add_txs(uid: int, rows: List[Tuple[str, float, str, str, str]], lid: Optional[int] = None) -> List[int]:
+    """Insert (ttype, amount, currency, category, note) rows in one write; returns their ids."""
+    lid = uid if lid is None else lid
+    ts = ts_now()
+    before = LEDGERS.peek(lid)
+    ids = await STORE.add_txs(uid, lid, rows, ts)
+    st = ledger_after_write(lid, before)
+    if st:
+        for rowid, r in zip(ids, rows):
+            st.add_tx(rowid, uid, *r, ts)
+        LEDGERS.resize(st)
+    return ids
+
+@traced("db.delete_tx")
+def delete_tx(uid: int, tx_id: int) -> bool:
+    return delete_txs(uid, [tx_id]) == 1
+
+def forget_tx(lid: int, *tx: Any):
+    """Patch a cached ledger for a deleted tx row (id, user_id, ttype, amount, currency, category, ts)."""
+    st = LEDGERS.peek(lid)
+    if st:
+        st.remove_tx(*tx)
+        LEDGERS.resize(st)
+
+@traced("db.delete_txs")
+def delete_txs(uid: int, tx_ids: List[int]) -> int:
+    rows = STORE.delete_txs(uid, tx_ids)
+    for row in rows:
+        forget_tx(*row)
+    return len(rows)
+
+@traced("db.last_txs")
+def last_txs(lid: int, limit: int = 10, offset: int = 0) -> List[tuple]:
+    if offset == 0 and limit <= RECENT_PAGE:
+        return ledger_state(lid).recent[:limit]
+    return load_last_txs(lid, limit, offset)
+
+@traced("db.load_last_txs")
+def load_last_txs(lid: int, limit: int, offset: int) -> List[tuple]:
+    return STORE.last_txs(lid, limit, offset)
+
+@traced("db.count_txs")
+def count_txs(lid: int) -> int:
+    return ledger_state(lid).count
+
+@traced("db.net_by_currency")
+def net_by_currency(lid: int) -> dict:
+    return dict(ledger_state(lid).net)
+
+@traced("db.net_by_member")
+def net_by_member(lid: int) -> Tuple[dict, Dict[int, dict]]:
+    """Ledger net per currency plus each member's share."""
+    st = ledger_state(lid)
+    return dict(st.net), {u: dict(m) for u, m in st.members.items()}
+
+@traced("db.debt_add")
+async def debt_add(uid: int, direction: str, amount: float, currency: str, counterparty: str, note: str = "",
+                   lid: Optional[int] = None) -> int:
     now = ts_now()
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""INSERT INTO debts(user_id, direction, amount, currency, counterparty, note, status, created_ts, updated_ts)
-                 VALUES(?,?,?,?,?,?, 'open', ?, ?)""",
-              (uid, direction, amount, currency, counterparty or "", note, now, now))
-    con.commit(); rowid = c.lastrowid; con.close()
+    lid = uid if lid is None else lid
+    name = (counterparty or "").strip()
+    before = LEDGERS.peek(lid)
+    rowid = await STORE.add_debt(uid, lid, direction, amount, currency, name, counterparty_key(name), note, now)
+    st = ledger_after_write(lid, before)
+    if st:
+        st.debts.insert(0, (rowid, direction, amount, currency, counterparty or "", now))
+        LEDGERS.resize(st)
     return rowid
 
+@traced("db.delete_debt")
 def delete_debt(uid: int, debt_id: int) -> bool:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("DELETE FROM debts WHERE id=? AND user_id=?", (debt_id, uid))
-    ok = c.rowcount > 0
-    con.commit(); con.close()
-    return ok
-
-def debts_open(uid: int, direction: str) -> List[tuple]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, amount, currency, counterparty, created_ts
-                 FROM debts WHERE user_id=? AND direction=? AND status='open'
-                 ORDER BY created_ts DESC, id DESC""", (uid, direction))
-    rows = c.fetchall(); con.close()
-    return rows
-
-def debt_get(uid: int, debt_id: int) -> Optional[tuple]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, amount, currency, counterparty, status
-                 FROM debts WHERE id=? AND user_id=?""", (debt_id, uid))
-    row = c.fetchone(); con.close()
-    return row
-
-def debt_totals_by_currency(uid: int) -> dict:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT currency, direction, SUM(amount) FROM debts
-                 WHERE user_id=? AND status='open'
-                 GROUP BY currency, direction""", (uid,))
+    lid = STORE.delete_debt(uid, debt_id)
+    if lid is not None:
+        LEDGERS.invalidate(lid)
+    return lid is not None
+
+@traced("db.debt_groups")
+def debt_groups(lid: int, direction: Optional[str], limit: int, offset: int = 0) -> List[tuple]:
+    """Open debts summed per (counterparty, currency) in one grouped pass, largest first:
+    (counterparty_id, name, currency, total, count). With direction=None both directions
+    net out: positive means they owe us."""
+    return STORE.debt_groups(lid, direction, limit, offset)
+
+@traced("db.counterparty_debts")
+def counterparty_debts(lid: int, cp_id: int) -> Tuple[Optional[str], List[tuple], List[tuple]]:
+    """(name, open debts (id, direction, amount, currency, created_ts), last payments (debt_id, amount, currency, ts))."""
+    return STORE.counterparty_debts(lid, cp_id)
+
+@traced("db.debt_totals_by_currency")
+def debt_totals_by_currency(lid: int) -> dict:
     res = {}
-    for currency, direction, s in c.fetchall():
+    for _, direction, amount, currency, _, _ in ledger_state(lid).debts:
         if currency not in res: res[currency] = {"owes": 0.0, "owed": 0.0}
-        res[currency][direction] = s or 0.0
-    con.close()
+        res[currency][direction] += amount or 0.0
     return res
 
-def debt_reduce_or_close(uid: int, debt_id: int, reduce_amount: Optional[float] = None) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("SELECT amount, currency, status FROM debts WHERE id=? AND user_id=?", (debt_id, uid))
-    row = c.fetchone()
+@traced("db.debt_reduce_or_close")
+def debt_reduce_or_close(lid: int, debt_id: int, reduce_amount: Optional[float] = None,
+                         uid: Optional[int] = None) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+    """Record a payment against the debt (the whole remainder when reduce_amount is None)."""
+    row = STORE.get_debt(lid, debt_id)
     if not row:
-        con.close(); return False, "Долг не найден.", None
+        return False, "Долг не найден.", None
     amount, currency, status = float(row[0]), row[1], row[2]
     if status != "open":
-        con.close(); return False, "Долг уже закрыт.", None
-    undo = {"type":"debt_update", "debt_id": debt_id, "prev_amount": amount, "prev_status": status}
-    if reduce_amount is None or reduce_amount >= amount:
-        c.execute("UPDATE debts SET status='closed', amount=0, updated_ts=? WHERE id=?", (ts_now(), debt_id))
-        con.commit(); con.close()
+        return False, "Долг уже закрыт.", None
+    paid = amount if reduce_amount is None else min(reduce_amount, amount)
+    payment_id = STORE.pay_debt(lid, debt_id, lid if uid is None else uid, paid, amount - paid, ts_now())
+    undo = {"type":"debt_update", "debt_id": debt_id, "prev_amount": amount, "prev_status": status,
+            "payment_id": payment_id}
+    st = LEDGERS.peek(lid)
+    if paid >= amount:
+        if st: st.debts = [d for d in st.debts if d[0] != debt_id]
         return True, f"✅ Долг #{debt_id} закрыт.", undo
     else:
-        new_amount = amount - reduce_amount
-        c.execute("UPDATE debts SET amount=?, updated_ts=? WHERE id=?", (new_amount, ts_now(), debt_id))
-        con.commit(); con.close()
+        new_amount = amount - paid
+        if st: st.debts = [d[:2] + (new_amount,) + d[3:] if d[0] == debt_id else d for d in st.debts]
         return True, f"➖ Сумма долга #{debt_id} уменьшена: {fmt_amount(new_amount, currency)}", undo
 
+@traced("db.debt_restore")
+def debt_restore(debt_id: int, amount: float, payment_id: Optional[int]) -> bool:
+    """Undo of debt_reduce_or_close: reopen at the previous amount and drop the payment."""
+    lid = STORE.undo_payment(debt_id, amount, payment_id, ts_now())
+    if lid is not None:
+        LEDGERS.invalidate(lid)
+    return lid is not None
+
 # Budgets
-def budget_set(uid: int, category: str, currency: str, limit_amount: float, period: str = "month"):
-    now = ts_now()
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""INSERT INTO budgets(user_id, category, currency, limit_amount, period, active, created_ts, updated_ts)
-                 VALUES(?,?,?,?,1,1,?,?)
-                 ON CONFLICT(user_id, category, currency) DO UPDATE SET
-                 limit_amount=excluded.limit_amount, period=excluded.period, active=1, updated_ts=excluded.updated_ts""",
-              (uid, category, currency, limit_amount, now, now))
-    con.commit(); con.close()
+@traced("db.budget_set")
+def budget_set(uid: int, category: str, currency: str, limit_amount: float, period: str = "month",
+               lid: Optional[int] = None):
+    lid = uid if lid is None else lid
+    STORE.set_budget(uid, lid, category, currency, limit_amount, period, ts_now())
+    LEDGERS.invalidate(lid)
+
+@traced("db.budget_list")
+def budget_list(lid: int) -> List[tuple]:
+    return list(ledger_state(lid).budgets)
+
+# budgets.period is "month" or "week" (calendar, so far), "rolling:<days>" (the last N days
+# including today) or "custom:<first day>:<last day>" (local day numbers, see local_day).
+BUDGET_MAX_DAYS = 120  # rolling/custom windows stay within ARCHIVE_MIN_DAYS of hot rows
+
+def budget_window(period: str, tz: Optional[ZoneInfo] = None) -> Tuple[int, int]:
+    """(first, last) local day of the period's current window in tz."""
+    today = local_day(ts_now(), tz)
+    if period == "week":
+        return local_day(week_bounds_now(tz)[0], tz), today
+    if period.startswith("rolling:"):
+        return today - int(period.split(":")[1]) + 1, today
+    if period.startswith("custom:"):
+        _, first, last = period.split(":")
+        return int(first), int(last)
+    return local_day(month_bounds_now(tz)[0], tz), today
+
+def budget_period_label(period: str) -> str:
+    if period == "week":
+        return "неделя"
+    if period.startswith("rolling:"):
+        return f"{period.split(':')[1]} дн."
+    if period.startswith("custom:"):
+        first, last = budget_window(period)
+        fmt = lambda d: datetime.fromtimestamp(d * 86400, tz=timezone.utc).strftime("%d.%m")
+        return f"{fmt(first)}–{fmt(last)}"
+    return "месяц"
+
+@traced("db.budget_spent")
+def budget_spent(lid: int, category: str, currency: str, period: str) -> float:
+    st = ledger_state(lid)
+    first, last = budget_window(period, st.tz)
+    return st.spend_index().total(category, currency, first, last)
 
-def budget_list(uid: int) -> List[tuple]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, category, currency, limit_amount, period, active FROM budgets
-                 WHERE user_id=? AND active=1 ORDER BY category""", (uid,))
-    rows = c.fetchall(); con.close()
+# Settings & pins
+_chat_settings: Dict[int, Dict[str, Any]] = {}
+_pins: Dict[int, Optional[int]] = {}
+
+@traced("db.get_chat_settings")
+def get_chat_settings(chat_id: int) -> Dict[str, Any]:
+    if chat_id in _chat_settings:
+        return dict(_chat_settings[chat_id])
+    st = STORE.chat_settings(chat_id) or dict(SETTING_DEFAULTS)
+    _chat_settings[chat_id] = st
+    return dict(st)
+
+@traced("db.set_chat_setting")
+async def set_chat_setting(chat_id: int, key: str, value: Any):
+    await STORE.set_chat_setting(chat_id, key, value, ts_now())
+    _chat_settings.pop(chat_id, None)
+
+@traced("db.get_pinned_msg_id")
+def get_pinned_msg_id(chat_id: int) -> Optional[int]:
+    if chat_id in _pins:
+        return _pins[chat_id]
+    _pins[chat_id] = STORE.pinned_msg_id(chat_id)
+    return _pins[chat_id]
+
+@traced("db.set_pinned_msg_id")
+async def set_pinned_msg_id(chat_id: int, message_id: int):
+    await STORE.set_pinned_msg_id(chat_id, message_id)
+    _pins[chat_id] = message_id
+
+# ---------------- Ledger cache ----------------
+# Hot ledgers keep what a typical action reads in memory: balances (per member), open
+# debts, active budgets, this month's expenses per category, the first history page, the
+# row count, the insight tip and (built on first budget check) daily spend prefix sums.
+# The DB helpers patch an entry after their write; changes that are awkward to replay
+# (debt undo, budget edits, restore) drop it and the next read reloads.
+RECENT_PAGE = 10
+
+class DailySpend:
+    """Cumulative expenses of one (category, currency) per local day: cum[i] is the total of
+    days base .. base+i-1, so any window is one subtraction. Adding today's expense touches
+    only the last element; days before base are ignored (no window reaches them)."""
+    __slots__ = ("base", "cum")
+
+    def __init__(self, base: int):
+        self.base = base
+        self.cum: List[float] = [0.0]
+
+    def add(self, day: int, amount: float):
+        i = day - self.base + 1
+        if i < 1:
+            return
+        cum = self.cum
+        if i >= len(cum):
+            cum.extend([cum[-1]] * (i + 1 - len(cum)))
+        for j in range(i, len(cum)):
+            cum[j] += amount
+
+    def total(self, first: int, last: int) -> float:
+        top = len(self.cum) - 1
+        hi = min(max(last - self.base + 1, 0), top)
+        lo = min(max(first - self.base, 0), top)
+        return self.cum[hi] - self.cum[lo] if hi > lo else 0.0
+
+class SpendIndex:
+    __slots__ = ("base", "series")
+
+    def __init__(self, base: int):
+        self.base = base
+        self.series: Dict[Tuple[str, str], DailySpend] = {}
+
+    def add(self, category: str, currency: str, day: int, amount: float):
+        ds = self.series.get((category, currency))
+        if ds is None:
+            ds = self.series[(category, currency)] = DailySpend(self.base)
+        ds.add(day, amount)
+
+    def total(self, category: str, currency: str, first: int, last: int) -> float:
+        ds = self.series.get((category, currency))
+        return ds.total(first, last) if ds else 0.0
+
+    def total_all(self, first: int, last: int) -> float:
+        return sum(ds.total(first, last) for ds in self.series.values())
+
+    def approx_size(self) -> int:
+        return sum(120 + 8 * len(ds.cum) for ds in self.series.values())
+
+class LedgerState:
+    __slots__ = ("lid", "tz", "net", "members", "count", "debts", "budgets", "month_start", "month_cats",
+                 "recent", "tip", "spend", "size")
+
+    def __init__(self, lid: int):
+        self.lid = lid
+        self.size = 0
+        self.spend: Optional[SpendIndex] = None
+
+    def load(self, store: Storage):
+        lid = self.lid
+        self.tz = ledger_tz(lid)
+        self.net: Dict[str, float] = {}; self.members: Dict[int, Dict[str, float]] = {}; self.count = 0
+        for user_id, currency, net, n in store.ledger_totals(lid):
+            self.net[currency] = self.net.get(currency, 0.0) + (net or 0.0)
+            self.members.setdefault(user_id, {})[currency] = net or 0.0
+            self.count += n
+        self.debts: List[tuple] = store.open_debts(lid)
+        self.budgets: List[tuple] = store.active_budgets(lid)
+        self.month_start, end = month_bounds_now(self.tz)
+        self.month_cats: Dict[Tuple[str, str], float] = {(cat, cur): s or 0.0 for cat, cur, s in store.expense_totals(lid, self.month_start, end)}
+        self.recent: List[tuple] = load_last_txs(lid, RECENT_PAGE, 0)
+        self.tip: Optional[tuple] = store.insight_tip(lid) or ()  # () = no insight yet, None = not loaded
+
+    def add_tx(self, rowid: int, uid: int, ttype: str, amount: float, currency: str, category: str, note: str, ts: int):
+        signed = amount if ttype == "income" else -amount
+        self.net[currency] = self.net.get(currency, 0.0) + signed
+        m = self.members.setdefault(uid, {})
+        m[currency] = m.get(currency, 0.0) + signed
+        self.count += 1
+        if ttype == "expense" and ts >= self.month_start:
+            self.month_cats[(category, currency)] = self.month_cats.get((category, currency), 0.0) + amount
+        if ttype == "expense" and self.spend is not None:
+            self.spend.add(category, currency, local_day(ts, self.tz), amount)
+        self.recent.insert(0, (rowid, ttype, amount, currency, category, note, ts))
+        del self.recent[RECENT_PAGE:]
+
+    def remove_tx(self, rowid: int, uid: int, ttype: str, amount: float, currency: str, category: str, ts: int):
+        signed = amount if ttype == "income" else -amount
+        self.net[currency] = self.net.get(currency, 0.0) - signed
+        m = self.members.setdefault(uid, {})
+        m[currency] = m.get(currency, 0.0) - signed
+        self.count -= 1
+        if ttype == "expense" and ts >= self.month_start:
+            self.month_cats[(category, currency)] = self.month_cats.get((category, currency), 0.0) - amount
+        if ttype == "expense" and self.spend is not None:
+            self.spend.add(category, currency, local_day(ts, self.tz), -amount)
+        if any(r[0] == rowid for r in self.recent):
+            self.recent = load_last_txs(self.lid, RECENT_PAGE, 0)
+
+    def spend_index(self) -> SpendIndex:
+        """Daily spend prefix sums reaching back to the earliest active budget window, and
+        at least to the start of last week (the tip compares the two weeks)."""
+        if self.spend is None:
+            last_week = local_day(week_bounds_now(self.tz)[0], self.tz) - 7
+            base = min([budget_window(b[4], self.tz)[0] for b in self.budgets] + [last_week])
+            idx = SpendIndex(base)
+            since = day_start(base, self.tz)
+            for day, category, currency, total in STORE.expenses_by_day(self.lid, since, tz_spans(self.tz, since, ts_now())):
+                idx.add(category, currency, day, total or 0.0)
+            self.spend = idx
+            LEDGERS.resize(self)
+        return self.spend
+
+    def approx_size(self) -> int:
+        return (400 + 80 * len(self.net) + sum(100 + 80 * len(m) for m in self.members.values())
+                + 160 * len(self.debts) + 140 * len(self.budgets) + 110 * len(self.month_cats)
+                + sum(200 + len(r[5] or "") for r in self.recent) + (len(self.tip[0]) * 2 if self.tip else 0)
+                + (self.spend.approx_size() if self.spend is not None else 0))
+
+class LedgerCache:
+    """LRU of LedgerState bounded by their approximate size."""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[int, LedgerState]" = OrderedDict()
+        self.bytes = 0
+
+    def peek(self, lid: int) -> Optional[LedgerState]:
+        return self.entries.get(lid)
+
+    def get(self, lid: int) -> LedgerState:
+        st = self.entries.get(lid)
+        if st is not None and st.month_start == month_bounds_now(st.tz)[0]:
+            self.entries.move_to_end(lid)
+            metric_inc("ledger_cache_hits_total")
+            return st
+        metric_inc("ledger_cache_misses_total")
+        self.invalidate(lid)
+        st = LedgerState(lid)
+        st.load(STORE)
+        self.entries[lid] = st
+        self.resize(st)
+        return st
+
+    def resize(self, st: LedgerState):
+        if self.entries.get(st.lid) is not st:
+            return
+        size = st.approx_size()
+        self.bytes += size - st.size
+        st.size = size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.size
+            metric_inc("ledger_cache_evictions_total")
+        metric_set("ledger_cache_entries", len(self.entries))
+        metric_set("ledger_cache_bytes", self.bytes)
+
+    def invalidate(self, lid: int):
+        st = self.entries.pop(lid, None)
+        if st:
+            self.bytes -= st.size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def drop_tips(self):
+        """After the insights job: tips reload lazily in get_insight_tip."""
+        for st in self.entries.values():
+            st.tip = None
+
+LEDGERS = LedgerCache(LEDGER_CACHE_MAX_KB * 1024)
+
+@traced("db.ledger_state")
+def ledger_state(lid: int) -> LedgerState:
+    return LEDGERS.get(lid)
+
+# ---------------- Archive (cold partitions) ----------------
+# Rows older than ARCHIVE_AFTER_DAYS move, one local month per transaction, into
+# ARCHIVE_DIR/tx_<year>.db (same tx schema and FTS index). Their per-month sums stay in
+# tx_archived_totals so balances and counts never need to open the archives; history,
+# /find and exports read through to them only when the hot rows run out. WAL commits are
+# atomic per file only, so the copy tolerates rows left in an archive by an interrupted run.
+ARCHIVE_MIN_DAYS = 120  # reports, budgets and insights never look further back
+
+def archive_path(year: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"tx_{year}.db")
+
+def archive_paths() -> List[str]:
+    """Archive files, newest year first."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    names = [f for f in os.listdir(ARCHIVE_DIR) if re.fullmatch(r"tx_\d{4}\.db", f)]
+    return [os.path.join(ARCHIVE_DIR, f) for f in sorted(names, reverse=True)]
+
+def ensure_archive(year: int) -> str:
+    path = archive_path(year)
+    if not os.path.exists(path):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        con = sqlite3.connect(path); c = con.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS tx(
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            ledger_id INTEGER,
+            ttype TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL,
+            category TEXT NOT NULL,
+            note TEXT,
+            ts INTEGER NOT NULL
+        )""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tx_ledger_ts ON tx(ledger_id, ts)")
+        init_fts(c)
+        con.commit(); con.close()
+    return path
+
+def archive_old_txs() -> Tuple[int, set]:
+    """Move every row older than the horizon into its year's archive. Returns rows moved
+    and the ledgers they belonged to."""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0, set()
+    horizon = datetime.now(TIMEZONE) - timedelta(days=max(ARCHIVE_AFTER_DAYS, ARCHIVE_MIN_DAYS))
+    cutoff = int(datetime(horizon.year, horizon.month, 1, tzinfo=TIMEZONE).timestamp())
+    con = sqlite3.connect(DB_PATH, isolation_level=None); c = con.cursor()
+    moved, lids = 0, set()
+    while True:
+        oldest = c.execute("SELECT MIN(ts) FROM tx WHERE ts<?", (cutoff,)).fetchone()[0]
+        if oldest is None:
+            break
+        d = datetime.fromtimestamp(oldest, tz=TIMEZONE)
+        lo = int(datetime(d.year, d.month, 1, tzinfo=TIMEZONE).timestamp())
+        nxt = datetime(d.year + d.month // 12, d.month % 12 + 1, 1, tzinfo=TIMEZONE)
+        hi = min(int(nxt.timestamp()), cutoff)
+        lids.update(r[0] for r in c.execute("SELECT DISTINCT ledger_id FROM tx WHERE ts>=? AND ts<?", (lo, hi)))
+        c.execute("ATTACH DATABASE ? AS arc", (ensure_archive(d.year),))
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""INSERT INTO tx_archived_totals(ledger_id, user_id, period, ttype, category, currency, amount, n)
+                         SELECT ledger_id, user_id, ?, ttype, category, currency, SUM(amount), COUNT(*)
+                         FROM main.tx WHERE ts>=? AND ts<? GROUP BY ledger_id, user_id, ttype, category, currency
+                         ON CONFLICT DO UPDATE SET amount=amount+excluded.amount, n=n+excluded.n""",
+                      (d.strftime("%Y-%m"), lo, hi))
+            c.execute("""INSERT OR IGNORE INTO arc.tx(id, user_id, ledger_id, ttype, amount, currency, category, note, ts)
+                         SELECT id, user_id, ledger_id, ttype, amount, currency, category, note, ts
+                         FROM main.tx WHERE ts>=? AND ts<?""", (lo, hi))
+            c.execute("DELETE FROM main.tx WHERE ts>=? AND ts<?", (lo, hi))
+            moved += c.rowcount
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            c.execute("DETACH DATABASE arc")
+    con.close()
+    return moved, lids
+
+@traced("db.archive_last_txs")
+def archive_last_txs(lid: int, limit: int, skip: int) -> List[tuple]:
+    """Continue a newest-first listing past the hot rows: `skip` archived rows, then `limit`."""
+    rows: List[tuple] = []
+    for path in archive_paths():
+        con = sqlite3.connect(path); c = con.cursor()
+        n = c.execute("SELECT COUNT(*) FROM tx WHERE ledger_id=?", (lid,)).fetchone()[0]
+        if skip < n:
+            c.execute("""SELECT id, ttype, amount, currency, category, note, ts FROM tx WHERE ledger_id=?
+                         ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?""", (lid, limit - len(rows), skip))
+            rows += c.fetchall()
+        skip = max(0, skip - n)
+        con.close()
+        if len(rows) >= limit:
+            break
     return rows
 
-def month_expenses_in_category(uid: int, category: str, currency: str) -> float:
-    start, end = month_bounds_now()
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT COALESCE(SUM(amount),0) FROM tx
-                 WHERE user_id=? AND ttype='expense' AND category=? AND currency=? AND ts BETWEEN ? AND ?""",
-              (uid, category, currency, start, end))
-    s = c.fetchone()[0] or 0.0
+@traced("db.tx_rows_between")
+def tx_rows_between(lid: int, start: int, end: int) -> List[tuple]:
+    """(id, ts, ttype, amount, currency, category, note) in [start, end], oldest first, archives included."""
+    rows: List[tuple] = []
+    sql = """SELECT id, ts, ttype, amount, currency, category, note
+             FROM tx WHERE ledger_id=? AND ts BETWEEN ? AND ? ORDER BY ts ASC"""
+    y0, y1 = datetime.fromtimestamp(start, tz=TIMEZONE).year, datetime.fromtimestamp(end, tz=TIMEZONE).year
+    for path in reversed(archive_paths()):
+        if y0 <= int(os.path.basename(path)[3:7]) <= y1:
+            con = sqlite3.connect(path)
+            rows += con.execute(sql, (lid, start, end)).fetchall()
+            con.close()
+    con = sqlite3.connect(DB_PATH)
+    rows += con.execute(sql, (lid, start, end)).fetchall()
     con.close()
-    return float(s)
+    return rows
 
-# Settings & pins
-def get_chat_settings(chat_id: int) -> Dict[str, Any]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("SELECT autopin, autoclean, group_silent, lang FROM settings WHERE chat_id=?", (chat_id,))
-    row = c.fetchone(); con.close()
-    if not row:
-        return {"autopin": 1, "autoclean": 1, "group_silent": 1, "lang": "ru"}
-    return {"autopin": int(row[0]), "autoclean": int(row[1]), "group_silent": int(row[2]), "lang": row[3]}
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        n, lids = await asyncio.to_thread(archive_old_txs)
+        for lid in lids:  # counts and history pages change; totals are kept per month
+            LEDGERS.invalidate(lid)
+        if n: log.info(f"Archived {n} transactions")
+    except Exception as e:
+        log.warning(f"Archive job failed: {e}")
 
-def set_chat_setting(chat_id: int, key: str, value: Any):
-    now = ts_now()
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""INSERT INTO settings(chat_id, autopin, autoclean, group_silent, lang, updated_ts)
-                 VALUES(?,1,1,1,'ru',?) ON CONFLICT(chat_id) DO NOTHING""", (chat_id, now))
-    c.execute(f"UPDATE settings SET {key}=?, updated_ts=? WHERE chat_id=?", (value, now, chat_id))
-    con.commit(); con.close()
+# ---------------- Ledgers ----------------
+_group_ledgers: Dict[int, bool] = {}
+_known_members: Dict[Tuple[int, int], str] = {}  # (lid, uid) -> name stored in ledger_members
 
-def get_pinned_msg_id(chat_id: int) -> Optional[int]:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("SELECT message_id FROM pins WHERE chat_id=?", (chat_id,))
-    row = c.fetchone(); con.close()
-    return int(row[0]) if row else None
+@traced("db.group_ledger_enabled")
+def group_ledger_enabled(chat_id: int) -> bool:
+    if chat_id not in _group_ledgers:
+        _group_ledgers[chat_id] = STORE.group_ledger_enabled(chat_id)
+    return _group_ledgers[chat_id]
 
-def set_pinned_msg_id(chat_id: int, message_id: int):
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""INSERT INTO pins(chat_id, message_id) VALUES(?,?)
-                 ON CONFLICT(chat_id) DO UPDATE SET message_id=excluded.message_id""", (chat_id, message_id))
+def ledger_set_group(chat_id: int, enabled: bool, title: str = ""):
+    STORE.set_group_ledger(chat_id, enabled, title, ts_now())
+    _group_ledgers[chat_id] = enabled
+
+@traced("db.ledger_ensure_member")
+def ledger_ensure_member(lid: int, uid: int, name: str = ""):
+    if _known_members.get((lid, uid)) == name:
+        return
+    STORE.ensure_member(lid, uid, name, ts_now())
+    _known_members[(lid, uid)] = name
+
+def ledger_member_names(lid: int) -> Dict[int, str]:
+    return STORE.member_names(lid)
+
+def current_ledger(update: Update) -> int:
+    """Shared chat ledger in groups that enabled /ledger, otherwise the user's personal ledger."""
+    user, chat = update.effective_user, update.effective_chat
+    lid = user.id
+    if chat and chat.type in {"group", "supergroup"} and group_ledger_enabled(chat.id):
+        lid = chat.id
+    ledger_ensure_member(lid, user.id, user.first_name or "")
+    return lid
+
+# ---------------- Shards ----------------
+# Under shards.py every worker owns DB_PATH = DB_BASE_PATH with ".shard<i>". The few
+# cross-user features (admin stats, backups, /export_user, FX rates) open the other
+# shards' files directly: one box, SQLite allows concurrent readers, and these are rare.
+def shard_dbs() -> List[str]:
+    """Every shard's DB file that exists; just DB_PATH when not sharded."""
+    if SHARD_INDEX < 0:
+        return [DB_PATH]
+    return [p for p in (shard_db_path(DB_BASE_PATH, i) for i in range(SHARDS)) if os.path.exists(p)]
+
+# ---------------- FX rates ----------------
+# Rates are stored per local day as "units of BASE_CURRENCY per 1 unit of currency".
+# Lookups are as-of: the latest rate on or before the requested day.
+class FxCache:
+    def __init__(self):
+        self.days: Dict[str, List[int]] = {}
+        self.rates: Dict[str, List[float]] = {}
+        self.loaded = False
+
+    def load(self):
+        days: Dict[str, List[int]] = {}; rates: Dict[str, List[float]] = {}
+        for cur, day, rate in STORE.fx_rates():
+            days.setdefault(cur, []).append(int(day)); rates.setdefault(cur, []).append(float(rate))
+        self.days, self.rates, self.loaded = days, rates, True
+
+    def rate(self, currency: str, day: Optional[int] = None) -> Optional[float]:
+        if currency == BASE_CURRENCY:
+            return 1.0
+        if not self.loaded:
+            self.load()
+        days = self.days.get(currency)
+        if not days:
+            return None
+        if day is None:
+            return self.rates[currency][-1]
+        i = bisect_right(days, day)
+        # before the first known rate fall back to the earliest one
+        return self.rates[currency][max(0, i - 1)]
+
+    def convert_buckets(self, rows: Iterable[tuple]) -> Tuple[float, set]:
+        """Sum (day, currency, amount) buckets in BASE_CURRENCY; one lookup per distinct (currency, day)."""
+        total, missing, memo = 0.0, set(), {}
+        for day, cur, amount in rows:
+            key = (cur, day)
+            if key not in memo:
+                memo[key] = self.rate(cur, day)
+            r = memo[key]
+            if r is None:
+                missing.add(cur); continue
+            total += (amount or 0.0) * r
+        return total, missing
+
+FX = FxCache()
+
+def fx_upsert(path: str, rows: List[Tuple[int, str, float]]):
+    con = sqlite3.connect(path); c = con.cursor()
+    c.executemany("""INSERT INTO fx_rates(day, currency, rate) VALUES(?,?,?)
+                     ON CONFLICT(currency, day) DO UPDATE SET rate=excluded.rate""", rows)
     con.commit(); con.close()
 
+def fx_write(rows: List[Tuple[int, str, float]], dbs: Optional[List[str]] = None):
+    """Upsert (day, currency, rate) rows into dbs (this shard by default). This shard's
+    copy goes through STORE; other shards pick theirs up in fx_reload_job."""
+    own = os.path.abspath(DB_PATH)
+    for path in dbs or [DB_PATH]:
+        if os.path.abspath(path) == own:
+            STORE.put_fx_rates(rows)
+        else:
+            fx_upsert(path, rows)
+    FX.load()
+
+def fx_set_rate(currency: str, rate: float, day: Optional[int] = None):
+    fx_write([(local_day(ts_now()) if day is None else day, currency, rate)], shard_dbs())
+
+async def fx_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(FX.load)
+
+def load_fx_file(path: str = FX_RATES_PATH, dbs: Optional[List[str]] = None) -> int:
+    """CSV lines `date,currency,rate` (date as YYYY-MM-DD or DD.MM.YYYY). Returns rows loaded."""
+    if not os.path.exists(path):
+        return 0
+    import csv
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for rec in csv.reader(f):
+            if len(rec) < 3 or not rec[2].strip().replace(".", "", 1).isdigit():
+                continue
+            d = rec[0].strip()
+            try:
+                dt = datetime.strptime(d, "%Y-%m-%d") if "-" in d else datetime.strptime(d, "%d.%m.%Y")
+            except ValueError:
+                continue
+            day = local_day(int(dt.replace(tzinfo=TIMEZONE).timestamp()))
+            rows.append((day, rec[1].strip().lower(), float(rec[2])))
+    fx_write(rows, dbs)
+    return len(rows)
+
+def to_base(amount: float, currency: str, day: Optional[int] = None) -> Optional[float]:
+    r = FX.rate(currency, day)
+    return None if r is None else amount * r
+
+def fmt_base_line(label: str, total: float, missing: set) -> str:
+    line = f"{label} ({BASE_CURRENCY.upper()}): {fmt_amount(total, BASE_CURRENCY)}"
+    if missing:
+        line += f" (нет курса: {', '.join(sorted(c.upper() for c in missing))})"
+    return line
+
+def base_hint(amount: float, currency: str) -> str:
+    if currency == BASE_CURRENCY:
+        return ""
+    b = to_base(amount, currency)
+    return f" (≈ {fmt_amount(b, BASE_CURRENCY)})" if b is not None else ""
+
+async def fx_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/fx lists rates; setting or loading them changes every ledger's conversions, so only
+    admins may."""
+    uid = update.effective_user.id
+    if ALLOWED_USER_IDS and uid not in ALLOWED_USER_IDS:
+        await update.message.reply_text("Доступ запрещён.")
+        return
+    args = context.args or []
+    if args and (args[0].lower() == "load" or len(args) >= 2) and not is_admin(uid):
+        await update.message.reply_text("Менять курсы может только администратор. /fx — посмотреть курсы.")
+        return
+    if args and args[0].lower() == "load":
+        n = await asyncio.to_thread(load_fx_file, dbs=shard_dbs())
+        await update.message.reply_text(f"Загружено курсов: {n} ({FX_RATES_PATH}).")
+        return
+    if len(args) >= 2:
+        rate = parse_amount(args[1])
+        if not rate:
+            await update.message.reply_text("Формат: /fx usd 12650")
+            return
+        currency = detect_currency(args[0])
+        await asyncio.to_thread(fx_set_rate, currency, rate)  # one file per shard
+        await update.message.reply_text(f"✅ Курс сохранён: 1 {currency.upper()} = {fmt_amount(rate, BASE_CURRENCY)}")
+        return
+    if not FX.loaded:
+        await asyncio.to_thread(FX.load)
+    if not FX.rates:
+        await update.message.reply_text(f"Курсов нет. /fx usd 12650 или /fx load ({FX_RATES_PATH}).")
+        return
+    lines = [f"Курсы к {BASE_CURRENCY.upper()}:"]
+    for cur in sorted(FX.rates):
+        when = (datetime(1970, 1, 1) + timedelta(days=FX.days[cur][-1])).strftime("%d.%m.%Y")
+        lines.append(f"• 1 {cur.upper()} = {fmt_amount(FX.rates[cur][-1], BASE_CURRENCY)} ({when})")
+    await update.message.reply_text("\n".join(lines))
+
 # ---------------- Reports/AI helpers ----------------
-def sum_range(uid: int, start_ts: int, end_ts: int) -> float:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT COALESCE(SUM(CASE WHEN ttype='expense' THEN amount ELSE 0 END),0)
-                 FROM tx WHERE user_id=? AND ts BETWEEN ? AND ?""",
-              (uid, start_ts, end_ts))
-    s = c.fetchone()[0] or 0.0
-    con.close()
-    return float(s)
+def spent_days(lid: int, first: int, last: int) -> float:
+    """All expenses over local days first..last, from the cached daily spend index."""
+    return ledger_state(lid).spend_index().total_all(first, last)
 
-def month_expenses_by_category(uid: int) -> List[tuple]:
-    start, end = month_bounds_now()
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT category, currency, COALESCE(SUM(amount),0) as s
-                 FROM tx
-                 WHERE user_id=? AND ttype='expense' AND ts BETWEEN ? AND ?
-                 GROUP BY category, currency
-                 ORDER BY s DESC""", (uid, start, end))
-    rows = c.fetchall(); con.close()
-    return rows
+@traced("db.month_expenses_by_category")
+def month_expenses_by_category(lid: int) -> List[tuple]:
+    cats = ledger_state(lid).month_cats
+    return sorted(((cat, cur, s) for (cat, cur), s in cats.items()), key=lambda r: -r[2])
 
-def generate_ai_tip(uid: int) -> str:
+def generate_ai_tip(lid: int) -> str:
     tip_parts = []
-    rows = month_expenses_by_category(uid)
+    rows = month_expenses_by_category(lid)
     if rows:
-        rows_sorted = sorted(rows, key=lambda r: (r[1] != "uzs", -r[2]))
+        # rank in BASE_CURRENCY; currencies without a rate go last
+        rows_sorted = sorted(rows, key=lambda r: (to_base(r[2], r[1]) is None, -(to_base(r[2], r[1]) or 0.0), -r[2]))
         top_cat, top_cur, top_sum = rows_sorted[0]
         tip_parts.append(f"Топ расход: «{top_cat}» — {fmt_amount(top_sum, top_cur)} в этом месяце.")
-    w_start, now_ts = week_bounds_now()
-    last_week_end = w_start - 1
-    prev_week_start = last_week_end - 6*24*3600
-    cur = sum_range(uid, w_start, now_ts)
-    prev = sum_range(uid, prev_week_start, last_week_end)
+    tz = ledger_tz(lid)
+    w_first = local_day(week_bounds_now(tz)[0], tz)
+    cur = spent_days(lid, w_first, local_day(ts_now(), tz))
+    prev = spent_days(lid, w_first - 7, w_first - 1)
     if prev > 0:
         diff = (cur - prev) / prev * 100.0
         if abs(diff) >= 20:
             tip_parts.append(("Расходы за неделю " + ("выросли" if diff > 0 else "снизились") + f" на {abs(diff):.0f}%."))
 
-    buds = budget_list(uid)
+    buds = budget_list(lid)
     if buds:
         best = None
+        today = local_day(ts_now(), tz)
         for _, cat, curcy, limit_amt, period, active in buds:
-            if active != 1 or period != "month": continue
-            spent = month_expenses_in_category(uid, cat, curcy)
+            first, last = budget_window(period, tz)
+            if active != 1 or not first <= today <= last: continue
+            spent = budget_spent(lid, cat, curcy, period)
             if limit_amt > 0:
                 util = spent / limit_amt
                 left = max(0.0, limit_amt - spent)
                 if not best or util > best[0]:
-                    best = (util, cat, curcy, left, limit_amt)
+                    best = (util, cat, curcy, left, period)
         if best:
-            util, cat, curcy, left, lim = best
-            tip_parts.append(f"По бюджету «{cat}»: осталось {fmt_amount(left, curcy)} ({min(100,int((1-util)*100))}% до лимита).")
+            util, cat, curcy, left, period = best
+            tip_parts.append(f"По бюджету «{cat}» ({budget_period_label(period)}): осталось {fmt_amount(left, curcy)}{base_hint(left, curcy)} ({min(100,int((1-util)*100))}% до лимита).")
 
     return " ".join(tip_parts) if tip_parts else "Нет заметных изменений расходов."
 
-def report_text_for_period(uid: int, start: int, end: int, title: str) -> str:
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT currency,
-                        SUM(CASE WHEN ttype='income' THEN amount ELSE 0 END) as inc,
-                        SUM(CASE WHEN ttype='expense' THEN amount ELSE 0 END) as exp
-                 FROM tx WHERE user_id=? AND ts BETWEEN ? AND ?
-                 GROUP BY currency""", (uid, start, end))
-    rows = c.fetchall()
+@traced("db.report_buckets")
+def report_buckets(lid: int, start: int, end: int) -> List[tuple]:
+    """(day, ttype, category, currency, sum) rows; each (day, currency) converts at that day's rate."""
+    return STORE.report_buckets(lid, start, end, tz_spans(ledger_tz(lid), start, end))
+
+def report_text_for_period(lid: int, start: int, end: int, title: str) -> str:
+    return format_report(title, report_buckets(lid, start, end))
+
+def format_report(title: str, buckets: List[tuple]) -> str:
+    """Report text from report_buckets rows; the per-currency totals are their sums."""
     lines = [f"📊 Отчёт: {title}"]
-    if not rows:
-        con.close(); return lines[0] + "\nНет операций."
+    if not buckets:
+        return lines[0] + "\nНет операций."
+    totals: Dict[str, List[float]] = {}
+    for _, t, _, cur, s in buckets:
+        acc = totals.setdefault(cur, [0.0, 0.0])
+        acc[0 if t == "income" else 1] += s or 0.0
+    rows = sorted((cur, inc, exp) for cur, (inc, exp) in totals.items())
     for cur, inc, exp in rows:
-        inc = inc or 0.0; exp = exp or 0.0
         lines.append(f"• Доходы: {fmt_amount(inc, cur)}")
         lines.append(f"• Расходы: {fmt_amount(exp, cur)}")
         lines.append(f"• Итог: {fmt_amount(inc - exp, cur)}")
         lines.append("")
-    c.execute("""SELECT category, currency, SUM(amount) as s
-                 FROM tx WHERE user_id=? AND ttype='expense' AND ts BETWEEN ? AND ?
-                 GROUP BY category, currency
-                 ORDER BY s DESC LIMIT 10""", (uid, start, end))
-    cats = c.fetchall(); con.close()
+    inc_b, inc_missing = FX.convert_buckets((d, cur, s) for d, t, cat, cur, s in buckets if t == "income")
+    exp_b, missing = FX.convert_buckets((d, cur, s) for d, t, cat, cur, s in buckets if t == "expense")
+    if len(rows) > 1 or rows[0][0] != BASE_CURRENCY:
+        lines.append(fmt_base_line("Итог", inc_b - exp_b, missing | inc_missing))
+        lines.append("")
+    cats: Dict[Tuple[str, str], List[float]] = {}
+    for d, t, cat, cur, s in buckets:
+        if t != "expense": continue
+        acc = cats.setdefault((cat, cur), [0.0, 0.0])
+        acc[0] += s or 0.0
+        b = to_base(s or 0.0, cur, d)
+        acc[1] += b if b is not None else 0.0
     if cats:
         lines.append("Топ расходов по категориям:")
-        for cat, cur, s in cats:
-            lines.append(f"- {cat}: {fmt_amount(s, cur)}")
+        top = sorted(cats.items(), key=lambda kv: (-kv[1][1], -kv[1][0]))[:10]
+        for (cat, cur), (orig, base) in top:
+            line = f"- {cat}: {fmt_amount(orig, cur)}"
+            if cur != BASE_CURRENCY and base:
+                line += f" (≈ {fmt_amount(base, BASE_CURRENCY)})"
+            lines.append(line)
     return "\n".join(lines)
 
-async def export_month_csv(uid: int, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    start, end = month_bounds_now()
+# ---------------- Report charts ----------------
+# Charts are keyed by a hash of the aggregates they plot: the same numbers give the
+# same key, so repeat taps reuse the Telegram file_id (or the bytes on disk).
+CHART_VERSION = "1"
+CHART_CACHE_MAX_FILES = 500
+CHART_TOP_CATS = 8
+_chart_pool = None
+
+def chart_pool():
+    global _chart_pool
+    if _chart_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _chart_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _chart_pool
+
+def report_chart_payload(lid: int, start: int, end: int, title: str) -> Dict[str, Any]:
+    cats: Dict[str, float] = {}
+    per_day: Dict[int, float] = {}
+    for d, t, cat, cur, s in report_buckets(lid, start, end):
+        if t != "expense": continue
+        b = to_base(s or 0.0, cur, d)
+        if b is None: continue
+        cats[cat] = cats.get(cat, 0.0) + b
+        per_day[d] = per_day.get(d, 0.0) + b
+    tz = ledger_tz(lid)
+    first, last = local_day(start, tz), local_day(end, tz)
+    days = [[(datetime(1970, 1, 1) + timedelta(days=d)).strftime("%d.%m"), round(per_day.get(d, 0.0), 2)]
+            for d in range(first, last + 1)]
+    top = sorted(cats.items(), key=lambda kv: -kv[1])[:CHART_TOP_CATS]
+    return {"title": f"Отчёт: {title}", "currency": BASE_CURRENCY,
+            "cats": [[c, round(v, 2)] for c, v in top], "days": days}
+
+def chart_key(payload: Dict[str, Any]) -> str:
+    import hashlib, json
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False) + CHART_VERSION
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+@traced("db.chart_file_get")
+def chart_file_get(key: str) -> Optional[Tuple[str, str]]:
+    row = STORE.chart_file(key)
+    return (row[0], row[1]) if row else None
+
+@traced("db.chart_file_set")
+def chart_file_set(key: str, kind: str, file_id: str):
+    STORE.set_chart_file(key, kind, file_id, ts_now())
+
+def chart_disk_get(key: str) -> Optional[Tuple[bytes, str]]:
+    for kind in ("png", "pdf"):
+        path = os.path.join(CHART_CACHE_DIR, f"{key}.{kind}")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read(), kind
+    return None
+
+def chart_disk_put(key: str, data: bytes, kind: str):
+    os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+    path = os.path.join(CHART_CACHE_DIR, f"{key}.{kind}")
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    files = sorted((os.path.join(CHART_CACHE_DIR, n) for n in os.listdir(CHART_CACHE_DIR)), key=os.path.getmtime)
+    for old in files[:-CHART_CACHE_MAX_FILES]:
+        try: os.remove(old)
+        except OSError: pass
+
+async def send_report_chart(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lid: int, start: int, end: int, title: str):
+    payload = report_chart_payload(lid, start, end, title)
+    if not payload["cats"]:
+        await context.bot.send_message(chat_id=chat_id, text=f"📊 Отчёт: {title}\nНет расходов для графика.")
+        return
+    key = chart_key(payload)
+    caption = f"📊 Отчёт: {title}"
+    cached = chart_file_get(key)
+    if cached:
+        kind, file_id = cached
+        try:
+            if kind == "png":
+                await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+            else:
+                await context.bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+            return
+        except Exception as e:
+            log.debug(f"cached chart file_id rejected: {e}")
+    hit = chart_disk_get(key)
+    if hit:
+        data, kind = hit
+    else:
+        import charts
+        loop = asyncio.get_running_loop()
+        data, kind = await loop.run_in_executor(chart_pool(), charts.render_report_chart, payload)
+        chart_disk_put(key, data, kind)
+    if kind == "png":
+        msg = await context.bot.send_photo(chat_id=chat_id, photo=data, caption=caption)
+        file_id = msg.photo[-1].file_id if msg.photo else None
+    else:
+        msg = await context.bot.send_document(chat_id=chat_id, document=io.BytesIO(data), filename=f"report_{key[:8]}.pdf", caption=caption)
+        file_id = msg.document.file_id if msg.document else None
+    if file_id:
+        chart_file_set(key, kind, file_id)
+
+# ---------------- Insights (nightly batch) ----------------
+INSIGHTS_WINDOW_DAYS = 56
+INSIGHTS_MAX_AGE = 36 * 3600
+ANOMALY_Z = 2.5
+
+_insight_days: Dict[str, int] = {}  # zone -> local day its ledgers' tips were last computed for
+
+def compute_insights() -> int:
+    """Recompute tips from complete days up to yesterday, per ledger zone (/tz). The job runs
+    hourly; a zone is done once its local day has changed, so every ledger's days, week and
+    month are its own. Returns ledgers processed."""
+    con = sqlite3.connect(DB_PATH); c = con.cursor()
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS insight_zones(lid INTEGER PRIMARY KEY, zone TEXT)")
+    c.execute("DELETE FROM insight_zones")
+    c.execute("INSERT INTO insight_zones(lid, zone) SELECT chat_id, tz FROM settings WHERE tz NOT IN ('', ?)",
+              (TIMEZONE.key,))
+    zones = [None] + [r[0] for r in c.execute("SELECT DISTINCT zone FROM insight_zones")]
+    n = 0
+    for name in zones:
+        tz = ZoneInfo(name) if name else TIMEZONE
+        today = local_day(ts_now(), tz)
+        if _insight_days.get(tz.key) == today:
+            continue
+        if name is None:
+            scope, scope_params = "ledger_id NOT IN (SELECT lid FROM insight_zones)", ()
+        else:
+            scope, scope_params = "ledger_id IN (SELECT lid FROM insight_zones WHERE zone=?)", (name,)
+        rows = zone_insights(c, tz, today, scope, scope_params)
+        c.executemany("""INSERT INTO insights(ledger_id, computed_ts, forecast, anomaly_z, tip) VALUES(?,?,?,?,?)
+                         ON CONFLICT(ledger_id) DO UPDATE SET computed_ts=excluded.computed_ts, forecast=excluded.forecast,
+                         anomaly_z=excluded.anomaly_z, tip=excluded.tip""", rows)
+        con.commit()
+        _insight_days[tz.key] = today
+        n += len(rows)
+    con.close()
+    return n
+
+def zone_insights(c: sqlite3.Cursor, tz: ZoneInfo, today: int, scope: str, scope_params: tuple) -> List[tuple]:
+    """Insight rows for the ledgers matching `scope` (SQL on ledger_id), all in zone tz."""
+    import calendar
+    import numpy as np
+    import insights as ins
+    now = datetime.now(tz)
+    first_day = today - INSIGHTS_WINDOW_DAYS
+    start_ts, end_ts = day_start(first_day, tz), day_start(today, tz) - 1
+    off, off_params = offset_sql(tz_spans(tz, start_ts, end_ts))
+    month_start = int(datetime(now.year, now.month, 1, tzinfo=tz).timestamp())
+    days_in_month = calendar.monthrange(now.year, now.month)[1]
+    days_elapsed = now.day - 1
+
+    c.execute(f"""SELECT ledger_id, (ts + {off}) / 86400 AS day, currency, SUM(amount)
+                  FROM tx WHERE ttype='expense' AND ts BETWEEN ? AND ? AND {scope}
+                  GROUP BY ledger_id, day, currency""", (*off_params, start_ts, end_ts, *scope_params))
+    series = c.fetchall()
+    if not series:
+        return []
+    c.execute(f"""SELECT ledger_id, category, currency, SUM(amount)
+                  FROM tx WHERE ttype='expense' AND ts BETWEEN ? AND ? AND {scope}
+                  GROUP BY ledger_id, category, currency""", (month_start, end_ts, *scope_params))
+    month_cats = c.fetchall()
+    # every active budget still running: its window's complete days so far, and its full length
+    budgets = []
+    c.execute(f"SELECT ledger_id, category, currency, limit_amount, period FROM budgets WHERE active=1 AND limit_amount>0 AND {scope}",
+              scope_params)
+    for u, cat, cur, lim, period in c.fetchall():
+        first, last = budget_window(period, tz)
+        if period == "week":
+            last = first + 6
+        elif not period.startswith(("rolling:", "custom:")):
+            last = first + days_in_month - 1
+        if first < today <= last:
+            budgets.append((u, cat, cur, lim, period, first, last))
+    by_day: Dict[Tuple[int, str, str], List[Tuple[int, float]]] = {}
+    if budgets:
+        since = day_start(min(b[5] for b in budgets), tz)
+        b_off, b_off_params = offset_sql(tz_spans(tz, since, end_ts))
+        c.execute(f"""SELECT ledger_id, category, currency, (ts + {b_off}) / 86400 AS day, SUM(amount) FROM tx
+                      WHERE ttype='expense' AND ts BETWEEN ? AND ? AND {scope} AND (ledger_id, category, currency) IN
+                        (SELECT ledger_id, category, currency FROM budgets WHERE active=1 AND limit_amount>0)
+                      GROUP BY ledger_id, category, currency, day""", (*b_off_params, since, end_ts, *scope_params))
+        for u, cat, cur, day, amount in c.fetchall():
+            by_day.setdefault((u, cat, cur), []).append((day, amount or 0.0))
+
+    lids = np.fromiter((r[0] for r in series), dtype=np.int64, count=len(series))
+    days = np.fromiter((r[1] for r in series), dtype=np.int64, count=len(series))
+    amounts = np.fromiter((r[3] or 0.0 for r in series), dtype=np.float64, count=len(series))
+    rates = np.fromiter((FX.rate(r[2], r[1]) or 0.0 for r in series), dtype=np.float64, count=len(series))
+    ledgers, ledger_idx = np.unique(lids, return_inverse=True)
+    daily = ins.daily_matrix(ledger_idx, days - first_day, amounts * rates, len(ledgers), INSIGHTS_WINDOW_DAYS)
+
+    forecast = ins.month_end_forecast(daily, days_elapsed, days_in_month)
+    wow = ins.week_change(daily)
+    z = ins.last_day_zscore(daily)
+
+    pos = {int(u): i for i, u in enumerate(ledgers)}
+    spent = {(u, cat, cur): s or 0.0 for u, cat, cur, s in month_cats}
+    top: Dict[int, Tuple[str, str, float, float]] = {}
+    for (u, cat, cur), s in spent.items():
+        b = to_base(s, cur)
+        key = b if b is not None else -1.0
+        if u not in top or key > top[u][3]:
+            top[u] = (cat, cur, s, key)
+    worst: Dict[int, Tuple[str, str, float, float, str]] = {}
+    if budgets:
+        so_far = np.array([sum(a for d, a in by_day.get((u, cat, cur), ()) if d >= first)
+                           for u, cat, cur, _, _, first, _ in budgets])
+        proj = ins.run_rate(so_far, np.array([today - b[5] for b in budgets]), np.array([b[6] - b[5] + 1 for b in budgets]))
+        for (u, cat, cur, lim, period, _, _), p in zip(budgets, proj):
+            if u not in worst or p / lim > worst[u][2] / worst[u][3]:
+                worst[u] = (cat, cur, float(p), lim, period)
+
+    out = []
+    for u, i in pos.items():
+        parts = []
+        if u in top:
+            cat, cur, s, _ = top[u]
+            parts.append(f"Топ расход: «{cat}» — {fmt_amount(s, cur)} в этом месяце.")
+        if not np.isnan(wow[i]) and abs(wow[i]) >= 0.2:
+            parts.append("Расходы за неделю " + ("выросли" if wow[i] > 0 else "снизились") + f" на {abs(wow[i])*100:.0f}%.")
+        if forecast[i] > 0:
+            parts.append(f"Прогноз расходов на месяц: ≈ {fmt_amount(forecast[i], BASE_CURRENCY)}.")
+        if u in worst:
+            cat, cur, p, lim, period = worst[u]
+            label = budget_period_label(period)
+            if p > lim:
+                parts.append(f"Бюджет «{cat}» ({label}) при текущем темпе будет превышен: ≈ {fmt_amount(p, cur)} из {fmt_amount(lim, cur)}.")
+            else:
+                parts.append(f"По бюджету «{cat}» ({label}) темп в норме: ≈ {fmt_amount(p, cur)} из {fmt_amount(lim, cur)}.")
+        if not np.isnan(z[i]) and z[i] >= ANOMALY_Z:
+            parts.append(f"Вчера расходы были необычно высокими: {fmt_amount(daily[i, -1], BASE_CURRENCY)}.")
+        tip = " ".join(parts) if parts else "Нет заметных изменений расходов."
+        out.append((u, ts_now(), float(forecast[i]), None if np.isnan(z[i]) else float(z[i]), tip))
+    return out
+
+@traced("db.get_insight_tip")
+def get_insight_tip(lid: int) -> Optional[str]:
+    st = ledger_state(lid)
+    row = st.tip
+    if row is None:
+        row = st.tip = STORE.insight_tip(lid) or ()
+    if not row or ts_now() - row[1] > INSIGHTS_MAX_AGE:
+        return None
+    return row[0]
+
+async def insights_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        n = await asyncio.to_thread(compute_insights)
+        if n:
+            LEDGERS.drop_tips()
+            log.info(f"Insights recomputed for {n} ledgers")
+    except Exception as e:
+        log.warning(f"Insights job failed: {e}")
+
+# ---------------- Digest (weekly/monthly broadcast) ----------------
+# digest_job runs hourly; a chat's digest is due from DIGEST_HOUR on Monday / the 1st in the
+# ledger's own time zone. Every due chat's report comes from one grouped query and the
+# texts are queued in digest_outbox (unique per chat and period, so a rerun queues nothing
+# twice).
+# OUTBOX drains the queue at DIGEST_RATE messages/s, leaving the rest of Telegram's
+# per-bot budget to interactive replies; pending rows survive restarts. Rows are marked
+# sent in small batches, so a crash can resend at most one batch.
+DIGEST_LABELS = {"off": "Выкл", "week": "Неделя", "month": "Месяц"}
+DIGEST_HOUR = 9
+OUTBOX_MARK_EVERY = 20
+
+def digest_due(kind: str, local: datetime) -> bool:
+    return local.hour >= DIGEST_HOUR and (local.weekday() == 0 if kind == "week" else local.day == 1)
+
+def digest_period(kind: str, now: Optional[datetime] = None, tz: Optional[ZoneInfo] = None) -> Tuple[int, int, str, str]:
+    """(start, end, title, period key) of the last complete week or month in tz."""
+    tz = tz or TIMEZONE
+    now = (now or datetime.now(tz)).astimezone(tz)
+    today = datetime(now.year, now.month, now.day, tzinfo=tz)
+    if kind == "week":
+        start = today - timedelta(days=today.weekday() + 7)
+        end = start + timedelta(days=7)
+        title = f"неделя {start.strftime('%d.%m')}–{(end - timedelta(days=1)).strftime('%d.%m')}"
+    else:
+        end = today.replace(day=1)
+        start = (end - timedelta(days=1)).replace(day=1)
+        title = f"месяц {start.strftime('%m.%Y')}"
+    return int(start.timestamp()), int(end.timestamp()) - 1, title, f"{kind}:{start.strftime('%Y-%m-%d')}"
+
+@traced("db.build_digests")
+def build_digests(kind: str, now: Optional[datetime] = None) -> int:
+    """Queue this period's digest for every chat subscribed to `kind` that is due at `now`
+    in its own time zone; returns rows queued. A private chat's ledger is the user's, a
+    group's is the chat's own when /ledger is on."""
+    now = now or datetime.now(timezone.utc)
+    con = sqlite3.connect(DB_PATH); c = con.cursor()
+    c.execute("""SELECT s.chat_id, s.tz FROM settings s WHERE s.digest=?
+                 AND (s.chat_id > 0 OR EXISTS(SELECT 1 FROM ledgers l WHERE l.id=s.chat_id AND l.kind='group'))""", (kind,))
+    by_tz: Dict[str, List[int]] = {}
+    for chat_id, name in c.fetchall():
+        by_tz.setdefault(name, []).append(chat_id)
+    periods: Dict[int, Tuple[List[Tuple[int, int, int]], str, str]] = {}  # lid -> (tz_spans, title, key)
+    for name, lids in by_tz.items():
+        tz = ZoneInfo(name) if name else TIMEZONE
+        if not digest_due(kind, now.astimezone(tz)):
+            continue
+        start, end, title, key = digest_period(kind, now, tz)
+        spans = tz_spans(tz, start, end)
+        c.execute("SELECT chat_id FROM digest_outbox WHERE period_key=?", (key,))
+        done = {r[0] for r in c.fetchall()}
+        for lid in lids:
+            if lid not in done:
+                periods[lid] = (spans, title, key)
+    if not periods:
+        con.close(); return 0
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS digest_spans(lid INTEGER, lo INTEGER, hi INTEGER, off INTEGER)")
+    c.execute("DELETE FROM digest_spans")
+    c.executemany("INSERT INTO digest_spans(lid, lo, hi, off) VALUES(?,?,?,?)",
+                  [(lid, *span) for lid, p in periods.items() for span in p[0]])
+    c.execute("""SELECT t.ledger_id, (t.ts + d.off) / 86400 AS day, t.ttype, t.category, t.currency, SUM(t.amount)
+                 FROM digest_spans d JOIN tx t ON t.ledger_id = d.lid AND t.ts BETWEEN d.lo AND d.hi
+                 GROUP BY t.ledger_id, day, t.ttype, t.category, t.currency""")
+    buckets: Dict[int, List[tuple]] = {}
+    for lid, *row in c.fetchall():
+        buckets.setdefault(lid, []).append(tuple(row))
+    head = "🗓 Еженедельный дайджест" if kind == "week" else "🗓 Ежемесячный дайджест"
+    now_ts = ts_now()
+    rows = [(lid, key, f"{head}\n\n{format_report(title, buckets[lid])}", now_ts, now_ts)
+            for lid, (_, title, key) in periods.items() if lid in buckets]  # nothing to report -> nothing sent
+    c.executemany("""INSERT OR IGNORE INTO digest_outbox(chat_id, period_key, text, next_ts, created_ts)
+                     VALUES(?,?,?,?,?)""", rows)
+    c.execute("DELETE FROM digest_outbox WHERE status != 'pending' AND created_ts < ?", (now_ts - 60 * 86400,))
+    con.commit(); con.close()
+    return len(rows)
+
+def outbox_pending(limit: int) -> List[tuple]:
     con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, ts, ttype, amount, currency, category, note
-                 FROM tx WHERE user_id=? AND ts BETWEEN ? AND ?
-                 ORDER BY ts ASC""", (uid, start, end))
+    c.execute("""SELECT id, chat_id, text, attempts FROM digest_outbox
+                 WHERE status='pending' AND next_ts <= ? ORDER BY next_ts, id LIMIT ?""", (ts_now(), limit))
     rows = c.fetchall(); con.close()
+    return rows
+
+class Outbox:
+    """Paced sender for digest_outbox; one task per process, started and stopped by run_bot."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / max(rate, 0.1)
+        self.wake: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, bot):
+        self.wake = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run(bot))
+
+    def kick(self):
+        if self.wake: self.wake.set()
+
+    async def run(self, bot):
+        """Runs until cancelled: a failed batch (DB error, unexpected send error) is logged
+        and retried after a growing pause instead of ending the task."""
+        backoff = 1.0
+        while True:
+            try:
+                await self.drain(bot)
+                backoff = 1.0
+            except Exception as e:
+                metric_inc("digest_outbox_errors_total")
+                log.warning(f"Digest outbox failed, retrying in {backoff:.0f}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300.0)
+
+    async def drain(self, bot):
+        """Sends one batch of due rows, or waits for a kick (at most 5 minutes) if none."""
+        loop = asyncio.get_running_loop()
+        rows = await asyncio.to_thread(outbox_pending, 200)
+        if not rows:
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=300)
+            except asyncio.TimeoutError:
+                pass
+            return
+        done: List[tuple] = []
+        try:
+            for oid, chat_id, text, attempts in rows:
+                t0 = loop.time()
+                done.append(await self.deliver(bot, oid, chat_id, text, attempts))
+                if len(done) >= OUTBOX_MARK_EVERY:
+                    await self.mark(done); done = []
+                await asyncio.sleep(max(0.0, self.interval - (loop.time() - t0)))
+        finally:
+            if done:
+                await self.mark(done)
+
+    async def deliver(self, bot, oid: int, chat_id: int, text: str, attempts: int) -> tuple:
+        """(status, attempts, next_ts, sent_ts, id) for the outbox row."""
+        from telegram.error import Forbidden, RetryAfter, TelegramError
+        while True:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                metric_inc("digest_sent_total")
+                return ("sent", attempts + 1, ts_now(), ts_now(), oid)
+            except RetryAfter as e:
+                metric_inc("digest_retry_after_total")
+                await asyncio.sleep(float(getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()))
+            except Forbidden:  # blocked or removed: stop sending to this chat
+                metric_inc("digest_failed_total")
+                await set_chat_setting(chat_id, "digest", "off")
+                return ("failed", attempts + 1, ts_now(), None, oid)
+            except TelegramError as e:
+                log.warning(f"Digest to {chat_id} failed: {e}")
+                if attempts + 1 >= 3:
+                    metric_inc("digest_failed_total")
+                    return ("failed", attempts + 1, ts_now(), None, oid)
+                return ("pending", attempts + 1, ts_now() + 300 * (attempts + 1), None, oid)
+
+    async def mark(self, rows: List[tuple]):
+        await WRITES.write(("UPDATE digest_outbox SET status=?, attempts=?, next_ts=?, sent_ts=? WHERE id=?", rows))
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+OUTBOX = Outbox(DIGEST_RATE)
+
+async def digest_job(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(timezone.utc)
+    for kind in ("week", "month"):
+        try:
+            n = await asyncio.to_thread(build_digests, kind, now)
+        except Exception as e:
+            log.warning(f"Digest build ({kind}) failed: {e}")
+            continue
+        log.info(f"Digest {kind}: queued {n}")
+    OUTBOX.kick()
+
+# ---------------- Backups ----------------
+def is_admin(uid: int) -> bool:
+    return uid in ADMIN_USER_IDS
+
+def run_backup(db_path: str = DB_PATH, backup_dir: str = BACKUP_DIR) -> Tuple[str, int]:
+    import backup
+    t0 = time.perf_counter()
+    path = backup.create_snapshot(db_path, backup_dir)
+    removed = backup.rotate(backup_dir, BACKUP_KEEP_LAST, BACKUP_KEEP_DAYS)
+    size = os.path.getsize(path)
+    metric_set("backup_last_ts", time.time())
+    metric_set("backup_last_seconds", time.perf_counter() - t0)
+    metric_set("backup_last_bytes", size)
+    log.info(f"Backup {os.path.basename(path)}: {size} bytes, rotated out {len(removed)}")
+    return path, size
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(run_backup)
+    except Exception as e:
+        metric_inc("backup_failures_total")
+        log.warning(f"Backup job failed: {e}")
+
+def shard_backups() -> List[Tuple[str, str]]:
+    """(db, backup dir) of every shard; /backup now snapshots them all."""
+    if SHARD_INDEX < 0:
+        return [(DB_PATH, BACKUP_DIR)]
+    return [(shard_db_path(DB_BASE_PATH, i), shard_dir(BACKUP_BASE_DIR, i)) for i in range(SHARDS)
+            if os.path.exists(shard_db_path(DB_BASE_PATH, i))]
+
+def resolve_snapshot(arg: str, backup_dir: str = BACKUP_DIR) -> Optional[str]:
+    """Snapshot by its number in the /backup list (1 = newest) or by file name."""
+    import backup
+    names = backup.list_snapshots(backup_dir)
+    if arg.isdigit() and 1 <= int(arg) <= len(names):
+        return os.path.join(backup_dir, names[int(arg) - 1])
+    return os.path.join(backup_dir, arg) if arg in names else None
+
+async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/backup — list snapshots; /backup now — take one immediately."""
+    if not is_admin(update.effective_user.id):
+        return
+    import backup
+    if context.args and context.args[0].lower() == "now":
+        done = []
+        for db_path, backup_dir in shard_backups():
+            try:
+                path, size = await asyncio.to_thread(run_backup, db_path, backup_dir)
+            except Exception as e:
+                await update.message.reply_text(f"Бэкап {os.path.basename(db_path)} не удался: {e}")
+                continue
+            shard = f" {os.path.basename(db_path)}" if SHARD_INDEX >= 0 else ""
+            done.append(f"✅ Бэкап{shard}: {os.path.basename(path)} ({size // 1024} КБ)")
+        if done:
+            await update.message.reply_text("\n".join(done))
+        return
+    names = backup.list_snapshots(BACKUP_DIR)
+    if not names:
+        await update.message.reply_text("Бэкапов пока нет. /backup now — создать.")
+        return
+    lines = [f"{i}. {n} ({os.path.getsize(os.path.join(BACKUP_DIR, n)) // 1024} КБ)" for i, n in enumerate(names[:20], 1)]
+    head = "Бэкапы (новые сверху):" if SHARD_INDEX < 0 else f"Бэкапы шарда {SHARD_INDEX} из {SHARDS} (новые сверху):"
+    await update.message.reply_text(head + "\n" + "\n".join(lines) +
+                                    "\n\n/restore <№> — восстановить, /export_user <id> [№] — выгрузка пользователя")
+
+async def restore_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    import backup
+    path = resolve_snapshot(context.args[0]) if context.args else None
+    if not path:
+        await update.message.reply_text("Использование: /restore <№ или имя из /backup>")
+        return
+    try:
+        safety = await asyncio.to_thread(backup.restore, path, DB_PATH, BACKUP_DIR)
+    except Exception as e:
+        await update.message.reply_text(f"Восстановление не удалось: {e}")
+        return
+    _group_ledgers.clear(); _known_members.clear()
+    _chat_settings.clear(); _pins.clear(); LEDGERS.clear()
+    await asyncio.to_thread(FX.load)
+    log.warning(f"Database restored from {os.path.basename(path)} by {update.effective_user.id}")
+    await update.message.reply_text(f"♻️ База восстановлена из {os.path.basename(path)}.\n"
+                                    f"Состояние до восстановления сохранено: {os.path.basename(safety)}")
+
+async def export_user_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    import backup
+    if not context.args or not context.args[0].lstrip("-").isdigit():
+        await update.message.reply_text("Использование: /export_user <user_id> [№ бэкапа, по умолчанию последний]")
+        return
+    uid = int(context.args[0])
+    backup_dir = BACKUP_DIR if SHARD_INDEX < 0 else shard_dir(BACKUP_BASE_DIR, shard_of(uid, SHARDS))
+    path = resolve_snapshot(context.args[1] if len(context.args) > 1 else "1", backup_dir)
+    if not path:
+        await update.message.reply_text("Бэкап не найден. /backup — список.")
+        return
+    try:
+        data = await asyncio.to_thread(backup.export_user, path, backup_dir, uid)
+    except Exception as e:
+        await update.message.reply_text(f"Выгрузка не удалась: {e}")
+        return
+    await context.bot.send_document(chat_id=update.effective_chat.id, document=io.BytesIO(data),
+                                    filename=f"user_{uid}_{os.path.basename(path).split('.')[0]}.zip")
+
+async def export_month_csv(lid: int, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    tz = ledger_tz(lid)
+    start, end = month_bounds_now(tz)
+    rows = STORE.tx_between(lid, start, end)
+    import csv
     buf = io.StringIO()
     w = csv.writer(buf)
     w.writerow(["id","datetime","type","amount","currency","category","note"])
-    for rid, ts, ttype, amount, currency, category, note in rows:
-        w.writerow([rid, datetime.fromtimestamp(ts, tz=TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"), ttype, amount, currency, category, note or ""])
+    whens = fmt_times((r[1] for r in rows), tz, "%Y-%m-%d", seconds=True)
+    for (rid, ts, ttype, amount, currency, category, note), when in zip(rows, whens):
+        w.writerow([rid, when, ttype, amount, currency, category, note or ""])
     data = buf.getvalue().encode("utf-8")
     await context.bot.send_document(chat_id=chat_id, document=io.BytesIO(data), filename="transactions_month.csv")
 
-async def export_debts_csv(uid: int, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    con = sqlite3.connect(DB_PATH); c = con.cursor()
-    c.execute("""SELECT id, direction, amount, currency, counterparty, status, created_ts, updated_ts
-                 FROM debts WHERE user_id=? ORDER BY created_ts DESC""", (uid,))
-    rows = c.fetchall(); con.close()
+async def export_debts_csv(lid: int, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    rows = STORE.debts_export(lid)
+    import csv
     buf = io.StringIO()
     w = csv.writer(buf)
-    w.writerow(["id","direction","amount","currency","counterparty","status","created_at","updated_at"])
-    for rid, direction, amount, currency, cp, status, cts, uts in rows:
-        w.writerow([rid, direction, amount, currency, cp, status,
-                    datetime.fromtimestamp(cts, tz=TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
-                    datetime.fromtimestamp(uts, tz=TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")])
+    w.writerow(["id","direction","amount","paid","currency","counterparty","status","created_at","updated_at"])
+    whens = iter(fmt_times((ts for r in rows for ts in r[7:9]), ledger_tz(lid), "%Y-%m-%d", seconds=True))
+    for rid, direction, amount, paid, currency, cp, status, _, _ in rows:
+        w.writerow([rid, direction, amount, paid, currency, cp, status, next(whens), next(whens)])
     data = buf.getvalue().encode("utf-8")
     await context.bot.send_document(chat_id=chat_id, document=io.BytesIO(data), filename="debts.csv")
 
 # ---------------- Balance summary + pin ----------------
-def build_balance_summary(uid: int) -> str:
-    now = datetime.now(TIMEZONE)
+def build_balance_summary(lid: int) -> str:
+    now = datetime.now(ledger_tz(lid))
     head = f"📌 Итог на {now.strftime('%d.%m')}, {now.strftime('%H:%M')}"
-    net = net_by_currency(uid)
-    debts = debt_totals_by_currency(uid)
+    net, members = net_by_member(lid)
+    debts = debt_totals_by_currency(lid)
 
     def fmt_multi(label: str) -> str:
         parts = []
@@ -506,14 +2353,32 @@ def build_balance_summary(uid: int) -> str:
         fmt_multi("Мне должны"),
         fmt_multi("Чистый баланс"),
     ]
+    currencies = set(net.keys()) | set(debts.keys())
+    if currencies - {BASE_CURRENCY}:
+        total, missing = 0.0, set()
+        for cur in currencies:
+            val = net.get(cur, 0.0) - debts.get(cur, {}).get("owes", 0.0) + debts.get(cur, {}).get("owed", 0.0)
+            b = to_base(val, cur)
+            if b is None: missing.add(cur)
+            else: total += b
+        lines.append(fmt_base_line("Итого", total, missing))
+    if len(members) > 1:
+        names = ledger_member_names(lid)
+        lines.append("")
+        lines.append("По участникам:")
+        for member_id, per_cur in sorted(members.items(), key=lambda kv: names.get(kv[0], "")):
+            parts = [fmt_amount(v, cur) for cur, v in sorted(per_cur.items()) if abs(v) > 0.0001] or [fmt_amount(0, "uzs")]
+            lines.append(f"• {names.get(member_id, member_id)}: " + " | ".join(parts))
     return "\n".join(lines)
 
 async def send_and_pin_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if shed_optional("summary"):
+        return
     chat_id = update.effective_chat.id
-    uid = update.effective_user.id
+    lid = current_ledger(update)
     st = get_chat_settings(chat_id)
-    summary = build_balance_summary(uid)
-    tip = generate_ai_tip(uid)
+    summary = build_balance_summary(lid)
+    tip = get_insight_tip(lid) or generate_ai_tip(lid)
     text = summary + "\n\n" + f"💡 {tip}"
     msg = await context.bot.send_message(chat_id=chat_id, text=text)
     if st.get("autopin", 1):
@@ -525,57 +2390,361 @@ async def send_and_pin_summary(update: Update, context: ContextTypes.DEFAULT_TYP
                 log.debug(f"unpin old failed: {e}")
         try:
             await context.bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id, disable_notification=True)
-            set_pinned_msg_id(chat_id, msg.message_id)
+            await set_pinned_msg_id(chat_id, msg.message_id)
         except Exception as e:
             log.debug(f"pin failed: {e}")
 
-# ---------------- Healthcheck HTTP (for Railway Web) ----------------
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-Type","text/plain")
-        self.end_headers()
-        self.wfile.write(b"OK")
-    def log_message(self, format, *args):
-        return
+# ---------------- Metrics ----------------
+METRICS: Dict[str, float] = {}
+STARTED_TS = time.time()
+
+def metric_inc(name: str, value: float = 1.0):
+    METRICS[name] = METRICS.get(name, 0.0) + value
+
+def metric_set(name: str, value: float):
+    METRICS[name] = value
+
+def metrics_text() -> str:
+    lines = [f"bot_uptime_seconds {time.time() - STARTED_TS:.0f}"]
+    lines += [f"bot_{k} {METRICS[k]:g}" for k in sorted(METRICS)]
+    return "\n".join(lines) + "\n"
+
+# ---------------- Admission control ----------------
+# text_router and on_callback ask ADMISSION first (admission.py): repeated read-only taps
+# are merged, users and groups are rate-limited, and under load optional work is shed
+# before reads, reads before writes. LOAD_SHED_PENDING pending updates sheds the summary,
+# tip, re-pin and cleanup; twice that also sheds read-only buttons.
+READ_BUTTONS = {BALANCE_BTN, HISTORY_BTN, REPORT_BTN, EXPORT_BTN, SETTINGS_BTN, "/settings"}
+READ_CALLBACKS = {"hist", "find", "dls", "dcp", "report"}
+BUSY_TEXT = "Бот перегружен, попробуйте через минуту."
+RATE_TEXT = "Слишком часто. Подождите немного."
+
+ADMISSION = Admission(ADMIT_USER_RATE, ADMIT_USER_BURST, ADMIT_CHAT_RATE, ADMIT_CHAT_BURST,
+                      ADMIT_COALESCE_MS / 1000, LOAD_SHED_PENDING, LOAD_SHED_PENDING * 2, METRICS)
+
+async def admit(update: Update, tap: Optional[str], read_only: bool) -> bool:
+    """False if the update is dropped; the user hears about it at most once per flood, and a
+    dropped callback is still answered so the button stops spinning."""
+    uid = update.effective_user.id
+    verdict = ADMISSION.check(uid, update.effective_chat.id, tap, read_only)
+    if verdict == ADMIT:
+        return True
+    text = None if verdict == DUPLICATE else BUSY_TEXT if verdict == SHED else RATE_TEXT
+    q = update.callback_query
+    if q is not None:
+        await q.answer(text)
+    elif text and ADMISSION.warn_once(uid):
+        await update.message.reply_text(text)
+    return False
+
+def shed_optional(what: str) -> bool:
+    if not ADMISSION.level():
+        return False
+    metric_inc(f"shed_{what}_total")
+    return True
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metric_inc("updates_total")
+    USAGE.hit(update)
+
+# ---------------- Usage stats (/admin_stats) ----------------
+# Handlers only bump in-memory counters; stats_job folds them into the stats_* tables every
+# STATS_EVERY_MINUTES, together with the tx count (an id-range scan past the last seen id)
+# and the DB size. /admin_stats reads only those small tables.
+def stats_day(ts: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(ts or time.time(), tz=TIMEZONE).strftime("%Y-%m-%d")
+
+def handler_name(update: object) -> str:
+    q = getattr(update, "callback_query", None)
+    if q is not None:
+        return "callback:" + (q.data or "").split(":", 1)[0]
+    if getattr(update, "inline_query", None) is not None:
+        return "inline"
+    if getattr(update, "chosen_inline_result", None) is not None:
+        return "inline:chosen"
+    msg = getattr(update, "message", None)
+    text = (msg.text or "") if msg else ""
+    if text.startswith("/"):
+        return text.split(maxsplit=1)[0].split("@", 1)[0]
+    return "text" if text else "other"
+
+class UsageStats:
+    def __init__(self):
+        self.users: Dict[str, set] = {}
+        self.chats: Dict[Tuple[str, int], int] = {}
+        self.handlers: Dict[Tuple[str, str], List[float]] = {}  # [n, total_ms, max_ms]
+
+    def hit(self, update: Update):
+        day = stats_day()
+        if update.effective_user:
+            self.users.setdefault(day, set()).add(update.effective_user.id)
+        if update.effective_chat:
+            key = (day, update.effective_chat.id)
+            self.chats[key] = self.chats.get(key, 0) + 1
+
+    def observe(self, update: object, seconds: float):
+        key, ms = (stats_day(), handler_name(update)), seconds * 1000
+        h = self.handlers.get(key)
+        if h is None:
+            self.handlers[key] = [1, ms, ms]
+        else:
+            h[0] += 1; h[1] += ms; h[2] = max(h[2], ms)
+
+    def take(self) -> "UsageStats":
+        """Hand the counters collected so far to the aggregation job and start afresh."""
+        snap = UsageStats()
+        snap.users, snap.chats, snap.handlers = self.users, self.chats, self.handlers
+        self.users, self.chats, self.handlers = {}, {}, {}
+        return snap
+
+USAGE = UsageStats()
+
+def aggregate_stats(snap: UsageStats) -> int:
+    """Fold one snapshot of in-memory counters into the stats tables; returns new tx counted."""
+    con = sqlite3.connect(DB_PATH); c = con.cursor()
+    c.executemany("INSERT OR IGNORE INTO stats_users(day, user_id) VALUES(?,?)",
+                  [(day, uid) for day, uids in snap.users.items() for uid in uids])
+    c.executemany("""INSERT INTO stats_chats(day, chat_id, updates) VALUES(?,?,?)
+                     ON CONFLICT(day, chat_id) DO UPDATE SET updates = updates + excluded.updates""",
+                  [(day, chat, n) for (day, chat), n in snap.chats.items()])
+    c.executemany("""INSERT INTO stats_handlers(day, handler, n, total_ms, max_ms) VALUES(?,?,?,?,?)
+                     ON CONFLICT(day, handler) DO UPDATE SET n = n + excluded.n, total_ms = total_ms + excluded.total_ms,
+                     max_ms = MAX(max_ms, excluded.max_ms)""",
+                  [(day, name, *v) for (day, name), v in snap.handlers.items()])
+    row = c.execute("SELECT value FROM stats_meta WHERE key='tx_last_id'").fetchone()
+    last_id = int(row[0]) if row else 0
+    lo, hi = c.execute("SELECT MIN(ts), MAX(ts) FROM tx WHERE id > ?", (last_id,)).fetchone()
+    off, off_params = offset_sql(tz_spans(TIMEZONE, lo, hi) if lo is not None else [(0, 0, 0)])
+    c.execute(f"""SELECT date(ts + {off}, 'unixepoch'), COUNT(*), MAX(id) FROM tx WHERE id > ? GROUP BY 1""",
+              (*off_params, last_id))
+    new_tx = 0
+    for day, n, top in c.fetchall():
+        c.execute("""INSERT INTO stats_daily(day, metric, value) VALUES(?, 'tx', ?)
+                     ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value""", (day, n))
+        new_tx += n; last_id = max(last_id, top)
+    today = stats_day()
+    days = set(snap.users) | {today}
+    c.executemany("""INSERT INTO stats_daily(day, metric, value)
+                     SELECT ?, 'active_users', COUNT(*) FROM stats_users WHERE day=?
+                     ON CONFLICT(day, metric) DO UPDATE SET value = excluded.value""", [(d, d) for d in days])
+    updates_by_day: Dict[str, int] = {}
+    for (day, _), n in snap.chats.items():
+        updates_by_day[day] = updates_by_day.get(day, 0) + n
+    c.executemany("""INSERT INTO stats_daily(day, metric, value) VALUES(?, 'updates', ?)
+                     ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value""", updates_by_day.items())
+    db_bytes = sum(os.path.getsize(DB_PATH + ext) for ext in ("", "-wal") if os.path.exists(DB_PATH + ext))
+    arc_bytes = sum(os.path.getsize(p) for p in archive_paths())
+    c.executemany("""INSERT INTO stats_daily(day, metric, value) VALUES(?,?,?)
+                     ON CONFLICT(day, metric) DO UPDATE SET value = excluded.value""",
+                  [(today, "db_bytes", db_bytes), (today, "archive_bytes", arc_bytes)])
+    c.executemany("INSERT OR REPLACE INTO stats_meta(key, value) VALUES(?,?)",
+                  [("tx_last_id", last_id), ("last_run_ts", time.time())])
+    cutoff = stats_day(time.time() - STATS_KEEP_DAYS * 86400)
+    for table in ("stats_daily", "stats_users", "stats_chats", "stats_handlers"):
+        c.execute(f"DELETE FROM {table} WHERE day < ?", (cutoff,))
+    con.commit(); con.close()
+    return new_tx
 
-def run_health_server():
+async def stats_job(context: ContextTypes.DEFAULT_TYPE):
+    snap = USAGE.take()
     try:
-        srv = HTTPServer(("0.0.0.0", PORT), HealthHandler)
-        srv.serve_forever()
+        await asyncio.to_thread(aggregate_stats, snap)
     except Exception as e:
-        log.warning(f"Health server stopped: {e}")
+        log.warning(f"Stats aggregation failed: {e}")
+
+def admin_stats_text(days: int) -> str:
+    """Summed over all shards: users and chats each live on one shard, so per-day counts
+    add up (a user active in a group and in private on different shards counts twice)."""
+    since = stats_day(time.time() - (days - 1) * 86400)
+    daily: Dict[str, Dict[str, float]] = {}
+    chat_n: Dict[int, float] = {}
+    handler_n: Dict[str, List[float]] = {}  # [n, total_ms, max_ms]
+    last_run = None
+    for path in shard_dbs():
+        con = sqlite3.connect(path); c = con.cursor()
+        for day, metric, value in c.execute("SELECT day, metric, value FROM stats_daily WHERE day >= ?", (since,)):
+            d = daily.setdefault(day, {})
+            d[metric] = d.get(metric, 0) + value
+        for chat_id, n in c.execute("SELECT chat_id, SUM(updates) FROM stats_chats WHERE day >= ? GROUP BY chat_id", (since,)):
+            chat_n[chat_id] = chat_n.get(chat_id, 0) + n
+        for name, n, total, mx in c.execute("""SELECT handler, SUM(n), SUM(total_ms), MAX(max_ms) FROM stats_handlers
+                                               WHERE day >= ? GROUP BY handler""", (since,)):
+            h = handler_n.setdefault(name, [0, 0.0, 0.0])
+            h[0] += n; h[1] += total; h[2] = max(h[2], mx)
+        row = c.execute("SELECT value FROM stats_meta WHERE key='last_run_ts'").fetchone()
+        con.close()
+        if row is not None:
+            last_run = max(last_run or 0, row[0])
+    if last_run is None:
+        return "Статистика ещё не собрана (первый сбор через несколько минут)."
+    chats = sorted(chat_n.items(), key=lambda kv: -kv[1])[:5]
+    handlers = sorted(((name, n, total / n, mx) for name, (n, total, mx) in handler_n.items() if n),
+                      key=lambda h: -h[2])[:5]
+    lines = [f"📈 Статистика за {days} дн. (обновлено {datetime.fromtimestamp(last_run, tz=TIMEZONE).strftime('%d.%m %H:%M')})",
+             "", "День: активных / операций / апдейтов"]
+    for day, m in sorted(daily.items(), reverse=True):
+        lines.append(f"{day[8:10]}.{day[5:7]}: {int(m.get('active_users', 0))} / {int(m.get('tx', 0))} / {int(m.get('updates', 0))}")
+    size = next((m for _, m in sorted(daily.items(), reverse=True) if "db_bytes" in m), {})
+    if size:
+        lines.append(f"\nБаза: {size['db_bytes'] / 1048576:.1f} МБ, архив: {size.get('archive_bytes', 0) / 1048576:.1f} МБ")
+    if chats:
+        lines.append("\nСамые активные чаты:")
+        lines += [f"{chat_id}: {n:g}" for chat_id, n in chats]
+    if handlers:
+        lines.append("\nСамые медленные обработчики (сред. / макс., мс):")
+        lines += [f"{name}: {avg:.0f} / {mx:.0f} ({n})" for name, n, avg, mx in handlers]
+    return "\n".join(lines)
+
+async def admin_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/admin_stats [days] — usage from the precomputed aggregates (default 7 days)."""
+    if not is_admin(update.effective_user.id):
+        return
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 7
+    days = max(1, min(days, STATS_KEEP_DAYS))
+    await update.message.reply_text(await asyncio.to_thread(admin_stats_text, days))
+
+# ---------------- HTTP server (health, metrics, webhook) ----------------
+# One tornado server on the bot's event loop. PTB's run_webhook() cannot host extra
+# routes, so webhook updates are fed to app.update_queue directly.
+def build_web_app(app: Application):
+    import hmac, json
+    import tornado.web
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain")
+            self.write("OK")
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(metrics_text())
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+                metric_inc("webhook_rejected_total")
+                self.set_status(403); return
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except Exception:
+                metric_inc("webhook_bad_request_total")
+                self.set_status(400); return
+            metric_inc("webhook_updates_total")
+            # the front routes by what this update changes, so it waits until it is handled
+            done = app.update_processor.watch(update.update_id) if self.request.headers.get("X-Shard-Wait") else None
+            await app.update_queue.put(update)
+            if done is not None:
+                await done
+
+        def log_exception(self, typ, value, tb):
+            log.warning(f"webhook handler error: {value}")
+
+    routes = [(r"/", HealthHandler), (r"/healthz", HealthHandler), (r"/metrics", MetricsHandler)]
+    if BOT_MODE == "webhook":
+        routes.append((WEBHOOK_PATH, WebhookHandler))
+    return tornado.web.Application(routes, log_function=lambda handler: None)
+
+async def run_bot(app: Application):
+    global WEBHOOK_SECRET
+    import secrets
+    import tornado.httpserver
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        log.warning("WEBHOOK_SECRET is not set, generated a random one for this run")
+    server = tornado.httpserver.HTTPServer(build_web_app(app))
+    if SHARD_SOCKET:  # a shards.py worker: the front forwards updates over this socket
+        import tornado.netutil
+        server.add_socket(tornado.netutil.bind_unix_socket(SHARD_SOCKET))
+    else:
+        server.listen(PORT)
+    async with app:
+        if SHARD_SOCKET:
+            log.info(f"Shard {SHARD_INDEX}/{SHARDS} on {SHARD_SOCKET}, DB {DB_PATH}")
+        elif BOT_MODE == "webhook":
+            if WEBHOOK_URL:
+                await app.bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                          max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES,
+                                          drop_pending_updates=True)
+            log.info(f"Webhook mode on :{PORT}{WEBHOOK_PATH}")
+        else:
+            await app.updater.start_polling(drop_pending_updates=True)
+            log.info(f"Polling mode, health on :{PORT}")
+        await app.start()
+        OUTBOX.start(app.bot)
+        await stop.wait()
+        server.stop()
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+        await OUTBOX.close()
+        await app.stop()
+        await WRITES.close()
 
 # ---------------- Cleanup helpers ----------------
+# Transient messages (menus, dialog prompts and confirmations, and the user's inputs to
+# them) go into a per-chat ring of message ids, chat_data["transient"] (id -> sent ts,
+# oldest first). With autoclean on, the next menu action deletes the whole ring through
+# deleteMessages, up to 100 ids per call. Bots can only delete messages younger than 48 h,
+# so older ids are dropped without a call; the pinned summary is never in the ring.
+CLEANUP_RING = 300
+CLEANUP_CHUNK = 100
+CLEANUP_MAX_AGE = 47 * 3600
+
 def should_autoclean(chat_id: int) -> bool:
     st = get_chat_settings(chat_id)
     return bool(st.get("autoclean", 1))
 
+async def delete_messages(bot, chat_id: int, message_ids: List[int]):
+    """Bot API deleteMessages. PTB 20.7 (pinned in requirements.txt) has neither
+    Bot.delete_messages nor the public do_api_request (20.8), so it falls back to the
+    private Bot._post there."""
+    if hasattr(bot, "delete_messages"):
+        return await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+    if hasattr(bot, "do_api_request"):
+        return await bot.do_api_request("deleteMessages", api_kwargs={"chat_id": chat_id, "message_ids": message_ids})
+    return await bot._post("deleteMessages", {"chat_id": chat_id, "message_ids": message_ids})
+
 async def cleanup_prev_msgs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if not should_autoclean(chat_id):
+    if not should_autoclean(chat_id) or shed_optional("cleanup"):
+        return  # under load the ring is kept for the next cleanup
+    ring = context.chat_data.pop("transient", None)  # messages sent meanwhile start a new ring
+    if not ring:
         return
-    chat_data = context.chat_data
-    last_user_id = chat_data.get("last_user_msg_id")
-    last_bot_id = chat_data.get("last_bot_msg_id")
-    if last_user_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=last_user_id)
-        except Exception:
-            pass
-    if last_bot_id:
+    oldest = ts_now() - CLEANUP_MAX_AGE
+    ids = [mid for mid, ts in ring.items() if ts >= oldest]
+    for i in range(0, len(ids), CLEANUP_CHUNK):
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=last_bot_id)
-        except Exception:
-            pass
-    chat_data.pop("last_user_msg_id", None)
-    chat_data.pop("last_bot_msg_id", None)
+            await delete_messages(context.bot, chat_id, ids[i:i + CLEANUP_CHUNK])
+            metric_inc("cleanup_deleted_total", len(ids[i:i + CLEANUP_CHUNK]))
+        except Exception as e:
+            log.debug(f"deleteMessages in {chat_id} failed: {e}")
+
+def remember_msg(context: ContextTypes.DEFAULT_TYPE, message_id: int):
+    ring = context.chat_data.setdefault("transient", {})
+    ring[message_id] = ts_now()
+    while len(ring) > CLEANUP_RING:
+        del ring[next(iter(ring))]
 
 def remember_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.chat_data["last_user_msg_id"] = update.message.message_id
+    remember_msg(context, update.message.message_id)
 
 def remember_bot_msg(context: ContextTypes.DEFAULT_TYPE, message_id: int):
-    context.chat_data["last_bot_msg_id"] = message_id
+    remember_msg(context, message_id)
+
+async def reply_transient(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kw):
+    """reply_text whose message autoclean removes on the next menu action."""
+    msg = await update.message.reply_text(text, **kw)
+    remember_bot_msg(context, msg.message_id)
+    return msg
 
 # ---------------- Undo last action ----------------
 def set_last_action(context: ContextTypes.DEFAULT_TYPE, uid: int, payload: Dict[str, Any]):
@@ -597,15 +2766,14 @@ async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if t == "tx_add":
         ok = delete_tx(uid, act["tx_id"])
         await update.message.reply_text("Отменено: последняя транзакция удалена." if ok else "Не удалось отменить транзакцию.")
+    elif t == "tx_batch":
+        n = delete_txs(uid, act["tx_ids"])
+        await update.message.reply_text(f"Отменено: удалено операций из списка — {n}." if n else "Не удалось отменить список операций.")
     elif t == "debt_add":
         ok = delete_debt(uid, act["debt_id"])
         await update.message.reply_text("Отменено: последний долг удалён." if ok else "Не удалось отменить долг.")
     elif t == "debt_update":
-        debt_id = act["debt_id"]
-        prev_amount = act.get("prev_amount")
-        con = sqlite3.connect(DB_PATH); c = con.cursor()
-        c.execute("UPDATE debts SET amount=?, status='open', updated_ts=? WHERE id=?", (prev_amount, ts_now(), debt_id))
-        con.commit(); con.close()
+        debt_restore(act["debt_id"], act.get("prev_amount"), act.get("payment_id"))
         await update.message.reply_text("Отмена применена: долг восстановлен.")
     else:
         await update.message.reply_text("Эту операцию отменить нельзя.")
@@ -614,17 +2782,16 @@ async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_and_pin_summary(update, context)
 
 # ---------------- History pagination ----------------
-def build_history_text(uid: int, page: int, page_size: int = 10) -> Tuple[str, int]:
-    total = count_txs(uid)
+def build_history_text(lid: int, page: int, page_size: int = 10) -> Tuple[str, int]:
+    total = count_txs(lid)
     pages = max(1, math.ceil(total / page_size))
     page = max(1, min(page, pages))
     offset = (page - 1) * page_size
-    rows = last_txs(uid, page_size, offset)
+    rows = last_txs(lid, page_size, offset)
     if not rows:
         return "История пуста.", pages
     lines = [f"История (стр. {page}/{pages}):"]
-    for rid, ttype, amount, currency, category, note, ts in rows:
-        when = dt_fmt(ts)
+    for (rid, ttype, amount, currency, category, note, ts), when in zip(rows, fmt_times((r[6] for r in rows), ledger_tz(lid))):
         lines.append(f"#{rid} {when} — {'+' if ttype=='income' else '-'} {fmt_amount(amount, currency)} [{category}]")
     return "\n".join(lines), pages
 
@@ -637,13 +2804,96 @@ def history_kb(page: int, pages: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([buttons] if buttons else [])
 
 async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
+    lid = current_ledger(update)
     await cleanup_prev_msgs(update, context)
     remember_user_msg(update, context)
-    text, pages = build_history_text(uid, 1)
+    text, pages = build_history_text(lid, 1)
     msg = await update.message.reply_text(text, reply_markup=history_kb(1, pages))
     remember_bot_msg(context, msg.message_id)
 
+# ---------------- Search (/find) ----------------
+FIND_PAGE_SIZE = 10
+DATE_RE = r"\d{1,2}\.\d{1,2}\.\d{2,4}"
+
+def parse_date_local(s: str, tz: Optional[ZoneInfo] = None) -> Optional[datetime]:
+    m = re.fullmatch(r"(\d{1,2})\.(\d{1,2})\.(\d{2,4})", s)
+    if not m: return None
+    dd, mm, yy = map(int, m.groups())
+    if yy < 100: yy += 2000
+    try:
+        return datetime(yy, mm, dd, tzinfo=tz or TIMEZONE)
+    except ValueError:
+        return None
+
+def parse_find_query(q: str, tz: Optional[ZoneInfo] = None) -> Dict[str, Any]:
+    """'такси >10000 <=50000 01.09.2025-30.09.2025 usd' -> terms + filters. Amount bounds
+    are (op, amount) with op one of >, >=, <, <=."""
+    res: Dict[str, Any] = {"terms": [], "min": None, "max": None, "start": None, "end": None, "currency": None}
+    for tok in q.split():
+        low = tok.lower()
+        m = re.fullmatch(r"([<>]=?)(\d[\d.,]*)", low)
+        if m:
+            amt = parse_amount(m.group(2))
+            if amt is not None:
+                res["min" if m.group(1)[0] == ">" else "max"] = (m.group(1), amt)
+            continue
+        m = re.fullmatch(rf"({DATE_RE})(?:-({DATE_RE}))?", low)
+        if m:
+            d1 = parse_date_local(m.group(1), tz)
+            d2 = parse_date_local(m.group(2), tz) if m.group(2) else d1
+            if d1 and d2:
+                res["start"] = int(d1.timestamp())
+                res["end"] = int((d2 + timedelta(days=1)).timestamp()) - 1
+            continue
+        if low in CURRENCY_WORDS:
+            res["currency"] = detect_currency(low)
+            continue
+        res["terms"].extend(re.findall(r"\w+", low))
+    return res
+
+def fts_match_expr(lid: int, terms: List[str]) -> str:
+    # every term is a quoted prefix query; the ledger_key column narrows the doclist
+    quoted = " ".join('"' + t.replace('"', '""') + '"*' for t in terms)
+    return f'ledger_key:"{fts_ledger_key(lid)}" AND {{note category}}:({quoted})'
+
+@traced("db.search_txs")
+def search_txs(lid: int, q: Dict[str, Any], before: Optional[Tuple[int, int]] = None,
+               limit: int = FIND_PAGE_SIZE) -> List[tuple]:
+    """Keyset-paginated search, newest first. `before` is the (ts, id) of the last row shown."""
+    return STORE.search_txs(lid, q, before, limit)
+
+def build_find_text(lid: int, query: str, before: Optional[Tuple[int, int]] = None) -> Tuple[str, Optional[Tuple[int, int]]]:
+    tz = ledger_tz(lid)
+    rows = search_txs(lid, parse_find_query(query, tz), before, FIND_PAGE_SIZE + 1)
+    more = len(rows) > FIND_PAGE_SIZE
+    rows = rows[:FIND_PAGE_SIZE]
+    if not rows:
+        return ("Ничего не найдено." if not before else "Больше ничего не найдено."), None
+    lines = [f"🔎 Поиск: {query}"]
+    for (rid, ttype, amount, currency, category, note, ts), when in zip(rows, fmt_times((r[6] for r in rows), tz)):
+        line = f"#{rid} {when} — {'+' if ttype=='income' else '-'} {fmt_amount(amount, currency)} [{category}]"
+        if note: line += f" {note[:40]}"
+        lines.append(line)
+    return "\n".join(lines), ((rows[-1][6], rows[-1][0]) if more else None)
+
+def find_kb(cursor: Optional[Tuple[int, int]], paged: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    if paged:
+        buttons.append(InlineKeyboardButton("⟨ В начало", callback_data="find:0:0"))
+    if cursor:
+        buttons.append(InlineKeyboardButton("Ещё ⟩", callback_data=f"find:{cursor[0]}:{cursor[1]}"))
+    return InlineKeyboardMarkup([buttons] if buttons else [])
+
+async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lid = current_ledger(update)
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("Поиск: /find такси >10000 <50000 01.09.2025-30.09.2025 usd")
+        return
+    context.user_data["find_q"] = query
+    text, cursor = build_find_text(lid, query)
+    await update.message.reply_text(text, reply_markup=find_kb(cursor, False))
+
 # ---------------- Settings ----------------
 def settings_kb(chat_id: int) -> InlineKeyboardMarkup:
     st = get_chat_settings(chat_id)
@@ -651,6 +2901,7 @@ def settings_kb(chat_id: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(f"Автопин: {'Вкл' if st['autopin'] else 'Выкл'}", callback_data="settings:toggle:autopin")],
         [InlineKeyboardButton(f"Автоочистка: {'Вкл' if st['autoclean'] else 'Выкл'}", callback_data="settings:toggle:autoclean")],
         [InlineKeyboardButton(f"Тихий режим (группы): {'Вкл' if st['group_silent'] else 'Выкл'}", callback_data="settings:toggle:group_silent")],
+        [InlineKeyboardButton(f"Дайджест: {DIGEST_LABELS.get(st['digest'], 'Выкл')}", callback_data="settings:digest:next")],
         [InlineKeyboardButton("Язык: RU", callback_data="settings:setlang:ru")]
     ])
 
@@ -659,58 +2910,113 @@ async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Настройки:", reply_markup=settings_kb(chat_id))
 
 # ---------------- Callbacks (inline) ----------------
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    data = q.data or ""
+# callback_data is "<prefix>:<arg>:...". CALLBACK_ROUTES maps a prefix to its handler and the
+# converters for its args: dispatch is one dict lookup, and malformed data is dropped.
+async def edit_or_send(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, kb: InlineKeyboardMarkup):
+    try:
+        await update.callback_query.edit_message_text(text=text, reply_markup=kb)
+    except Exception:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=kb)
+
+async def cb_debt_close(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, debt_id: int):
     uid = update.effective_user.id
-    chat_id = update.effective_chat.id
+    ok, msg, undo = debt_reduce_or_close(lid, debt_id, None, uid=uid)
+    if ok and undo: set_last_action(context, uid, undo)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+    await send_and_pin_summary(update, context)
 
-    if data.startswith("debt_close:"):
-        debt_id = int(data.split(":")[1])
-        ok, msg, undo = debt_reduce_or_close(uid, debt_id, None)
-        if ok and undo: set_last_action(context, uid, undo)
-        await context.bot.send_message(chat_id=chat_id, text=msg)
-        await send_and_pin_summary(update, context)
-        return
+async def cb_debt_reduce(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, debt_id: int):
+    set_debts_state(context, {"stage":"reduce_ask_amount", "debt_id": debt_id})
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="Введите сумму уменьшения (например: 1000 или 10 usd). Для полного закрытия введите 0.")
 
-    if data.startswith("debt_reduce:"):
-        debt_id = int(data.split(":")[1])
-        context.user_data["debts"] = {"stage":"reduce_ask_amount", "debt_id": debt_id}
-        await context.bot.send_message(chat_id=chat_id, text="Введите сумму уменьшения (например: 1000 или 10 usd). Для полного закрытия введите 0.")
-        return
+async def cb_debts_page(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, mode: str, page: int):
+    await edit_or_send(update, context, *build_debts_page(lid, mode, page))
 
-    if data.startswith("hist:"):
-        parts = data.split(":")
-        page = int(parts[2])
-        text, pages = build_history_text(uid, page)
-        try:
-            await q.edit_message_text(text=text, reply_markup=history_kb(page, pages))
-        except Exception:
-            await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=history_kb(page, pages))
+async def cb_counterparty(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, cp_id: int, mode: str):
+    await edit_or_send(update, context, *build_counterparty_text(lid, cp_id, mode))
+
+async def cb_history(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, _direction: str, page: int):
+    text, pages = build_history_text(lid, page)
+    await edit_or_send(update, context, text, history_kb(page, pages))
+
+async def cb_find(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, ts: int, tx_id: int):
+    query = context.user_data.get("find_q")
+    if not query:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Поиск устарел. Повторите /find.")
         return
+    before = (ts, tx_id) if tx_id else None
+    text, cursor = build_find_text(lid, query, before)
+    await edit_or_send(update, context, text, find_kb(cursor, before is not None))
 
-    if data.startswith("report:"):
-        if data == "report:week":
-            s, e = week_bounds_now(); title = "неделя"
-        elif data == "report:month":
-            s, e = month_bounds_now(); title = "месяц"
-        else:
-            s, e = quarter_bounds_now(); title = "квартал"
-        text = report_text_for_period(uid, s, e, title)
-        await context.bot.send_message(chat_id=chat_id, text=text)
+REPORT_PERIODS = {"week": (week_bounds_now, "неделя"), "month": (month_bounds_now, "месяц"),
+                  "quarter": (quarter_bounds_now, "квартал")}
+
+async def cb_report(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, period: str, kind: str = ""):
+    bounds, title = REPORT_PERIODS.get(period, REPORT_PERIODS["quarter"])
+    s, e = bounds(ledger_tz(lid))
+    chat_id = update.effective_chat.id
+    if kind == "chart":
+        await send_report_chart(context, chat_id, lid, s, e, title)
         return
+    await context.bot.send_message(chat_id=chat_id, text=report_text_for_period(lid, s, e, title))
+
+async def cb_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, lid: int, action: str, key: str):
+    chat_id = update.effective_chat.id
+    if action == "toggle":
+        st = get_chat_settings(chat_id)
+        new_val = 0 if st.get(key, 1) else 1
+        await set_chat_setting(chat_id, key, new_val)
+    elif action == "setlang":
+        await set_chat_setting(chat_id, "lang", key)
+    elif action == "digest":
+        cycle = list(DIGEST_LABELS)
+        cur = get_chat_settings(chat_id)["digest"]
+        await set_chat_setting(chat_id, "digest", cycle[(cycle.index(cur) + 1) % len(cycle)] if cur in cycle else "week")
+    await update.callback_query.edit_message_text("Настройки:", reply_markup=settings_kb(chat_id))
+
+def debt_list_mode(s: str) -> str:
+    if s not in DEBT_LIST_TITLES:
+        raise ValueError(s)
+    return s
+
+# prefix -> (handler, arg converters, number of required args)
+CALLBACK_ROUTES: Dict[str, Tuple[Any, tuple, int]] = {
+    "debt_close": (cb_debt_close, (int,), 1),
+    "debt_reduce": (cb_debt_reduce, (int,), 1),
+    "dls": (cb_debts_page, (debt_list_mode, int), 2),
+    "dcp": (cb_counterparty, (int, debt_list_mode), 2),
+    "hist": (cb_history, (str, int), 2),
+    "find": (cb_find, (int, int), 2),
+    "report": (cb_report, (str, str), 1),
+    "settings": (cb_settings, (str, str), 2),
+}
 
-    if data.startswith("settings:"):
-        _, action, key = data.split(":")
-        if action == "toggle":
-            st = get_chat_settings(chat_id)
-            new_val = 0 if st.get(key, 1) else 1
-            set_chat_setting(chat_id, key, new_val)
-        elif action == "setlang":
-            set_chat_setting(chat_id, "lang", key)
-        await q.edit_message_text("Настройки:", reply_markup=settings_kb(chat_id))
+def parse_callback(data: str) -> Optional[Tuple[Any, list]]:
+    """(handler, converted args) for callback_data, or None if unknown or malformed."""
+    prefix, *parts = data.split(":")
+    route = CALLBACK_ROUTES.get(prefix)
+    if route is None:
+        return None
+    handler, conv, required = route
+    if not required <= len(parts) <= len(conv):
+        return None
+    try:
+        return handler, [f(p) for f, p in zip(conv, parts)]
+    except ValueError:
+        return None
+
+@trace_handler("on_callback")
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    read_only = (q.data or "").split(":", 1)[0] in READ_CALLBACKS
+    if not await admit(update, (q.data or "") if read_only else None, read_only):  # writes are never merged
+        return
+    await q.answer()
+    parsed = parse_callback(q.data or "")
+    if parsed is None:
         return
+    handler, args = parsed
+    await handler(update, context, current_ledger(update), *args)
 
 # ---------------- Handlers ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -720,12 +3026,65 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Главное меню:", reply_markup=MAIN_KB)
 
 async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
+    lid = current_ledger(update)
     await cleanup_prev_msgs(update, context)
     remember_user_msg(update, context)
-    msg = await update.message.reply_text(build_balance_summary(uid))
+    msg = await update.message.reply_text(build_balance_summary(lid))
     remember_bot_msg(context, msg.message_id)
 
+async def ledger_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type not in {"group", "supergroup"}:
+        await update.message.reply_text("Общий бюджет включается в группе: добавьте бота в чат и отправьте /ledger.")
+        return
+    uid = update.effective_user.id
+    if ALLOWED_USER_IDS and uid not in ALLOWED_USER_IDS:
+        await update.message.reply_text("Доступ запрещён.")
+        return
+    if not is_admin(uid):
+        try:
+            member = await context.bot.get_chat_member(chat.id, uid)
+            status = member.status
+        except Exception as e:
+            log.warning(f"get_chat_member({chat.id}, {uid}) failed: {e}")
+            status = ""
+        if status not in {"administrator", "creator"}:
+            await update.message.reply_text("Включать и выключать общий бюджет могут только администраторы группы.")
+            return
+    if context.args and context.args[0].lower() in {"off", "выкл"}:
+        ledger_set_group(chat.id, False)
+        await update.message.reply_text("Общий бюджет группы выключен. Операции снова личные.")
+        return
+    ledger_set_group(chat.id, True, chat.title or "")
+    lid = current_ledger(update)
+    names = ledger_member_names(lid)
+    await update.message.reply_text(
+        "👥 Общий бюджет группы включён. Операции участников этого чата попадают в общий учёт.\n"
+        f"Участники: {', '.join(sorted(names.values()))}\n\n" + build_balance_summary(lid))
+
+async def set_ledger_tz(lid: int, name: str):
+    await set_chat_setting(lid, "tz", name)
+    LEDGERS.invalidate(lid)  # month start, day index and budget windows move with the zone
+
+async def tz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lid = current_ledger(update)
+    if not context.args:
+        await update.message.reply_text(
+            f"Часовой пояс: {tz_label(ledger_tz(lid))}.\n"
+            "Изменить: /tz Europe/Berlin или /tz UTC+5; вернуть по умолчанию: /tz reset")
+        return
+    arg = " ".join(context.args)
+    if arg.lower() in {"reset", "сброс"}:
+        await set_ledger_tz(lid, "")
+        await update.message.reply_text(f"Часовой пояс сброшен: {tz_label(TIMEZONE)}.")
+        return
+    tz = parse_tz(arg)
+    if tz is None:
+        await update.message.reply_text("Не знаю такой пояс. Пример: /tz Asia/Tashkent или /tz UTC+5")
+        return
+    await set_ledger_tz(lid, tz.key)
+    await update.message.reply_text(f"Часовой пояс: {tz_label(tz)}. Сейчас {datetime.now(tz).strftime('%d.%m.%Y %H:%M')}.")
+
 # ---------- Flow helpers ----------
 def set_flow(context: ContextTypes.DEFAULT_TYPE, flow: dict):
     context.user_data["flow"] = flow
@@ -755,321 +3114,639 @@ def clear_budget_state(context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("budget", None)
 
 # ---------------- Text router ----------------
-async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    is_group = chat.type in {"group", "supergroup"}
-    if is_group:
-        st = get_chat_settings(chat.id)
-        if st.get("group_silent", 1):
-            txt = (update.message.text or "").strip()
-            low = txt.lower()
-            is_command = txt.startswith("/")
-            bot_username = (context.bot.username or "").lower()
-            mentioned = bool(bot_username and f"@{bot_username}" in low)
-            is_reply_to_bot = bool(update.message.reply_to_message and update.message.reply_to_message.from_user and update.message.reply_to_message.from_user.is_bot)
-            if not (is_command or mentioned or is_reply_to_bot):
-                return
+# A message is normalized once into a TextMsg and routed by dict lookups: BUTTON_ROUTES by
+# exact button text, FSM_ROUTES by (active dialog, stage). Every route has a rank and the
+# lowest-ranked match wins, in this order: cancel, the debts dialog, the debts entry, the
+# budget dialog, the budget entry, the income/expense buttons, the transaction dialog and
+# the menu buttons. Adding buttons or stages adds dict entries, not per-message comparisons.
+class TextMsg:
+    __slots__ = ("txt", "low", "key", "uid", "lid", "chat_id", "state")
+
+    def __init__(self, txt: str, uid: int, lid: int, chat_id: int):
+        self.txt, self.low = txt, txt.lower()
+        self.key = BUTTON_ALIASES.get(self.low, txt)
+        self.uid, self.lid, self.chat_id = uid, lid, chat_id
+        self.state: Dict[str, Any] = {}  # the matched dialog's user_data state
+
+def back_route(fsm: str):
+    async def back(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+        context.user_data.pop(fsm, None)
+        await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
+    return back
 
-    if ALLOWED_USER_IDS and update.effective_user.id not in ALLOWED_USER_IDS:
-        await update.message.reply_text("Доступ запрещён.")
-        return
+def command_route(fn):
+    return lambda update, context, m: fn(update, context)
 
-    uid = update.effective_user.id
-    chat_id = update.effective_chat.id
-    txt = (update.message.text or "").strip()
-    low = txt.lower()
-
-    if txt == CANCEL_BTN:
-        await undo_last(update, context)
-        return
+# ---------- Debts dialog ----------
+async def open_debts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await cleanup_prev_msgs(update, context); remember_user_msg(update, context)
+    set_debts_state(context, {"stage":"menu"})
+    msg = await update.message.reply_text("Раздел «Долги». Выберите действие:", reply_markup=debts_menu_kb())
+    remember_bot_msg(context, msg.message_id)
 
-    # ---------- Debts FSM ----------
-    debts = get_debts_state(context)
-    stage = debts.get("stage")
+async def finish_debt_add(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg,
+                          direction: str, amount: float, currency: str, name: str):
+    debt_id = await debt_add(m.uid, direction, amount, currency, name, lid=m.lid)
+    set_last_action(context, m.uid, {"type":"debt_add", "debt_id":debt_id})
+    when = dt_fmt(ts_now(), ledger_tz(m.lid))
+    party_line = f"• Должник: {name}" if direction == "owed" else f"• Кому: {name}"
+    msg = await update.message.reply_text(
+        "✅ Долг добавлен:\n"
+        f"• Сумма: {fmt_amount(amount, currency)}\n{party_line}\n• Дата: {when}"
+    )
+    clear_debts_state(context)
+    await show_debts_list(update, context, direction)
+    remember_bot_msg(context, msg.message_id)  # after the list's cleanup, which would take it right away
+    await send_and_pin_summary(update, context)
 
-    if txt == BACK_BTN and debts:
-        clear_debts_state(context)
-        await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
+async def debt_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    amount, currency, name = parse_debt_input(m.txt)
+    if not amount:
+        await reply_transient(update, context, "Введите сумму, например: 5000 usd Ahmed")
         return
-
-    if stage == "await_amount":
-        amount, currency, name = parse_debt_input(txt)
-        if not amount:
-            await update.message.reply_text("Введите сумму, например: 5000 usd Ahmed")
-            return
-        direction = debts.get("direction")
-        if not name:
-            set_debts_state(context, {"stage":"await_counterparty", "direction":direction, "amount":amount, "currency":currency})
-            await update.message.reply_text("Кто контрагент? (Имя/комментарий)")
-            return
-        debt_id = debt_add(uid, direction, amount, currency, name)
-        set_last_action(context, uid, {"type":"debt_add", "debt_id":debt_id})
-        when = dt_fmt(ts_now())
-        party_line = f"• Должник: {name}" if direction == "owed" else f"• Кому: {name}"
-        await update.message.reply_text(
-            "✅ Долг добавлен:\n"
-            f"• Сумма: {fmt_amount(amount, currency)}\n{party_line}\n• Дата: {when}"
-        )
-        clear_debts_state(context)
-        await show_debts_list(update, context, direction)
-        await send_and_pin_summary(update, context)
+    direction = m.state.get("direction")
+    if not name:
+        set_debts_state(context, {"stage":"await_counterparty", "direction":direction, "amount":amount, "currency":currency})
+        await reply_transient(update, context, "Кто контрагент? (Имя/комментарий)")
         return
+    await finish_debt_add(update, context, m, direction, amount, currency, name)
 
-    if stage == "await_counterparty":
-        direction = debts.get("direction"); amount = debts.get("amount"); currency = debts.get("currency")
-        name = txt.strip()
-        if not name:
-            await update.message.reply_text("Введите имя/комментарий.")
-            return
-        debt_id = debt_add(uid, direction, amount, currency, name)
-        set_last_action(context, uid, {"type":"debt_add", "debt_id":debt_id})
-        when = dt_fmt(ts_now())
-        party_line = f"• Должник: {name}" if direction == "owed" else f"• Кому: {name}"
-        await update.message.reply_text(
-            "✅ Долг добавлен:\n"
-            f"• Сумма: {fmt_amount(amount, currency)}\n{party_line}\n• Дата: {when}"
-        )
-        clear_debts_state(context)
-        await show_debts_list(update, context, direction)
-        await send_and_pin_summary(update, context)
+async def debt_counterparty_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    if not m.txt:
+        await reply_transient(update, context, "Введите имя/комментарий.")
         return
+    await finish_debt_add(update, context, m, m.state.get("direction"), m.state.get("amount"), m.state.get("currency"), m.txt)
 
-    if stage == "reduce_ask_id":
-        if not txt.lstrip("#").isdigit():
-            await update.message.reply_text("Введите ID долга, например: 3")
-            return
-        set_debts_state(context, {"stage":"reduce_ask_amount", "debt_id": int(txt.lstrip('#'))})
-        await update.message.reply_text("На сколько уменьшить? (например: 1000 или 1000 usd). Для полного закрытия введите 0.")
+async def debt_reduce_id_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    if not m.txt.lstrip("#").isdigit():
+        await reply_transient(update, context, "Введите ID долга, например: 3")
         return
+    set_debts_state(context, {"stage":"reduce_ask_amount", "debt_id": int(m.txt.lstrip('#'))})
+    await reply_transient(update, context, "На сколько уменьшить? (например: 1000 или 1000 usd). Для полного закрытия введите 0.")
 
-    if stage == "reduce_ask_amount":
-        if txt.strip() in {"0","0 uzs","0 usd","закрыть","close"}:
-            ok, msg, undo = debt_reduce_or_close(uid, get_debts_state(context)["debt_id"], None)
-            if ok and undo: set_last_action(context, uid, undo)
-            await update.message.reply_text(msg)
-            clear_debts_state(context)
-            await update.message.reply_text("Выберите действие:", reply_markup=debts_menu_kb())
-            await send_and_pin_summary(update, context)
-            return
-        amt = parse_amount(txt)
+DEBT_CLOSE_WORDS = {"0", "0 uzs", "0 usd", "закрыть", "close"}
+
+async def debt_reduce_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    if m.txt in DEBT_CLOSE_WORDS:
+        amt = None
+    else:
+        amt = parse_amount(m.txt)
         if not amt:
-            await update.message.reply_text("Введите число, например: 1500")
+            await reply_transient(update, context, "Введите число, например: 1500")
             return
-        row = debt_get(uid, get_debts_state(context)["debt_id"])
-        prev_amount = float(row[1]) if row else None
-        ok, msg, undo = debt_reduce_or_close(uid, get_debts_state(context)["debt_id"], amt)
-        if ok:
-            if undo is None and prev_amount is not None:
-                undo = {"type":"debt_update", "debt_id": get_debts_state(context)["debt_id"], "prev_amount": prev_amount, "prev_status":"open"}
-            if undo: set_last_action(context, uid, undo)
-        await update.message.reply_text(msg)
-        clear_debts_state(context)
-        await update.message.reply_text("Выберите действие:", reply_markup=debts_menu_kb())
-        await send_and_pin_summary(update, context)
-        return
+    ok, msg, undo = debt_reduce_or_close(m.lid, m.state["debt_id"], amt, uid=m.uid)
+    if ok and undo: set_last_action(context, m.uid, undo)
+    await reply_transient(update, context, msg)
+    clear_debts_state(context)
+    await reply_transient(update, context, "Выберите действие:", reply_markup=debts_menu_kb())
+    await send_and_pin_summary(update, context)
 
-    # Debts menu entry/actions
-    if txt in {DEBTS_BTN, "Долги"} or ("долг" in low and not debts):
-        await cleanup_prev_msgs(update, context); remember_user_msg(update, context)
-        set_debts_state(context, {"stage":"menu"})
-        msg = await update.message.reply_text("Раздел «Долги». Выберите действие:", reply_markup=debts_menu_kb())
-        remember_bot_msg(context, msg.message_id)
-        return
+async def debts_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    direction = "owed" if m.key == "➕ Мне должны" else "owes"
+    set_debts_state(context, {"stage":"await_amount", "direction":direction})
+    await reply_transient(update, context, "Введите сумму и имя, например: 5000 usd Ahmed" if direction=="owed" else "Введите сумму и кому должны, например: 300 usd Rent")
 
-    if debts.get("stage") == "menu":
-        if low.replace("+", "➕") in {"➕ я должен", "➕ мне должны"} or txt in {"➕ Я должен", "➕ Мне должны"}:
-            direction = "owed" if "мне должны" in low else "owes"
-            set_debts_state(context, {"stage":"await_amount", "direction":direction})
-            await update.message.reply_text("Введите сумму и имя, например: 5000 usd Ahmed" if direction=="owed" else "Введите сумму и кому должны, например: 300 usd Rent")
-            return
-        if txt in {"📜 Мне должны", "📜 Я должен"}:
-            direction = "owed" if "Мне" in txt else "owes"
-            await show_debts_list(update, context, direction)
-            return
-        if txt == "✖️ Закрыть долг":
-            set_debts_state(context, {"stage":"reduce_ask_id"})
-            await update.message.reply_text("Введите ID долга для закрытия (например: 3). Введите 0 на следующем шаге для полного закрытия.")
-            return
-        if txt == "➖ Уменьшить долг":
-            set_deбts_state(context, {"stage":"reduce_ask_id"})
-            await update.message.reply_text("Введите ID долга (например: 3)")
-            return
-        if txt == "Экспорт долгов 📂":
-            await export_debts_csv(uid, context, chat_id)
-            return
-        if txt == BACK_BTN:
-            clear_deбts_state(context)
-            await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
-            return
-        await update.message.reply_text("Выберите действие:", reply_markup=debts_menu_kb())
-        return
+async def debts_list(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await show_debts_list(update, context, "owed" if m.key == "📜 Мне должны" else "owes")
 
-    # ---------- Budget FSM ----------
-    budget = get_budget_state(context); bstage = budget.get("stage")
-    if txt == BUDGET_BTN and not bstage:
-        set_budget_state(context, {"stage":"choose_cat"})
-        await update.message.reply_text("Выберите категорию для бюджета:", reply_markup=build_categories_kb(EXPENSE_CATS))
-        return
-    if txt == BACK_BTN and bstage:
-        clear_budget_state(context)
-        await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
-        return
-    if bstage == "choose_cat":
-        if txt in EXPENSE_CATS:
-            set_budget_state(context, {"stage":"await_amount", "category":txt})
-            await update.message.reply_text(f"Введите лимит и валюту для «{txt}», например: 5 000 000 uzs или 300 usd.",
-                                            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)]], resize_keyboard=True))
-            return
-    if bstage == "await_amount":
-        amount = parse_amount(txt)
-        if not amount:
-            await update.message.reply_text("Введите число, например: 5 000 000 uzs")
-            return
-        currency = detect_currency(txt)
-        category = budget.get("category")
-        budget_set(uid, category, currency, amount, "month")
-        await update.message.reply_text(f"✅ Бюджет сохранён: {category} — {fmt_amount(amount, currency)} / месяц.")
-        clear_budget_state(context)
-        return
+async def debts_by_person(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await show_debts_list(update, context, "net")
 
-    # ---------- Transaction flow (buttons) ----------
-    flow = get_flow(context)
-    if txt == BACK_BTN and flow:
-        clear_flow(context)
-        await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
-        return
+async def debts_close_start(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    set_debts_state(context, {"stage":"reduce_ask_id"})
+    await reply_transient(update, context, "Введите ID долга для закрытия (например: 3). Введите 0 на следующем шаге для полного закрытия.")
 
-    if txt == EXPENSE_BTN:
-        set_flow(context, {"stage":"choose_expense"})
-        await update.message.reply_text("Выберите категорию расхода:", reply_markup=build_categories_kb(EXPENSE_CATS))
-        return
+async def debts_reduce_start(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    set_debts_state(context, {"stage":"reduce_ask_id"})
+    await reply_transient(update, context, "Введите ID долга (например: 3)")
 
-    if txt == INCOME_BTN:
-        set_flow(context, {"stage":"choose_income"})
-        await update.message.reply_text("Выберите категорию дохода:", reply_markup=build_categories_kb(INCOME_CATS))
-        return
+async def debts_export(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await export_debts_csv(m.lid, context, m.chat_id)
 
-    if flow.get("stage") == "choose_expense" and txt in EXPENSE_CATS:
-        set_flow(context, {"stage":"await_amount", "ttype":"expense", "category":txt})
-        await update.message.reply_text(f"Введите сумму для «{txt}» (например: 25000 или 20 usd).",
-                                        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)]], resize_keyboard=True))
-        return
+async def debts_menu_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await reply_transient(update, context, "Выберите действие:", reply_markup=debts_menu_kb())
 
-    if flow.get("stage") == "choose_income" and txt in INCOME_CATS:
-        set_flow(context, {"stage":"await_amount", "ttype":"income", "category":txt})
-        await update.message.reply_text(f"Введите сумму для «{txt}» (например: 25000 или 20 usd).",
-                                        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BACK_BTN)]], resize_keyboard=True))
-        return
+# ---------- Budget dialog ----------
+async def budget_start(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    set_budget_state(context, {"stage":"choose_cat"})
+    await reply_transient(update, context, "Выберите категорию для бюджета:", reply_markup=build_categories_kb(EXPENSE_CATS))
 
-    if flow.get("stage") == "await_amount":
-        amount = parse_amount(txt)
-        if not amount:
-            await update.message.reply_text("Введите корректную сумму, например: 25000 или 20 usd.")
-            return
-        currency = detect_currency(txt)
-        ttype = flow.get("ttype")
-        category = flow.get("category")
-        tx_id = add_tx(uid, ttype, amount, currency, category, "")
-        set_last_action(context, uid, {"type":"tx_add", "tx_id": tx_id})
-        await update.message.reply_text(f"✅ Сохранено: {('+' if ttype=='income' else '-')}{fmt_amount(amount, currency)} [{category}]")
-        if ttype == "expense":
-            for _, cat, curcy, limit_amt, period, active in budget_list(uid):
-                if active == 1 and period == "month" and cat == category and curcy == currency and limit_amt > 0:
-                    spent = month_expenses_in_category(uid, category, currency)
-                    util = spent / limit_amt
-                    if 0.8 <= util < 1.0:
-                        await update.message.reply_text(f"⚠️ Достигнуто 80% бюджета по «{category}». Потрачено {fmt_amount(spent, currency)} из {fmt_amount(limit_amt, currency)}.")
-                    if util >= 1.0:
-                        await update.message.reply_text(f"⛔️ Бюджет по «{category}» исчерпан. Потрачено {fmt_amount(spent, currency)} из {fmt_amount(limit_amt, currency)}.")
-                    break
-        clear_flow(context)
-        await send_and_pin_summary(update, context)
-        await update.message.reply_text("Главное меню.", reply_markup=MAIN_KB)
-        return
+BUDGET_PERIODS = {"Месяц": "month", "Неделя": "week", "30 дней": "rolling:30", "Свой период": None}
+
+async def budget_pick_category(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    set_budget_state(context, {"stage":"choose_period", "category":m.txt})
+    await reply_transient(update, context, f"За какой период бюджет «{m.txt}»?", reply_markup=build_categories_kb(list(BUDGET_PERIODS)))
 
-    # ---------- Simple buttons ----------
-    if txt == BALANCE_BTN:
-        await balance_cmd(update, context)
+async def budget_ask_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str, period: str):
+    set_budget_state(context, {"stage":"await_amount", "category":category, "period":period})
+    await reply_transient(update, context, f"Введите лимит и валюту для «{category}» ({budget_period_label(period)}), например: 5 000 000 uzs или 300 usd.",
+                                    reply_markup=BACK_KB)
+
+async def budget_pick_period(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    period = BUDGET_PERIODS[m.txt]
+    if period is None:
+        set_budget_state(context, {"stage":"await_window", "category":m.state.get("category")})
+        await reply_transient(update, context, f"Введите даты (например: 01.11-15.11) или число дней скользящего окна (до {BUDGET_MAX_DAYS}).",
+                                        reply_markup=BACK_KB)
+        return
+    await budget_ask_amount(update, context, m.state.get("category"), period)
+
+async def budget_period_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await reply_transient(update, context, "Выберите период:", reply_markup=build_categories_kb(list(BUDGET_PERIODS)))
+
+def parse_budget_window(txt: str, tz: Optional[ZoneInfo] = None) -> Optional[str]:
+    """Budget period for "N" (rolling:N) or "dd.mm[.yy]-dd.mm[.yy]" (custom:first:last);
+    None if invalid or reaching further than BUDGET_MAX_DAYS."""
+    txt = txt.strip()
+    today = local_day(ts_now(), tz)
+    if txt.isdigit():
+        days = int(txt)
+        return f"rolling:{days}" if 1 <= days <= BUDGET_MAX_DAYS else None
+    parts = re.split(r"\s*[-–—]\s*", txt)
+    if len(parts) != 2:
+        return None
+    year = datetime.now(tz or TIMEZONE).year
+    dates = [parse_date_local(p if p.count(".") == 2 else f"{p}.{year}", tz) for p in parts]
+    if None in dates:
+        return None
+    first, last = (local_day(int(d.timestamp()), tz) for d in dates)
+    if last < first or last - first + 1 > BUDGET_MAX_DAYS or first < today - BUDGET_MAX_DAYS:
+        return None
+    return f"custom:{first}:{last}"
+
+async def budget_window_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    period = parse_budget_window(m.txt, ledger_tz(m.lid))
+    if period is None:
+        await reply_transient(update, context, f"Не понял период. Например: 01.11-15.11 или 45 (дней, до {BUDGET_MAX_DAYS}).")
         return
-    if txt == HISTORY_BTN:
-        await history_cmd(update, context)
+    await budget_ask_amount(update, context, m.state.get("category"), period)
+
+async def budget_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    amount = parse_amount(m.txt)
+    if not amount:
+        await reply_transient(update, context, "Введите число, например: 5 000 000 uzs")
         return
-    if txt == REPORT_BTN:
-        kb = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("Неделя", callback_data="report:week"),
-              InlineKeyboardButton("Месяц", callback_data="report:month"),
-              InlineKeyboardButton("Квартал", callback_data="report:quarter")]]
-        )
-        await cleanup_prev_msgs(update, context); remember_user_msg(update, context)
-        msg = await update.message.reply_text("Выберите период отчёта:", reply_markup=kb)
-        remember_bot_msg(context, msg.message_id)
+    currency = detect_currency(m.txt)
+    category = m.state.get("category")
+    period = m.state.get("period", "month")
+    budget_set(m.uid, category, currency, amount, period, lid=m.lid)
+    await reply_transient(update, context, f"✅ Бюджет сохранён: {category} — {fmt_amount(amount, currency)}{base_hint(amount, currency)} / {budget_period_label(period)}.")
+    clear_budget_state(context)
+
+# ---------- Transaction dialog ----------
+async def flow_start(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    if m.key == EXPENSE_BTN:
+        set_flow(context, {"stage":"choose_expense"})
+        await reply_transient(update, context, "Выберите категорию расхода:", reply_markup=build_categories_kb(EXPENSE_CATS))
+    else:
+        set_flow(context, {"stage":"choose_income"})
+        await reply_transient(update, context, "Выберите категорию дохода:", reply_markup=build_categories_kb(INCOME_CATS))
+
+async def flow_pick_category(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    ttype = "expense" if m.state.get("stage") == "choose_expense" else "income"
+    set_flow(context, {"stage":"await_amount", "ttype":ttype, "category":m.txt})
+    await reply_transient(update, context, f"Введите сумму для «{m.txt}» (например: 25000 или 20 usd).", reply_markup=BACK_KB)
+
+async def check_budget_alert(update: Update, lid: int, category: str, currency: str):
+    for _, cat, curcy, limit_amt, period, active in budget_list(lid):
+        if active == 1 and cat == category and curcy == currency and limit_amt > 0:
+            tz = ledger_tz(lid)
+            first, last = budget_window(period, tz)
+            if not first <= local_day(ts_now(), tz) <= last:
+                break
+            spent = budget_spent(lid, category, currency, period)
+            util = spent / limit_amt
+            label = budget_period_label(period)
+            if 0.8 <= util < 1.0:
+                await update.message.reply_text(f"⚠️ Достигнуто 80% бюджета по «{category}» ({label}). Потрачено {fmt_amount(spent, currency)} из {fmt_amount(limit_amt, currency)}{base_hint(limit_amt, currency)}.")
+            if util >= 1.0:
+                await update.message.reply_text(f"⛔️ Бюджет по «{category}» ({label}) исчерпан. Потрачено {fmt_amount(spent, currency)} из {fmt_amount(limit_amt, currency)}{base_hint(limit_amt, currency)}.")
+            break
+
+async def flow_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    amount = parse_amount(m.txt)
+    if not amount:
+        await reply_transient(update, context, "Введите корректную сумму, например: 25000 или 20 usd.")
         return
-    if txt == EXPORT_BTN:
-        await export_month_csv(uid, context, chat_id)
+    currency = detect_currency(m.txt)
+    ttype = m.state.get("ttype")
+    category = m.state.get("category")
+    tx_id = await add_tx(m.uid, ttype, amount, currency, category, "", lid=m.lid)
+    set_last_action(context, m.uid, {"type":"tx_add", "tx_id": tx_id})
+    await reply_transient(update, context, f"✅ Сохранено: {('+' if ttype=='income' else '-')}{fmt_amount(amount, currency)} [{category}]")
+    if ttype == "expense":
+        await check_budget_alert(update, m.lid, category, currency)
+    clear_flow(context)
+    await send_and_pin_summary(update, context)
+    await reply_transient(update, context, "Главное меню.", reply_markup=MAIN_KB)
+
+# ---------- Menu buttons and free text ----------
+async def report_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    kb = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Неделя", callback_data="report:week"),
+          InlineKeyboardButton("Месяц", callback_data="report:month"),
+          InlineKeyboardButton("Квартал", callback_data="report:quarter")],
+         [InlineKeyboardButton("📈 Неделя", callback_data="report:week:chart"),
+          InlineKeyboardButton("📈 Месяц", callback_data="report:month:chart"),
+          InlineKeyboardButton("📈 Квартал", callback_data="report:quarter:chart")]]
+    )
+    await cleanup_prev_msgs(update, context); remember_user_msg(update, context)
+    msg = await update.message.reply_text("Выберите период отчёта:", reply_markup=kb)
+    remember_bot_msg(context, msg.message_id)
+
+async def export_month(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    await export_month_csv(m.lid, context, m.chat_id)
+
+BATCH_MAX_LINES = 50
+
+def parse_batch_lines(txt: str) -> Tuple[List[Tuple[float, str, str]], List[str]]:
+    """Each non-empty line of a pasted list as (amount, currency, note); lines without an
+    amount are returned separately."""
+    rows, skipped = [], []
+    for line in txt.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        amount = parse_amount(line)
+        if amount:
+            rows.append((amount, detect_currency(line), line))
+        else:
+            skipped.append(line)
+    return rows, skipped
+
+async def free_text_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    rows, skipped = parse_batch_lines(m.txt)
+    if not rows:
+        await reply_transient(update, context, "Не понял. Выберите действие.", reply_markup=MAIN_KB)
         return
-    if txt == SETTINGS_BTN or txt == "/settings":
-        await settings_cmd(update, context)
+    if len(rows) > BATCH_MAX_LINES:
+        await reply_transient(update, context, f"Слишком длинный список: не больше {BATCH_MAX_LINES} строк за раз.")
         return
+    category = "Прочее"
+    tx_ids = await add_txs(m.uid, [("expense", amount, currency, category, note) for amount, currency, note in rows], lid=m.lid)
+    set_last_action(context, m.uid, {"type":"tx_batch", "tx_ids": tx_ids})
+    totals: Dict[str, float] = {}
+    lines = [f"✅ Сохранено операций: {len(rows)} [{category}]"]
+    for amount, currency, note in rows:
+        totals[currency] = totals.get(currency, 0.0) + amount
+        lines.append(f"• -{fmt_amount(amount, currency)} {note}")
+    lines.append("Итого: " + " | ".join(f"-{fmt_amount(v, cur)}" for cur, v in sorted(totals.items())))
+    if skipped:
+        lines.append("Без суммы, пропущено: " + "; ".join(skipped[:5]) + (" …" if len(skipped) > 5 else ""))
+    lines.append(f"{CANCEL_BTN} — отменить весь список.")
+    await reply_transient(update, context, "\n".join(lines))
+    await send_and_pin_summary(update, context)
 
-    # ---------- Free-form fallback ----------
-    amount = parse_amount(txt)
+async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE, m: TextMsg):
+    if "\n" in m.txt:
+        await free_text_batch(update, context, m)
+        return
+    amount = parse_amount(m.txt)
     if amount:
-        currency = detect_currency(txt)
+        currency = detect_currency(m.txt)
         ttype = "expense"
         category = "Прочее"
-        tx_id = add_tx(uid, ttype, amount, currency, category, txt)
-        set_last_action(context, uid, {"type":"tx_add", "tx_id": tx_id})
-        await update.message.reply_text(f"✅ Сохранено: -{fmt_amount(amount, currency)} [{category}]")
+        tx_id = await add_tx(m.uid, ttype, amount, currency, category, m.txt, lid=m.lid)
+        set_last_action(context, m.uid, {"type":"tx_add", "tx_id": tx_id})
+        await reply_transient(update, context, f"✅ Сохранено: -{fmt_amount(amount, currency)} [{category}]")
         await send_and_pin_summary(update, context)
         return
+    await reply_transient(update, context, "Не понял. Выберите действие.", reply_markup=MAIN_KB)
 
-    await update.message.reply_text("Не понял. Выберите действие.", reply_markup=MAIN_KB)
+# ---------- Routing tables ----------
+BUTTON_ALIASES = {  # lowercased input -> canonical button text
+    "+ я должен": "➕ Я должен", "➕ я должен": "➕ Я должен",
+    "+ мне должны": "➕ Мне должны", "➕ мне должны": "➕ Мне должны",
+}
+DEBTS_MENU_ROUTES = {
+    "➕ Я должен": debts_add_start, "➕ Мне должны": debts_add_start,
+    "📜 Мне должны": debts_list, "📜 Я должен": debts_list,
+    "✖️ Закрыть долг": debts_close_start, "➖ Уменьшить долг": debts_reduce_start,
+    DEBTS_BY_PERSON_BTN: debts_by_person, "Экспорт долгов 📂": debts_export,
+    DEBTS_BTN: open_debts_menu, "Долги": open_debts_menu,
+    None: debts_menu_prompt,
+}
+# (dialog, stage) -> handler taking any text, or {exact text: handler} (None = any other text;
+# without it unmatched text falls through to lower-precedence routes)
+FSM_ROUTES: Dict[Tuple[str, str], Any] = {
+    ("debts", "menu"): DEBTS_MENU_ROUTES,
+    ("debts", "await_amount"): debt_amount_step,
+    ("debts", "await_counterparty"): debt_counterparty_step,
+    ("debts", "reduce_ask_id"): debt_reduce_id_step,
+    ("debts", "reduce_ask_amount"): debt_reduce_amount_step,
+    ("budget", "choose_cat"): {cat: budget_pick_category for cat in EXPENSE_CATS},
+    ("budget", "choose_period"): {**{p: budget_pick_period for p in BUDGET_PERIODS}, None: budget_period_prompt},
+    ("budget", "await_window"): budget_window_step,
+    ("budget", "await_amount"): budget_amount_step,
+    ("flow", "choose_expense"): {cat: flow_pick_category for cat in EXPENSE_CATS},
+    ("flow", "choose_income"): {cat: flow_pick_category for cat in INCOME_CATS},
+    ("flow", "await_amount"): flow_amount_step,
+}
+FSM_RANKS = (("debts", 10), ("budget", 30), ("flow", 50))
+FSM_BACK = {fsm: back_route(fsm) for fsm, _ in FSM_RANKS}
+BUTTON_ROUTES: Dict[str, Tuple[int, Any]] = {  # text -> (rank, handler)
+    CANCEL_BTN: (0, command_route(undo_last)),
+    DEBTS_BTN: (20, open_debts_menu), "Долги": (20, open_debts_menu),
+    BUDGET_BTN: (35, budget_start),
+    EXPENSE_BTN: (40, flow_start), INCOME_BTN: (40, flow_start),
+    BALANCE_BTN: (60, command_route(balance_cmd)),
+    HISTORY_BTN: (60, command_route(history_cmd)),
+    REPORT_BTN: (60, report_menu),
+    EXPORT_BTN: (60, export_month),
+    SETTINGS_BTN: (60, command_route(settings_cmd)), "/settings": (60, command_route(settings_cmd)),
+}
+DEBTS_KEYWORD = (20, open_debts_menu)  # any text mentioning "долг" opens the debts menu
+
+def resolve_text_route(m: TextMsg, user_data: dict):
+    """Handler for the message: the button route unless an active dialog outranks it."""
+    btn = BUTTON_ROUTES.get(m.key)
+    if btn is None and "долг" in m.low:
+        btn = DEBTS_KEYWORD
+    for fsm, rank in FSM_RANKS:
+        if btn is not None and btn[0] < rank:
+            break
+        state = user_data.get(fsm)
+        if not state:
+            continue
+        if m.txt == BACK_BTN:
+            return FSM_BACK[fsm]
+        route = FSM_ROUTES.get((fsm, state.get("stage")))
+        if isinstance(route, dict):
+            route = route.get(m.key) or route.get(None)
+        if route is not None:
+            m.state = state
+            return route
+    return btn[1] if btn is not None else free_text
+
+@trace_handler("text_router")
+async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    txt = (update.message.text or "").strip()
+    if chat.type in {"group", "supergroup"} and get_chat_settings(chat.id).get("group_silent", 1):
+        bot_username = (context.bot.username or "").lower()
+        mentioned = bool(bot_username and f"@{bot_username}" in txt.lower())
+        reply = update.message.reply_to_message
+        is_reply_to_bot = bool(reply and reply.from_user and reply.from_user.is_bot)
+        if not (txt.startswith("/") or mentioned or is_reply_to_bot):
+            return
+
+    if ALLOWED_USER_IDS and update.effective_user.id not in ALLOWED_USER_IDS:
+        await update.message.reply_text("Доступ запрещён.")
+        return
+
+    tap = txt if txt in READ_BUTTONS else None
+    if not await admit(update, tap, tap is not None):
+        return
+    m = TextMsg(txt, update.effective_user.id, current_ledger(update), chat.id)
+    await resolve_text_route(m, context.user_data)(update, context, m)
+    remember_user_msg(update, context)  # after the handler: its own cleanup must not take this message
 
 # -------- Debts list + inline manage --------
+DEBTS_PAGE_SIZE = 15
+DEBT_LIST_TITLES = {"owed": "Мне должны:", "owes": "Я должен:", "net": "Долги по людям (итог):"}
+
 def debts_inline_kb(rows: List[tuple]) -> InlineKeyboardMarkup:
     btn_rows = []
-    for did, amount, currency, name, created_ts in rows[:10]:
+    for did, *_ in rows[:10]:
         btn_rows.append([
             InlineKeyboardButton(f"Закрыть #{did}", callback_data=f"debt_close:{did}"),
             InlineKeyboardButton(f"➖ #{did}", callback_data=f"debt_reduce:{did}")
         ])
     return InlineKeyboardMarkup(btn_rows) if btn_rows else InlineKeyboardMarkup([])
 
+def net_debt_line(name: str, total: float, currency: str) -> str:
+    if total > 0:
+        return f"{name} должен мне {fmt_amount(total, currency)}"
+    return f"Я должен {name} {fmt_amount(-total, currency)}"
+
+def build_debts_page(lid: int, mode: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """One page of open debts grouped per person; mode is "owes", "owed" or "net"."""
+    rows = debt_groups(lid, None if mode == "net" else mode, DEBTS_PAGE_SIZE + 1, page * DEBTS_PAGE_SIZE)
+    more, rows = len(rows) > DEBTS_PAGE_SIZE, rows[:DEBTS_PAGE_SIZE]
+    title = DEBT_LIST_TITLES[mode]
+    if not rows:
+        return title + "\nСписок пуст.", InlineKeyboardMarkup([])
+    lines = [title if not page else f"{title} (стр. {page + 1})"]
+    buttons, row = [], []
+    for i, (cp_id, name, currency, total, n) in enumerate(rows, page * DEBTS_PAGE_SIZE + 1):
+        name = name or "-"
+        if mode == "net":
+            lines.append(f"{i}. {net_debt_line(name, total, currency)}")
+        else:
+            lines.append(f"{i}. {name} — {fmt_amount(total, currency)}" + (f" ({n} долг.)" if n > 1 else ""))
+        row.append(InlineKeyboardButton(f"{i}. {name[:16]}", callback_data=f"dcp:{cp_id}:{mode}"))
+        if len(row) == 3:
+            buttons.append(row); row = []
+    if row: buttons.append(row)
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("⬅️", callback_data=f"dls:{mode}:{page - 1}"))
+    if more: nav.append(InlineKeyboardButton("➡️", callback_data=f"dls:{mode}:{page + 1}"))
+    if nav: buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+def build_counterparty_text(lid: int, cp_id: int, mode: str) -> Tuple[str, InlineKeyboardMarkup]:
+    name, debts, payments = counterparty_debts(lid, cp_id)
+    back = [InlineKeyboardButton("⬅️ К списку", callback_data=f"dls:{mode}:0")]
+    if name is None:
+        return "Контрагент не найден.", InlineKeyboardMarkup([back])
+    net: Dict[str, float] = {}
+    for _, direction, amount, currency, _ in debts:
+        net[currency] = net.get(currency, 0.0) + (amount if direction == "owed" else -amount)
+    lines = [f"👤 {name}"]
+    lines += [f"Итог: {net_debt_line(name, v, cur)}" for cur, v in sorted(net.items()) if abs(v) > 1e-4]
+    dates = iter(fmt_times([d[4] for d in debts] + [p[3] for p in payments], ledger_tz(lid), with_time=False))
+    if debts:
+        lines.append("\nОткрытые долги:")
+        for did, direction, amount, currency, _ in debts:
+            arrow = "мне должен" if direction == "owed" else "я должен"
+            lines.append(f"#{did} {arrow} {fmt_amount(amount, currency)} ({next(dates)})")
+    else:
+        lines.append("Открытых долгов нет.")
+    if payments:
+        lines.append("\nПоследние платежи:")
+        for did, amount, currency, _ in payments:
+            lines.append(f"#{did} −{fmt_amount(amount, currency)} ({next(dates)})")
+    kb = debts_inline_kb(debts).inline_keyboard
+    return "\n".join(lines), InlineKeyboardMarkup([*kb, back])
+
 async def show_debts_list(update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str):
-    uid = update.effective_user.id
+    lid = current_ledger(update)
     await cleanup_prev_msgs(update, context); remember_user_msg(update, context)
-    rows = debts_open(uid, direction)
-    title = "Список должников:" if direction == "owed" else "Список моих долгов:"
-    if not rows:
-        msg = await update.message.reply_text(title + "\nСписок пуст.", reply_markup=debts_menu_kb())
-        remember_bot_msg(context, msg.message_id)
-        return
-    lines = [title]
-    for did, amount, currency, name, created_ts in rows:
-        lines.append(f"#{did} {name or '-'} — {fmt_amount(amount, currency)} ({datetime.fromtimestamp(created_ts, tz=TIMEZONE).strftime('%d.%m.%Y')})")
-    msg = await update.message.reply_text("\n".join(lines), reply_markup=debts_menu_kb())
+    text, kb = build_debts_page(lid, direction, 0)
+    msg = await update.message.reply_text(text, reply_markup=kb if kb.inline_keyboard else debts_menu_kb())
     remember_bot_msg(context, msg.message_id)
-    await update.message.reply_text("Управление долгами:", reply_markup=debts_inline_kb(rows))
+
+# ---------------- Inline mode ----------------
+# "@bot" alone answers with the balance card, "@bot 25000 такси" with quick-add articles:
+# an expense in the guessed category and an income. Picking one posts its text to the
+# current chat; the chosen_inline_result update then records the transaction in the user's
+# personal ledger, so inline feedback must be on (BotFather /setinlinefeedback). Telegram
+# re-sends the query on every keystroke: answers are kept per (user, query) for
+# INLINE_CACHE_SECONDS and Telegram is asked to cache them per user as long. The balance
+# card, the only part that reads storage, is shared by all of a user's queries.
+INLINE_CACHE_MAX = 4096
+
+class InlineCache:
+    """TTL entries keyed by (uid, ...), least recently used evicted beyond max_entries."""
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: tuple) -> Any:
+        hit = self.entries.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return hit[1]
+
+    def put(self, key: tuple, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def drop_user(self, uid: int):
+        for key in [k for k in self.entries if k[0] == uid]:
+            del self.entries[key]
+
+INLINE = InlineCache(INLINE_CACHE_SECONDS, INLINE_CACHE_MAX)
+
+def guess_category(txt: str, cats: List[str]) -> int:
+    """Index in cats of the first category a word of txt abbreviates ("трансп", "еда"); the
+    last one ("Прочее") otherwise."""
+    words = [w for w in re.findall(r"[^\W\d_]+", txt.lower()) if len(w) >= 3]
+    for i, cat in enumerate(cats[:-1]):
+        if any(cat.lower().startswith(w) for w in words):
+            return i
+    return len(cats) - 1
+
+def inline_card(uid: int, lid: int) -> str:
+    card = INLINE.get((uid, None))
+    if card is None:
+        card = build_balance_summary(lid)
+        INLINE.put((uid, None), card)
+    return card
+
+def inline_results(uid: int, lid: int, query: str) -> list:
+    card = inline_card(uid, lid)
+    first = card.split("\n", 3)
+    card_result = InlineQueryResultArticle(
+        id="card", title=BALANCE_BTN, description=first[2] if len(first) > 2 else "",
+        input_message_content=InputTextMessageContent(card))
+    amount = parse_amount(query.lstrip("+"))  # "+500000 зарплата" puts the income first
+    if not amount:
+        return [card_result]
+    currency = detect_currency(query)
+    results = []
+    for ttype, cats, sign, label in (("expense", EXPENSE_CATS, "-", "Расход"), ("income", INCOME_CATS, "+", "Доход")):
+        i = guess_category(query, cats)
+        results.append(InlineQueryResultArticle(
+            id=f"{ttype}:{i}", title=f"{label}: {sign}{fmt_amount(amount, currency)} [{cats[i]}]", description=query,
+            input_message_content=InputTextMessageContent(f"✅ {sign}{fmt_amount(amount, currency)} [{cats[i]}] {query}")))
+    if query.startswith("+"):
+        results.reverse()
+    return results + [card_result]
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.inline_query
+    uid = q.from_user.id
+    if ALLOWED_USER_IDS and uid not in ALLOWED_USER_IDS:
+        await q.answer([], cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+        return
+    query = " ".join(q.query.split())
+    results = INLINE.get((uid, query))
+    if results is None:
+        metric_inc("inline_cache_misses_total")
+        results = inline_results(uid, current_ledger(update), query)
+        INLINE.put((uid, query), results)
+    await q.answer(results, cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+
+async def inline_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    r = update.chosen_inline_result
+    uid = r.from_user.id
+    ttype, _, idx = r.result_id.partition(":")
+    cats = {"expense": EXPENSE_CATS, "income": INCOME_CATS}.get(ttype)
+    query = " ".join(r.query.split())
+    amount = parse_amount(query.lstrip("+"))
+    if cats is None or not amount or (ALLOWED_USER_IDS and uid not in ALLOWED_USER_IDS):
+        return
+    category = cats[int(idx)] if idx.isdigit() and int(idx) < len(cats) else cats[-1]
+    tx_id = await add_tx(uid, ttype, amount, detect_currency(query), category, query, lid=current_ledger(update))
+    set_last_action(context, uid, {"type":"tx_add", "tx_id": tx_id})
+    INLINE.drop_user(uid)
 
 # ---------------- Main ----------------
-def build_app(token: str) -> Application:
-    app = Application.builder().token(token).build()
+def build_app(token: str, request=None) -> Application:
+    """`request` replaces the HTTPX transport for Bot API calls (benchmarks/handlers.py)."""
+    from updates import PerUserUpdateProcessor
+    builder = Application.builder().token(token).concurrent_updates(
+        PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_PENDING_LIMIT, METRICS, observe=USAGE.observe)
+    ).request(request or traced_request(connection_pool_size=256))
+    if BOT_API_BASE_URL:
+        base = BOT_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, count_update), group=-2)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("balance", balance_cmd))
     app.add_handler(CommandHandler("history", history_cmd))
     app.add_handler(CommandHandler("settings", settings_cmd))
+    app.add_handler(CommandHandler("find", find_cmd))
+    app.add_handler(CommandHandler("fx", fx_cmd))
+    app.add_handler(CommandHandler("ledger", ledger_cmd))
+    app.add_handler(CommandHandler("tz", tz_cmd))
+    app.add_handler(CommandHandler("backup", backup_cmd))
+    app.add_handler(CommandHandler("restore", restore_cmd))
+    app.add_handler(CommandHandler("export_user", export_user_cmd))
+    app.add_handler(CommandHandler("admin_stats", admin_stats_cmd))
     app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(InlineQueryHandler(inline_query))
+    app.add_handler(ChosenInlineResultHandler(inline_chosen))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
     return app
 
+def prepare_storage():
+    init_db()
+    n = load_fx_file()
+    if n: log.info(f"Loaded {n} FX rates from {FX_RATES_PATH}")
+    if not FX.loaded: FX.load()
+
+def boot():
+    """Schema migrations and FX loading run in a thread while telegram is imported;
+    sqlite releases the GIL, so the two mostly overlap."""
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        storage = ex.submit(prepare_storage)
+        load_telegram()
+        storage.result()
+
 def main():
     token = os.environ.get("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN is not set in environment variables")
-    Thread(target=run_health_server, daemon=True).start()
+    if SHARDS > 1 and SHARD_INDEX < 0:
+        import shards
+        shards.run_front(token, SHARDS, PORT, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+                         WEBHOOK_MAX_CONNECTIONS, UPDATE_PENDING_LIMIT, BOT_API_BASE_URL, DB_BASE_PATH)
+        return
+    boot()
     app = build_app(token)
-    log.info("Starting polling")
-    app.run_polling(drop_pending_updates=True)
+    if SHARD_INDEX >= 0:
+        app.job_queue.run_repeating(fx_reload_job, interval=300, first=300, name="fx_reload")
+    # hourly at :10; each zone's ledgers are recomputed on the first run after their midnight
+    app.job_queue.run_repeating(insights_job, interval=3600, first=(600 - ts_now()) % 3600 or 3600, name="insights")
+    app.job_queue.run_once(insights_job, when=30, name="insights_boot")
+    app.job_queue.run_daily(archive_job, time=dtime(3, 30, tzinfo=TIMEZONE), name="archive")
+    app.job_queue.run_repeating(digest_job, interval=3600, first=60, name="digest")
+    if STATS_EVERY_MINUTES > 0:
+        app.job_queue.run_repeating(stats_job, interval=STATS_EVERY_MINUTES * 60, first=60, name="stats")
+    if BACKUP_EVERY_HOURS > 0:
+        app.job_queue.run_repeating(backup_job, interval=BACKUP_EVERY_HOURS * 3600, first=120, name="backup")
+    asyncio.run(run_bot(app))
 
 if __name__ == "__main__":
     main()
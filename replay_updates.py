@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Replay recorded Telegram Update JSON against a running bot in webhook mode.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=dev python main.py
+    python replay_updates.py updates.jsonl --secret dev [--url http://127.0.0.1:8080/telegram] [--concurrency 8]
+
+The input holds one Update object per line (a JSON array is accepted too).
+"""
+import argparse, asyncio, json, os, time
+
+import httpx
+
+def load_updates(path: str):
+    with open(path, encoding="utf-8") as f:
+        raw = f.read().strip()
+    if raw.startswith("["):
+        return json.loads(raw)
+    return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+async def replay(updates, url: str, secret: str, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(u):
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.post(url, json=u, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                latencies.append((time.perf_counter() - t0) * 1000)
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        total = time.perf_counter() - t0
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+    print(f"sent={len(updates)} in {total:.2f}s ({len(updates) / max(total, 1e-9):.0f}/s) statuses={statuses}")
+    print(f"latency ms: p50={pct(0.5):.1f} p95={pct(0.95):.1f} max={pct(1.0):.1f}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("file")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('PORT', '8080')}/{os.environ.get('WEBHOOK_PATH', 'telegram').strip('/')}")
+    ap.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET", ""))
+    ap.add_argument("--concurrency", type=int, default=8)
+    args = ap.parse_args()
+    asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.concurrency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Sharded deployment: one front process, N bot workers, one SQLite file per worker.
+
+    SHARDS=4 BOT_TOKEN=... python main.py
+
+With SHARDS > 1 main() runs the front instead of a bot. The front receives updates
+(getUpdates or the webhook, as BOT_MODE says) and forwards each one to a worker over a
+Unix socket, into the worker's ordinary webhook handler. Workers are `python main.py`
+processes started with SHARD_INDEX (and restarted if they exit): each owns its SQLite file
+(DB_PATH with ".shard<i>" before the extension), archive and backup directories, caches
+and jobs, and calls the Bot API itself.
+
+Routing: updates from a group with a shared ledger (/ledger) go to the group's shard, where
+that ledger lives; everything else, personal entries made in other groups included, to the
+user's. The shard is the id modulo SHARDS. The front reads the enabled groups from the shard
+files at start and every minute. A group's /ledger command is forwarded to the group's shard
+and processed before the reply (X-Shard-Wait); the group's later updates are held until then
+and routed by the new state. Changing SHARDS moves users to other files, and nothing here
+migrates them. A worker's updates are forwarded one at a time in arrival order, which keeps
+each user's updates ordered. Nothing the front receives waits on a worker: past its queue
+an update goes to the worker's overflow (in order), and past that, or past queue_limit
+updates held behind one /ledger, it is dropped and counted. The webhook answers 503 instead,
+so Telegram redelivers.
+
+The front serves /healthz (every worker alive) and /metrics (its own counters plus every
+worker's, labelled by shard). Cross-shard reads and writes (/admin_stats, /backup now,
+/export_user, FX rates) open the other shards' files from main through shard_db_path.
+
+Only the path helpers are imported by main; httpx and tornado load when the front runs.
+"""
+import asyncio, json, logging, os, secrets, signal, sqlite3, subprocess, sys, tempfile, time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+log = logging.getLogger("front")
+
+ALLOWED_UPDATES = ["message", "edited_message", "channel_post", "edited_channel_post", "inline_query",
+                   "chosen_inline_result", "callback_query", "shipping_query", "pre_checkout_query", "poll",
+                   "poll_answer", "my_chat_member", "chat_member", "chat_join_request"]
+GROUP_TYPES = {"group", "supergroup"}
+OVERFLOW_QUEUES = 10  # a worker's overflow holds this many queue_limits
+
+def shard_of(key: int, shards: int) -> int:
+    return key % shards if shards > 1 else 0
+
+def shard_db_path(path: str, index: int) -> str:
+    """finance.db -> finance.shard2.db; index < 0 (unsharded) keeps the path."""
+    if index < 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+def shard_dir(path: str, index: int) -> str:
+    return path if index < 0 else os.path.join(path, f"shard{index}")
+
+def group_chat(update: dict) -> Optional[int]:
+    """The chat id of an update from a group or supergroup."""
+    for value in update.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"] if chat.get("type") in GROUP_TYPES else None
+    return None
+
+def is_ledger_toggle(update: dict) -> bool:
+    """A /ledger command sent (or edited) in a group."""
+    msg = update.get("message") or update.get("edited_message") or {}
+    if (msg.get("chat") or {}).get("type") not in GROUP_TYPES:
+        return False
+    words = (msg.get("text") or "").split()
+    return bool(words) and words[0].split("@")[0].lower() == "/ledger"
+
+def route_key(update: dict, group_ledgers: Set[int] = frozenset()) -> int:
+    """The chat id for a group with a shared ledger, else the sender's user id; the chat id
+    for updates without a sender (0 if neither)."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and chat["id"] in group_ledgers:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        if chat:
+            return chat["id"]
+    return 0
+
+def group_ledgers_in(db_path: str) -> Set[int]:
+    """Groups with a shared ledger stored in one shard's file (none before its first start)."""
+    if not os.path.exists(db_path):
+        return set()
+    try:
+        con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5)
+        try:
+            return {r[0] for r in con.execute("SELECT id FROM ledgers WHERE kind='group'")}
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        log.warning(f"Reading group ledgers from {db_path} failed: {e}")
+        return set()
+
+def _die_with_parent():
+    """Workers get SIGTERM when the front dies (Linux), so none keeps running orphaned."""
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6", use_errno=True).prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except Exception:
+        pass
+
+class Worker:
+    def __init__(self, index: int, socket_path: str, env: Dict[str, str], queue_limit: int, metrics: Dict[str, float]):
+        import httpx
+        self.index = index
+        self.socket_path = socket_path
+        self.env = env
+        self.metrics = metrics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_limit)  # (body, chat toggling /ledger or None)
+        self.overflow: Deque[Tuple[bytes, Optional[int]]] = deque()  # behind a full queue, same order
+        self.overflow_limit = queue_limit * OVERFLOW_QUEUES
+        self.client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=socket_path), timeout=30)
+        self.proc: Optional[subprocess.Popen] = None
+        self.on_toggled: Optional[Callable[[int], Awaitable[None]]] = None
+        self.releases: Set[asyncio.Task] = set()
+
+    def spawn(self):
+        main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        self.proc = subprocess.Popen([sys.executable, main_py], env=self.env, preexec_fn=_die_with_parent)
+        log.info(f"Shard {self.index}: worker pid {self.proc.pid}")
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def inc(self, name: str):
+        self.metrics[name] = self.metrics.get(name, 0) + 1
+
+    def put(self, body: bytes, toggling: Optional[int] = None) -> bool:
+        """Queue an update without waiting; False if the overflow is full too and it was dropped."""
+        if not self.overflow and not self.queue.full():
+            self.queue.put_nowait((body, toggling))
+            return True
+        if len(self.overflow) >= self.overflow_limit:
+            self.inc("front_overflow_dropped_total")
+            return False
+        self.overflow.append((body, toggling))
+        return True
+
+    def backlog(self) -> int:
+        return self.queue.qsize() + len(self.overflow)
+
+    async def run(self, secret: str, path: str):
+        """Forward queued updates in order. While the worker is down (starting, restarting) or
+        answers 5xx, the head update is retried with backoff; only one the worker rejects as
+        malformed or unauthorized (4xx, retrying cannot help) is logged and dropped."""
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+        delay = 0.05
+        while True:
+            body, toggling = await self.queue.get()
+            while self.overflow and not self.queue.full():
+                self.queue.put_nowait(self.overflow.popleft())
+            h = {**headers, "X-Shard-Wait": "1"} if toggling is not None else headers
+            while True:
+                try:
+                    # a waited-for update returns once processed: no read timeout, or a slow
+                    # backlog would have it forwarded (and applied) twice
+                    r = await self.client.post(f"http://shard{path}", content=body, headers=h,
+                                               timeout=None if toggling is not None else 30)
+                except Exception:
+                    r = None
+                if r is None or r.status_code >= 500:
+                    self.inc("front_forward_retries_total")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 2.0)
+                    continue
+                delay = 0.05
+                if r.status_code != 200:
+                    self.inc("front_forward_dropped_total")
+                    log.warning(f"Shard {self.index} rejected an update, dropped: HTTP {r.status_code}")
+                else:
+                    self.inc("front_forwarded_total")
+                break
+            if toggling is not None and self.on_toggled:
+                # in a task: the held updates may be queued back here, and this loop drains the queue
+                t = asyncio.get_running_loop().create_task(self.on_toggled(toggling))
+                self.releases.add(t)
+                t.add_done_callback(self.releases.discard)
+
+    async def metrics_lines(self) -> List[str]:
+        try:
+            r = await self.client.get("http://shard/metrics", timeout=2)
+        except Exception:
+            return []
+        lines = []
+        for line in r.text.splitlines():
+            name, _, value = line.rpartition(" ")
+            if name:
+                lines.append(f'{name}{{shard="{self.index}"}} {value}')
+        return lines
+
+    async def stop(self, timeout: float = 20):
+        if self.alive():
+            self.proc.terminate()
+            deadline = time.monotonic() + timeout
+            while self.alive() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if self.alive():
+                self.proc.kill()
+        await self.client.aclose()
+
+class Front:
+    def __init__(self, token: str, shards: int, queue_limit: int, api_base: str = "", db_path: str = "finance.db"):
+        import httpx
+        self.shards = shards
+        self.hold_limit = queue_limit
+        self.db_path = db_path
+        self.group_ledgers: Set[int] = set()
+        self.holding: Dict[int, List[Tuple[bytes, dict]]] = {}  # chat -> updates behind its /ledger
+        self.metrics: Dict[str, float] = {}
+        self.secret = secrets.token_urlsafe(32)
+        self.socket_dir = tempfile.mkdtemp(prefix="bot-shards-")
+        self.api = httpx.AsyncClient(base_url=f"{(api_base or 'https://api.telegram.org').rstrip('/')}/bot{token}/",
+                                     timeout=httpx.Timeout(10, read=60))
+        self.stopping = False
+        self.workers: List[Worker] = []
+        for i in range(shards):
+            sock = os.path.join(self.socket_dir, f"shard{i}.sock")
+            env = {**os.environ, "SHARD_INDEX": str(i), "SHARD_SOCKET": sock, "BOT_MODE": "webhook",
+                   "WEBHOOK_URL": "", "WEBHOOK_SECRET": self.secret, "WEBHOOK_PATH": "telegram",
+                   "TRACE_PATH": shard_db_path(os.environ.get("TRACE_PATH", "traces.jsonl"), i)}
+            self.workers.append(Worker(i, sock, env, queue_limit, self.metrics))
+            self.workers[-1].on_toggled = self.release
+
+    def inc(self, name: str):
+        self.metrics[name] = self.metrics.get(name, 0) + 1
+
+    def load_group_ledgers(self):
+        groups: Set[int] = set()
+        for i in range(self.shards):
+            groups |= {g for g in group_ledgers_in(shard_db_path(self.db_path, i)) if shard_of(g, self.shards) == i}
+        self.group_ledgers = groups
+        self.metrics["front_group_ledgers"] = len(groups)
+
+    def worker_for(self, update: dict) -> Worker:
+        return self.workers[shard_of(route_key(update, self.group_ledgers), self.shards)]
+
+    def dispatch(self, raw: bytes, update: dict) -> bool:
+        """Route one update without waiting; False if it was dropped."""
+        self.inc("front_updates_total")
+        chat = group_chat(update)
+        if chat is not None and chat in self.holding:
+            held = self.holding[chat]
+            if len(held) >= self.hold_limit:
+                self.inc("front_held_dropped_total")
+                return False
+            held.append((raw, update))
+            return True
+        return self.forward(raw, update, chat)
+
+    def forward(self, raw: bytes, update: dict, chat: Optional[int]) -> bool:
+        """Queue an update on its worker; a group's /ledger starts holding the group's later ones."""
+        if chat is not None and is_ledger_toggle(update):
+            self.inc("front_ledger_toggles_total")
+            if not self.workers[shard_of(chat, self.shards)].put(raw, chat):
+                return False
+            self.holding.setdefault(chat, [])
+            return True
+        return self.worker_for(update).put(raw)
+
+    async def release(self, chat: int):
+        """After a group's /ledger was processed: re-read whether the group keeps a shared
+        ledger, then route the updates held behind it, up to the next /ledger."""
+        i = shard_of(chat, self.shards)
+        if chat in await asyncio.to_thread(group_ledgers_in, shard_db_path(self.db_path, i)):
+            self.group_ledgers.add(chat)
+        else:
+            self.group_ledgers.discard(chat)
+        held = self.holding.get(chat, [])
+        while held:
+            raw, update = held.pop(0)
+            if self.forward(raw, update, chat) and is_ledger_toggle(update):
+                return  # the rest stays held behind this one
+        self.holding.pop(chat, None)
+
+    async def supervise(self):
+        refreshed = time.monotonic()
+        while not self.stopping:
+            if time.monotonic() - refreshed >= 60:  # /restore can change them under the front
+                refreshed = time.monotonic()
+                self.load_group_ledgers()  # on the loop: a release in progress cannot be overwritten
+            for w in self.workers:
+                if not w.alive() and not self.stopping:
+                    if w.proc is not None:
+                        log.warning(f"Shard {w.index}: worker exited with {w.proc.returncode}, restarting")
+                        self.inc("front_worker_restarts_total")
+                    w.spawn()
+            await asyncio.sleep(1)
+
+    async def poll(self):
+        await self.api.post("deleteWebhook", json={"drop_pending_updates": True})
+        offset = None
+        while True:
+            try:
+                r = await self.api.post("getUpdates", json={"offset": offset, "timeout": 30,
+                                                            "allowed_updates": ALLOWED_UPDATES})
+                updates = r.json().get("result") or []
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for u in updates:
+                offset = u["update_id"] + 1
+                self.dispatch(json.dumps(u).encode(), u)
+
+    def metrics_head(self) -> List[str]:
+        lines = [f"{k} {v:g}" for k, v in sorted(self.metrics.items())]
+        lines += [f'front_queue_depth{{shard="{w.index}"}} {w.queue.qsize()}' for w in self.workers]
+        lines += [f'front_overflow_depth{{shard="{w.index}"}} {len(w.overflow)}' for w in self.workers]
+        lines += [f"front_held_updates {sum(len(h) for h in self.holding.values())}"]
+        lines += [f'front_worker_up{{shard="{w.index}"}} {int(w.alive())}' for w in self.workers]
+        return lines
+
+    def web_app(self, mode: str, webhook_path: str, webhook_secret: str):
+        import hmac
+        import tornado.web
+        front = self
+
+        class HealthHandler(tornado.web.RequestHandler):
+            def get(self):
+                ok = all(w.alive() for w in front.workers)
+                self.set_status(200 if ok else 503)
+                self.set_header("Content-Type", "text/plain")
+                self.write("OK" if ok else "DEGRADED")
+
+        class MetricsHandler(tornado.web.RequestHandler):
+            async def get(self):
+                per_shard = await asyncio.gather(*(w.metrics_lines() for w in front.workers))
+                self.set_header("Content-Type", "text/plain; version=0.0.4")
+                self.write("\n".join(front.metrics_head() + [l for lines in per_shard for l in lines]) + "\n")
+
+        class WebhookHandler(tornado.web.RequestHandler):
+            async def post(self):
+                token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(token.encode(), webhook_secret.encode()):
+                    front.inc("front_webhook_rejected_total")
+                    self.set_status(403); return
+                try:
+                    update = json.loads(self.request.body)
+                except ValueError:
+                    self.set_status(400); return
+                w = front.worker_for(update)
+                if w.queue.full() or not front.dispatch(self.request.body, update):  # Telegram redelivers on non-2xx
+                    front.inc("front_webhook_busy_total")
+                    self.set_status(503); return
+
+        routes = [(r"/", HealthHandler), (r"/healthz", HealthHandler), (r"/metrics", MetricsHandler)]
+        if mode == "webhook":
+            routes.append((webhook_path, WebhookHandler))
+        return tornado.web.Application(routes, log_function=lambda handler: None)
+
+    async def run(self, port: int, mode: str, webhook_url: str, webhook_path: str, webhook_secret: str,
+                  max_connections: int):
+        import tornado.httpserver
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        server = tornado.httpserver.HTTPServer(self.web_app(mode, webhook_path, webhook_secret))
+        server.listen(port)
+        self.load_group_ledgers()
+        tasks = [loop.create_task(self.supervise())]
+        tasks += [loop.create_task(w.run(self.secret, "/telegram")) for w in self.workers]
+        if mode == "webhook":
+            if webhook_url:
+                await self.api.post("setWebhook", json={
+                    "url": webhook_url.rstrip("/") + webhook_path, "secret_token": webhook_secret,
+                    "max_connections": max_connections, "allowed_updates": ALLOWED_UPDATES,
+                    "drop_pending_updates": True})
+            log.info(f"Front: webhook on :{port}{webhook_path}, {self.shards} shards")
+            poller = None
+        else:
+            poller = loop.create_task(self.poll())
+            log.info(f"Front: polling, health on :{port}, {self.shards} shards")
+        await stop.wait()
+        self.stopping = True
+        server.stop()
+        if poller:
+            poller.cancel()
+        deadline = time.monotonic() + 10  # let forwarded-but-queued updates reach their workers
+        while (self.holding or any(w.backlog() for w in self.workers)) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*(w.stop() for w in self.workers))
+        await self.api.aclose()
+
+def run_front(token: str, shards: int, port: int, mode: str, webhook_url: str, webhook_path: str,
+              webhook_secret: str, max_connections: int, queue_limit: int, api_base: str = "",
+              db_path: str = "finance.db"):
+    async def go():
+        front = Front(token, shards, queue_limit, api_base, db_path)
+        await front.run(port, mode, webhook_url, webhook_path, webhook_secret, max_connections)
+    asyncio.run(go())
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""Storage interface behind the bot's DB helpers, plus an in-memory implementation.
+
+main.SqliteStorage is the production backend; main.STORE holds the active one. The DB
+helpers in main (add_tx, debt_groups, get_chat_settings, ...) keep the ledger cache and
+the per-chat caches and call STORE for everything that touches rows, so handlers never
+see SQL. MemoryStorage keeps the same rows in indexed dicts: benchmarks/handlers.py runs
+the handlers on it to separate bot-logic cost from storage cost.
+
+Rows are plain tuples in the shapes documented per method (the SQLite column order).
+/find, the FX rate table and the chart file_id cache are here too. Background jobs
+(archive, insights, digest, usage stats, backups) and writes to other shards' files are
+SQLite-specific and stay outside this interface; main lists them where STORE is set.
+"""
+import abc, operator, re
+from bisect import insort
+from typing import Any, Dict, List, Optional, Tuple
+
+TxRow = Tuple[str, float, str, str, str]  # (ttype, amount, currency, category, note)
+Span = Tuple[int, int, int]  # (lo, hi, UTC offset) from main.tz_spans; local day = (ts + offset) // 86400
+
+def span_offset(spans: List[Span], ts: int) -> int:
+    """Offset of the span holding ts; the last span's before and after the covered range."""
+    for _, hi, off in spans[:-1]:
+        if ts <= hi:
+            return off
+    return spans[-1][2]
+
+class Storage(abc.ABC):
+    # ---- transactions
+    @abc.abstractmethod
+    async def add_txs(self, uid: int, lid: int, rows: List[TxRow], ts: int) -> List[int]:
+        """Insert rows in one write; returns their ids in order."""
+
+    @abc.abstractmethod
+    def delete_txs(self, uid: int, tx_ids: List[int]) -> List[tuple]:
+        """Delete the user's rows; returns (ledger_id, id, user_id, ttype, amount, currency, category, ts)."""
+
+    @abc.abstractmethod
+    def last_txs(self, lid: int, limit: int, offset: int) -> List[tuple]:
+        """(id, ttype, amount, currency, category, note, ts), newest first."""
+
+    @abc.abstractmethod
+    def tx_between(self, lid: int, start: int, end: int) -> List[tuple]:
+        """(id, ts, ttype, amount, currency, category, note) with start <= ts <= end, oldest first."""
+
+    @abc.abstractmethod
+    def ledger_totals(self, lid: int) -> List[tuple]:
+        """(user_id, currency, net, count) over the ledger's whole history."""
+
+    @abc.abstractmethod
+    def expense_totals(self, lid: int, start: int, end: int) -> List[tuple]:
+        """(category, currency, sum) of expenses with start <= ts <= end."""
+
+    @abc.abstractmethod
+    def expenses_by_day(self, lid: int, since: int, spans: List[Span]) -> List[tuple]:
+        """(local day, category, currency, sum) of expenses with ts >= since, by day."""
+
+    @abc.abstractmethod
+    def report_buckets(self, lid: int, start: int, end: int, spans: List[Span]) -> List[tuple]:
+        """(local day, ttype, category, currency, sum) with start <= ts <= end."""
+
+    # ---- debts
+    @abc.abstractmethod
+    async def add_debt(self, uid: int, lid: int, direction: str, amount: float, currency: str,
+                       name: str, name_key: str, note: str, ts: int) -> int:
+        """Insert an open debt, creating the counterparty (matched on name_key) if needed."""
+
+    @abc.abstractmethod
+    def delete_debt(self, uid: int, debt_id: int) -> Optional[int]:
+        """Delete the user's debt; returns its ledger id, None if there was none."""
+
+    @abc.abstractmethod
+    def open_debts(self, lid: int) -> List[tuple]:
+        """(id, direction, amount, currency, counterparty, created_ts), newest first."""
+
+    @abc.abstractmethod
+    def debt_groups(self, lid: int, direction: Optional[str], limit: int, offset: int) -> List[tuple]:
+        """(counterparty_id, name, currency, total, count), see main.debt_groups."""
+
+    @abc.abstractmethod
+    def counterparty_debts(self, lid: int, cp_id: int) -> Tuple[Optional[str], List[tuple], List[tuple]]:
+        """(name, open debts (id, direction, amount, currency, created_ts),
+        last 5 payments (debt_id, amount, currency, ts))."""
+
+    @abc.abstractmethod
+    def get_debt(self, lid: int, debt_id: int) -> Optional[tuple]:
+        """(amount, currency, status)."""
+
+    @abc.abstractmethod
+    def pay_debt(self, lid: int, debt_id: int, uid: int, paid: float, remaining: float, ts: int) -> int:
+        """Record a payment and leave `remaining` open (closed at 0); returns the payment id."""
+
+    @abc.abstractmethod
+    def undo_payment(self, debt_id: int, amount: float, payment_id: Optional[int], ts: int) -> Optional[int]:
+        """Reopen the debt at `amount` and drop the payment; returns its ledger id."""
+
+    @abc.abstractmethod
+    def debts_export(self, lid: int) -> List[tuple]:
+        """(id, direction, amount, paid, currency, counterparty, status, created_ts, updated_ts), newest first."""
+
+    # ---- budgets
+    @abc.abstractmethod
+    def set_budget(self, uid: int, lid: int, category: str, currency: str, limit_amount: float,
+                   period: str, ts: int):
+        """Create or replace (and reactivate) the ledger's budget for (category, currency)."""
+
+    @abc.abstractmethod
+    def active_budgets(self, lid: int) -> List[tuple]:
+        """(id, category, currency, limit_amount, period, active), by category."""
+
+    # ---- ledgers
+    @abc.abstractmethod
+    def group_ledger_enabled(self, chat_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    def set_group_ledger(self, chat_id: int, enabled: bool, title: str, ts: int): ...
+
+    @abc.abstractmethod
+    def ensure_member(self, lid: int, uid: int, name: str, ts: int):
+        """Add or rename a member; a ledger whose id is the user's own is created as personal."""
+
+    @abc.abstractmethod
+    def member_names(self, lid: int) -> Dict[int, str]: ...
+
+    @abc.abstractmethod
+    def insight_tip(self, lid: int) -> Optional[tuple]:
+        """(tip, computed_ts) from the nightly insights job."""
+
+    # ---- settings & pins
+    @abc.abstractmethod
+    def chat_settings(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """{"autopin", "autoclean", "group_silent", "lang", "digest", "tz"}, None for defaults."""
+
+    @abc.abstractmethod
+    async def set_chat_setting(self, chat_id: int, key: str, value: Any, ts: int): ...
+
+    @abc.abstractmethod
+    def pinned_msg_id(self, chat_id: int) -> Optional[int]: ...
+
+    @abc.abstractmethod
+    async def set_pinned_msg_id(self, chat_id: int, message_id: int): ...
+
+    # ---- search
+    @abc.abstractmethod
+    def search_txs(self, lid: int, q: Dict[str, Any], before: Optional[Tuple[int, int]], limit: int) -> List[tuple]:
+        """(id, ttype, amount, currency, category, note, ts) matching a main.parse_find_query
+        dict, newest first, below the (ts, id) of `before`; archived rows included."""
+
+    # ---- FX rates & chart cache
+    @abc.abstractmethod
+    def fx_rates(self) -> List[tuple]:
+        """(currency, day, rate) by currency, day."""
+
+    @abc.abstractmethod
+    def put_fx_rates(self, rows: List[Tuple[int, str, float]]):
+        """Upsert (day, currency, rate) rows."""
+
+    @abc.abstractmethod
+    def chart_file(self, key: str) -> Optional[Tuple[str, str]]:
+        """(kind, file_id) of a chart already sent to Telegram."""
+
+    @abc.abstractmethod
+    def set_chart_file(self, key: str, kind: str, file_id: str, ts: int): ...
+
+
+OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+SETTING_DEFAULTS = {"autopin": 1, "autoclean": 1, "group_silent": 1, "lang": "ru", "digest": "off", "tz": ""}
+
+class MemoryStorage(Storage):
+    """Everything in dicts, indexed the way the SQLite indexes are: tx ids per ledger kept
+    sorted by (ts, id), debts and budgets per ledger, counterparties by (ledger, name key).
+    Not persistent and not thread-safe; meant for benchmarks."""
+
+    def __init__(self):
+        self.tx: Dict[int, tuple] = {}  # id -> (ledger_id, user_id, ttype, amount, currency, category, note, ts)
+        self.tx_by_ledger: Dict[int, List[Tuple[int, int]]] = {}  # lid -> [(ts, id)]
+        self.debts: Dict[int, list] = {}  # id -> [ledger_id, user_id, direction, amount, currency, name, cp_id, note, status, created, updated]
+        self.debts_by_ledger: Dict[int, List[int]] = {}
+        self.counterparties: Dict[Tuple[int, str], int] = {}
+        self.cps: Dict[int, Tuple[int, str, str]] = {}  # id -> (ledger_id, name, name_key)
+        self.payments: Dict[int, tuple] = {}  # id -> (debt_id, amount, ts)
+        self.payments_by_debt: Dict[int, List[int]] = {}
+        self.budgets: Dict[int, Dict[Tuple[str, str], list]] = {}  # lid -> (cat, cur) -> row
+        self.group_ledgers: Dict[int, str] = {}
+        self.members: Dict[int, Dict[int, str]] = {}
+        self.tips: Dict[int, tuple] = {}
+        self.settings: Dict[int, Dict[str, Any]] = {}
+        self.pins: Dict[int, int] = {}
+        self.fx: Dict[Tuple[str, int], float] = {}
+        self.charts: Dict[str, Tuple[str, str]] = {}
+        self.next_id = {"tx": 0, "debt": 0, "cp": 0, "payment": 0, "budget": 0}
+
+    def new_id(self, table: str) -> int:
+        self.next_id[table] += 1
+        return self.next_id[table]
+
+    def ledger_tx(self, lid: int, start: int = -2 ** 63, end: int = 2 ** 63):
+        for ts, tid in self.tx_by_ledger.get(lid, ()):
+            if start <= ts <= end:
+                yield tid, self.tx[tid]
+
+    # ---- transactions
+    async def add_txs(self, uid, lid, rows, ts):
+        ids = []
+        index = self.tx_by_ledger.setdefault(lid, [])
+        for ttype, amount, currency, category, note in rows:
+            tid = self.new_id("tx")
+            self.tx[tid] = (lid, uid, ttype, amount, currency, category, note, ts)
+            insort(index, (ts, tid))
+            ids.append(tid)
+        return ids
+
+    def delete_txs(self, uid, tx_ids):
+        out = []
+        for tid in tx_ids:
+            row = self.tx.get(tid)
+            if row is None or row[1] != uid:
+                continue
+            del self.tx[tid]
+            lid, user_id, ttype, amount, currency, category, _, ts = row
+            self.tx_by_ledger[lid].remove((ts, tid))
+            out.append((lid, tid, user_id, ttype, amount, currency, category, ts))
+        return out
+
+    def last_txs(self, lid, limit, offset):
+        index = self.tx_by_ledger.get(lid, [])
+        picked = index[max(0, len(index) - offset - limit):max(0, len(index) - offset)]
+        return [(tid, *self.tx[tid][2:]) for _, tid in reversed(picked)]
+
+    def tx_between(self, lid, start, end):
+        return [(tid, r[7], r[2], r[3], r[4], r[5], r[6]) for tid, r in self.ledger_tx(lid, start, end)]
+
+    def ledger_totals(self, lid):
+        acc: Dict[Tuple[int, str], list] = {}
+        for _, r in self.ledger_tx(lid):
+            a = acc.setdefault((r[1], r[4]), [0.0, 0])
+            a[0] += r[3] if r[2] == "income" else -r[3]
+            a[1] += 1
+        return [(uid, cur, net, n) for (uid, cur), (net, n) in acc.items()]
+
+    def expense_totals(self, lid, start, end):
+        acc: Dict[Tuple[str, str], float] = {}
+        for _, r in self.ledger_tx(lid, start, end):
+            if r[2] == "expense":
+                acc[(r[5], r[4])] = acc.get((r[5], r[4]), 0.0) + r[3]
+        return [(cat, cur, s) for (cat, cur), s in acc.items()]
+
+    def expenses_by_day(self, lid, since, spans):
+        acc: Dict[Tuple[int, str, str], float] = {}
+        for _, r in self.ledger_tx(lid, since):
+            if r[2] == "expense":
+                key = ((r[7] + span_offset(spans, r[7])) // 86400, r[5], r[4])
+                acc[key] = acc.get(key, 0.0) + r[3]
+        return sorted((day, cat, cur, s) for (day, cat, cur), s in acc.items())
+
+    def report_buckets(self, lid, start, end, spans):
+        acc: Dict[tuple, float] = {}
+        for _, r in self.ledger_tx(lid, start, end):
+            key = ((r[7] + span_offset(spans, r[7])) // 86400, r[2], r[5], r[4])
+            acc[key] = acc.get(key, 0.0) + r[3]
+        return [(*key, s) for key, s in acc.items()]
+
+    # ---- debts
+    async def add_debt(self, uid, lid, direction, amount, currency, name, name_key, note, ts):
+        cp_id = self.counterparties.get((lid, name_key))
+        if cp_id is None:
+            cp_id = self.counterparties[(lid, name_key)] = self.new_id("cp")
+            self.cps[cp_id] = (lid, name, name_key)
+        did = self.new_id("debt")
+        self.debts[did] = [lid, uid, direction, amount, currency, name, cp_id, note, "open", ts, ts]
+        self.debts_by_ledger.setdefault(lid, []).append(did)
+        return did
+
+    def delete_debt(self, uid, debt_id):
+        d = self.debts.get(debt_id)
+        if d is None or d[1] != uid:
+            return None
+        del self.debts[debt_id]
+        self.debts_by_ledger[d[0]].remove(debt_id)
+        for pid in self.payments_by_debt.pop(debt_id, ()):
+            self.payments.pop(pid, None)
+        return d[0]
+
+    def ledger_debts(self, lid: int, status: Optional[str] = "open"):
+        for did in self.debts_by_ledger.get(lid, ()):
+            d = self.debts[did]
+            if status is None or d[8] == status:
+                yield did, d
+
+    def open_debts(self, lid):
+        rows = [(did, d[2], d[3], d[4], d[5], d[9]) for did, d in self.ledger_debts(lid)]
+        return sorted(rows, key=lambda r: (r[5], r[0]), reverse=True)
+
+    def debt_groups(self, lid, direction, limit, offset):
+        acc: Dict[Tuple[int, str], list] = {}
+        for _, d in self.ledger_debts(lid):
+            if direction and d[2] != direction:
+                continue
+            a = acc.setdefault((d[6], d[4]), [0.0, 0])
+            a[0] += d[3] if direction or d[2] == "owed" else -d[3]
+            a[1] += 1
+        rows = [(cp, self.cps[cp][1], cur, total, n) for (cp, cur), (total, n) in acc.items() if abs(total) > 0.0001]
+        rows.sort(key=lambda r: (-abs(r[3]), self.cps[r[0]][2]))
+        return rows[offset:offset + limit]
+
+    def counterparty_debts(self, lid, cp_id):
+        cp = self.cps.get(cp_id)
+        if cp is None or cp[0] != lid:
+            return None, [], []
+        mine = [(did, d) for did, d in self.ledger_debts(lid, None) if d[6] == cp_id]
+        debts = sorted(((did, d[2], d[3], d[4], d[9]) for did, d in mine if d[8] == "open"),
+                       key=lambda r: (r[4], r[0]), reverse=True)
+        payments = [(pid, self.payments[pid], d[4]) for did, d in mine for pid in self.payments_by_debt.get(did, ())]
+        payments.sort(key=lambda p: (p[1][2], p[0]), reverse=True)
+        return cp[1], debts, [(p[0], p[1], cur, p[2]) for _, p, cur in payments[:5]]
+
+    def get_debt(self, lid, debt_id):
+        d = self.debts.get(debt_id)
+        return (d[3], d[4], d[8]) if d and d[0] == lid else None
+
+    def pay_debt(self, lid, debt_id, uid, paid, remaining, ts):
+        pid = self.new_id("payment")
+        self.payments[pid] = (debt_id, paid, ts)
+        self.payments_by_debt.setdefault(debt_id, []).append(pid)
+        d = self.debts[debt_id]
+        d[3], d[10] = max(remaining, 0.0), ts
+        if remaining <= 0:
+            d[8] = "closed"
+        return pid
+
+    def undo_payment(self, debt_id, amount, payment_id, ts):
+        d = self.debts.get(debt_id)
+        if d is None:
+            return None
+        d[3], d[8], d[10] = amount, "open", ts
+        if payment_id in self.payments and self.payments[payment_id][0] == debt_id:
+            del self.payments[payment_id]
+            self.payments_by_debt[debt_id].remove(payment_id)
+        return d[0]
+
+    def debts_export(self, lid):
+        rows = [(did, d[2], d[3], sum(self.payments[p][1] for p in self.payments_by_debt.get(did, ())),
+                 d[4], d[5], d[8], d[9], d[10]) for did, d in self.ledger_debts(lid, None)]
+        return sorted(rows, key=lambda r: r[7], reverse=True)
+
+    # ---- budgets
+    def set_budget(self, uid, lid, category, currency, limit_amount, period, ts):
+        by_key = self.budgets.setdefault(lid, {})
+        row = by_key.get((category, currency))
+        if row is None:
+            by_key[(category, currency)] = [self.new_id("budget"), category, currency, limit_amount, period, 1]
+        else:
+            row[3:] = [limit_amount, period, 1]
+
+    def active_budgets(self, lid):
+        return sorted((tuple(b) for b in self.budgets.get(lid, {}).values() if b[5]), key=lambda b: b[1])
+
+    # ---- ledgers
+    def group_ledger_enabled(self, chat_id):
+        return chat_id in self.group_ledgers
+
+    def set_group_ledger(self, chat_id, enabled, title, ts):
+        if enabled:
+            self.group_ledgers[chat_id] = title
+        else:
+            self.group_ledgers.pop(chat_id, None)
+
+    def ensure_member(self, lid, uid, name, ts):
+        self.members.setdefault(lid, {})[uid] = name
+
+    def member_names(self, lid):
+        return {u: (n or str(u)) for u, n in self.members.get(lid, {}).items()}
+
+    def insight_tip(self, lid):
+        return self.tips.get(lid)
+
+    # ---- settings & pins
+    def chat_settings(self, chat_id):
+        st = self.settings.get(chat_id)
+        return dict(st) if st else None
+
+    async def set_chat_setting(self, chat_id, key, value, ts):
+        self.settings.setdefault(chat_id, dict(SETTING_DEFAULTS))[key] = value
+
+    def pinned_msg_id(self, chat_id):
+        return self.pins.get(chat_id)
+
+    async def set_pinned_msg_id(self, chat_id, message_id):
+        self.pins[chat_id] = message_id
+
+    # ---- search
+    def search_txs(self, lid, q, before, limit):
+        # terms match word prefixes in note or category, like the FTS prefix queries
+        out = []
+        for ts, tid in reversed(self.tx_by_ledger.get(lid, [])):
+            if before and (ts, tid) >= before:
+                continue
+            _, _, ttype, amount, currency, category, note, _ = self.tx[tid]
+            if any(b is not None and not OPS[b[0]](amount, b[1]) for b in (q["min"], q["max"])):
+                continue
+            if q["start"] is not None and not q["start"] <= ts <= q["end"]:
+                continue
+            if q["currency"] and currency != q["currency"]:
+                continue
+            words = re.findall(r"\w+", f"{note or ''} {category or ''}".lower())
+            if not all(any(w.startswith(t) for w in words) for t in q["terms"]):
+                continue
+            out.append((tid, ttype, amount, currency, category, note, ts))
+            if len(out) >= limit:
+                break
+        return out
+
+    # ---- FX rates & chart cache
+    def fx_rates(self):
+        return sorted((cur, day, rate) for (cur, day), rate in self.fx.items())
+
+    def put_fx_rates(self, rows):
+        for day, cur, rate in rows:
+            self.fx[(cur, day)] = rate
+
+    def chart_file(self, key):
+        return self.charts.get(key)
+
+    def set_chart_file(self, key, kind, file_id, ts):
+        self.charts[key] = (kind, file_id)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Admission control: token buckets, tap coalescing, load shedding.
+
+    python -m pytest -q tests
+"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from admission import ADMIT, DUPLICATE, LIMITED, SHED, Admission, Buckets  # noqa: E402
+
+def make(**kw) -> Admission:
+    args = dict(user_rate=1.0, user_burst=3, chat_rate=2.0, chat_burst=5, coalesce_seconds=1.0,
+                soft_pending=10, hard_pending=20, metrics={})
+    args.update(kw)
+    return Admission(**args)
+
+def test_bucket_burst_then_refill():
+    b = Buckets(rate=2.0, burst=3)
+    assert [b.take("u", 0.0) for _ in range(4)] == [True, True, True, False]
+    assert not b.take("u", 0.4)  # 0.8 tokens
+    assert b.take("u", 0.5)      # 1.0 token
+    assert [b.take("u", 100.0) for _ in range(4)] == [True, True, True, False]  # capped at burst
+
+def test_bucket_forgets_least_recent_keys():
+    b = Buckets(rate=1.0, burst=1, max_keys=2)
+    b.take("a", 0.0); b.take("b", 0.0); b.take("a", 0.0); b.take("c", 0.0)
+    assert list(b.state) == ["a", "c"]
+
+def test_user_and_chat_limits():
+    a = make(user_burst=2, chat_burst=3)
+    assert [a.check(1, 1, None, False, now=0.0) for _ in range(3)] == [ADMIT, ADMIT, LIMITED]
+    # a group: each user has their own bucket, the chat's is shared
+    assert [a.check(u, -9, None, False, now=0.0) for u in (2, 3, 4, 5)] == [ADMIT, ADMIT, ADMIT, LIMITED]
+    assert a.metrics["admission_limited_user_total"] == 1
+    assert a.metrics["admission_limited_chat_total"] == 1
+
+def test_coalescing_window_runs_from_admitted_tap():
+    a = make()
+    assert a.check(1, 1, "hist:next:2", True, now=0.0) == ADMIT
+    assert a.check(1, 1, "hist:next:2", True, now=0.5) == DUPLICATE
+    assert a.check(1, 1, "hist:next:2", True, now=0.9) == DUPLICATE
+    assert a.check(1, 1, "hist:next:2", True, now=1.0) == ADMIT
+    assert a.check(1, 1, "hist:next:3", True, now=1.1) == ADMIT  # another tap
+    assert a.check(2, 2, "hist:next:2", True, now=1.1) == ADMIT  # another user
+    assert a.metrics["admission_coalesced_total"] == 2
+
+def test_no_tap_is_never_merged():
+    a = make(user_burst=10)
+    assert [a.check(1, 1, None, False, now=0.0) for _ in range(3)] == [ADMIT] * 3
+
+def test_shed_levels():
+    a = make()
+    assert a.level() == 0
+    a.metrics["updates_pending"] = 10
+    assert a.level() == 1
+    assert a.check(1, 1, "report:month", True, now=0.0) == ADMIT  # level 1 only skips optional work
+    a.metrics["updates_pending"] = 20
+    assert a.level() == 2
+    assert a.check(2, 2, "report:month", True, now=0.0) == SHED
+    assert a.check(2, 2, None, False, now=0.0) == ADMIT  # writes are not shed
+
+def test_rejected_tap_can_be_retried():
+    a = make(user_burst=1, user_rate=1.0)
+    assert a.check(1, 1, None, False, now=0.0) == ADMIT
+    assert a.check(1, 1, "hist:next:2", True, now=0.1) == LIMITED
+    assert a.check(1, 1, "hist:next:2", True, now=1.05) == ADMIT  # not a DUPLICATE of the refused tap
+    a.metrics["updates_pending"] = 20
+    assert a.check(2, 2, "dls:net:1", True, now=0.0) == SHED
+    a.metrics["updates_pending"] = 0
+    assert a.check(2, 2, "dls:net:1", True, now=0.1) == ADMIT
+
+def test_warn_once_per_window():
+    a = make(warn_every=30.0)
+    assert a.warn_once(1, now=0.0)
+    assert not a.warn_once(1, now=29.0)
+    assert a.warn_once(2, now=29.0)
+    assert a.warn_once(1, now=30.0)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Front routing: route keys, group detection, /ledger holding and release.
+
+    python -m pytest -q tests
+"""
+import asyncio, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shards  # noqa: E402
+from shards import Front, group_chat, is_ledger_toggle, route_key  # noqa: E402
+
+USER, OTHER = 10, 11   # shard 0 and 1 of 2
+GROUP = -3             # shard 1
+
+def msg(uid: int, chat: int, text: str = "обед 45000", ctype: str = "group") -> dict:
+    return {"update_id": 1, "message": {"message_id": 1, "text": text, "from": {"id": uid},
+                                        "chat": {"id": chat, "type": ctype}}}
+
+def callback(uid: int, chat: int, ctype: str = "group") -> dict:
+    return {"update_id": 1, "callback_query": {"id": "1", "data": "hist:next:2", "from": {"id": uid},
+                                               "message": {"message_id": 1, "chat": {"id": chat, "type": ctype}}}}
+
+def make_front(tmp_path, monkeypatch, enabled=(), queue_limit=10) -> Front:
+    ledgers = set(enabled)
+    monkeypatch.setattr(shards, "group_ledgers_in", lambda path: set(ledgers))
+    monkeypatch.setattr(shards.tempfile, "mkdtemp", lambda prefix="": str(tmp_path))  # socket dir
+    front = Front("1:x", 2, queue_limit, db_path=str(tmp_path / "finance.db"))
+    front.load_group_ledgers()
+    front.ledgers = ledgers  # what the shard files say; a test flips it like /ledger would
+    return front
+
+def queued(worker) -> list:
+    return [*worker.queue._queue, *worker.overflow]
+
+def test_route_key():
+    assert route_key(msg(USER, USER, ctype="private")) == USER
+    assert route_key(msg(USER, GROUP)) == USER  # personal entries in a group without a ledger
+    assert route_key(msg(USER, GROUP), {GROUP}) == GROUP
+    assert route_key(callback(USER, GROUP), {GROUP}) == GROUP
+    assert route_key(callback(USER, GROUP)) == USER
+    assert route_key({"update_id": 1, "channel_post": {"chat": {"id": -7, "type": "channel"}}}) == -7
+    assert route_key({"update_id": 1}) == 0
+
+def test_group_chat():
+    assert group_chat(msg(USER, GROUP)) == GROUP
+    assert group_chat(msg(USER, GROUP, ctype="supergroup")) == GROUP
+    assert group_chat(callback(USER, GROUP)) == GROUP
+    assert group_chat(msg(USER, USER, ctype="private")) is None
+    assert group_chat({"update_id": 1, "channel_post": {"chat": {"id": -7, "type": "channel"}}}) is None
+
+def test_is_ledger_toggle():
+    assert is_ledger_toggle(msg(USER, GROUP, "/ledger"))
+    assert is_ledger_toggle(msg(USER, GROUP, "/ledger@finance_bot on"))
+    assert is_ledger_toggle({"update_id": 1, "edited_message": msg(USER, GROUP, "/Ledger")["message"]})
+    assert not is_ledger_toggle(msg(USER, USER, "/ledger", ctype="private"))
+    assert not is_ledger_toggle(msg(USER, GROUP, "/ledgers"))
+    assert not is_ledger_toggle(msg(USER, GROUP, ""))
+
+def test_personal_entries_in_a_group_go_to_the_user(tmp_path, monkeypatch):
+    front = make_front(tmp_path, monkeypatch)
+    w0, w1 = front.workers
+    assert front.dispatch(b"a", msg(USER, GROUP)) and front.dispatch(b"b", msg(OTHER, GROUP))
+    assert queued(w0) == [(b"a", None)] and queued(w1) == [(b"b", None)]
+
+def test_ledger_group_goes_to_its_shard(tmp_path, monkeypatch):
+    front = make_front(tmp_path, monkeypatch, enabled={GROUP})
+    w0, w1 = front.workers
+    front.dispatch(b"a", msg(USER, GROUP))
+    front.dispatch(b"b", msg(USER, USER, ctype="private"))
+    assert queued(w0) == [(b"b", None)] and queued(w1) == [(b"a", None)]
+
+def test_toggle_holds_the_group_until_released(tmp_path, monkeypatch):
+    front = make_front(tmp_path, monkeypatch)
+    w0, w1 = front.workers
+    front.dispatch(b"t", msg(USER, GROUP, "/ledger"))
+    front.dispatch(b"h1", msg(USER, GROUP))
+    front.dispatch(b"h2", callback(OTHER, GROUP))
+    front.dispatch(b"p", msg(USER, USER, ctype="private"))  # other chats are not held
+    assert queued(w1) == [(b"t", GROUP)] and queued(w0) == [(b"p", None)]
+    assert [raw for raw, _ in front.holding[GROUP]] == [b"h1", b"h2"]
+    front.ledgers.add(GROUP)  # the worker turned the ledger on
+    asyncio.run(front.release(GROUP))
+    assert GROUP in front.group_ledgers and GROUP not in front.holding
+    assert queued(w1) == [(b"t", GROUP), (b"h1", None), (b"h2", None)]
+
+def test_second_toggle_among_held_keeps_holding(tmp_path, monkeypatch):
+    front = make_front(tmp_path, monkeypatch)
+    w0, w1 = front.workers
+    for raw, text in ((b"t1", "/ledger"), (b"h1", "x"), (b"t2", "/ledger"), (b"h2", "y")):
+        front.dispatch(raw, msg(USER, GROUP, text))
+    front.ledgers.add(GROUP)
+    asyncio.run(front.release(GROUP))  # routes h1 by the new state, stops behind t2
+    assert queued(w1) == [(b"t1", GROUP), (b"h1", None), (b"t2", GROUP)]
+    assert [raw for raw, _ in front.holding[GROUP]] == [b"h2"]
+    front.ledgers.discard(GROUP)  # t2 turned it off again
+    asyncio.run(front.release(GROUP))
+    assert GROUP not in front.group_ledgers and GROUP not in front.holding
+    assert queued(w0) == [(b"h2", None)]
+
+def test_full_queue_overflows_in_order_then_drops(tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "OVERFLOW_QUEUES", 1)
+    front = make_front(tmp_path, monkeypatch, queue_limit=2)
+    w0 = front.workers[0]
+    assert [front.dispatch(b"%d" % i, msg(USER, USER, ctype="private")) for i in range(5)] == [True] * 4 + [False]
+    assert w0.queue.qsize() == 2 and [raw for raw, _ in w0.overflow] == [b"2", b"3"]
+    assert front.metrics["front_overflow_dropped_total"] == 1
+
+def test_held_updates_are_capped(tmp_path, monkeypatch):
+    front = make_front(tmp_path, monkeypatch, queue_limit=2)
+    front.dispatch(b"t", msg(USER, GROUP, "/ledger"))
+    assert [front.dispatch(b"h", msg(USER, GROUP)) for _ in range(3)] == [True, True, False]
+    assert front.metrics["front_held_dropped_total"] == 1
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Per-update traces: a trace is opened around a handler, spans (DB helpers, Bot API
+requests) attach to it through contextvars, and finished traces are appended to a
+JSON-lines file.
+
+    TRACE_SAMPLE=0.05 TRACE_PATH=traces.jsonl python main.py
+    python tracing.py [traces.jsonl] [--top 10] [--since-hours 24]
+
+With TRACE_SAMPLE=0 (default) a handler pays one float compare and every instrumented
+call one ContextVar lookup. asyncio tasks and asyncio.to_thread copy the context, so
+spans recorded there land in the right trace; the write batcher's own task does not, so
+its callers are spanned around the await instead.
+"""
+import functools, os, sys, time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0"))
+TRACE_PATH = os.environ.get("TRACE_PATH", "traces.jsonl")
+CO_COROUTINE = 0x80  # inspect.CO_COROUTINE, without importing inspect (~10 ms) into main
+
+class Trace:
+    __slots__ = ("name", "attrs", "t0", "wall", "spans")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name, self.attrs = name, attrs
+        self.t0, self.wall = time.perf_counter(), time.time()
+        self.spans: List[list] = []  # [name, parent index, start ms, duration ms, error]
+
+    def record(self) -> Dict[str, Any]:
+        return {"ts": round(self.wall, 3), "name": self.name, **self.attrs,
+                "ms": round((time.perf_counter() - self.t0) * 1000, 2),
+                "spans": [{"name": n, "parent": p, "at": a, "ms": d, **({"err": e} if e else {})}
+                          for n, p, a, d, e in self.spans]}
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_parent: ContextVar[int] = ContextVar("trace_parent", default=-1)
+_sink = None
+
+def sampled() -> bool:
+    if TRACE_SAMPLE <= 0:
+        return False
+    if TRACE_SAMPLE >= 1:
+        return True
+    import random
+    return random.random() < TRACE_SAMPLE
+
+def write(record: Dict[str, Any]):
+    global _sink
+    import json
+    if _sink is None:
+        _sink = open(TRACE_PATH, "a", encoding="utf-8", buffering=1)
+    _sink.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+class Span:
+    __slots__ = ("tr", "name", "idx", "t", "token")
+
+    def __init__(self, tr: Trace, name: str):
+        self.tr, self.name = tr, name
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        self.idx = len(self.tr.spans)
+        self.tr.spans.append([self.name, _parent.get(), round((self.t - self.tr.t0) * 1000, 2), None, None])
+        self.token = _parent.set(self.idx)
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        _parent.reset(self.token)
+        row = self.tr.spans[self.idx]
+        row[3] = round((time.perf_counter() - self.t) * 1000, 2)
+        if etype is not None:
+            row[4] = etype.__name__
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+NO_SPAN = _NoSpan()
+
+def span(name: str):
+    """Context manager timing `name` inside the current trace; a shared no-op outside one."""
+    tr = _trace.get()
+    return NO_SPAN if tr is None else Span(tr, name)
+
+def traced(name: str):
+    """Decorator: span every call of a sync or async function."""
+    def wrap(fn):
+        if fn.__code__.co_flags & CO_COROUTINE:
+            @functools.wraps(fn)
+            async def run_async(*args, **kwargs):
+                tr = _trace.get()
+                if tr is None:
+                    return await fn(*args, **kwargs)
+                with Span(tr, name):
+                    return await fn(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            tr = _trace.get()
+            if tr is None:
+                return fn(*args, **kwargs)
+            with Span(tr, name):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
+
+def trace_handler(name: str):
+    """Decorator for PTB handlers: opens a (sampled) trace for the update being handled."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def run(update, context):
+            if not sampled() or _trace.get() is not None:
+                return await fn(update, context)
+            user, chat = update.effective_user, update.effective_chat
+            tr = Trace(name, {"update_id": update.update_id,
+                              "user": user.id if user else None, "chat": chat.id if chat else None})
+            token = _trace.set(tr)
+            try:
+                return await fn(update, context)
+            except BaseException as e:
+                tr.attrs["err"] = type(e).__name__
+                raise
+            finally:
+                _trace.reset(token)
+                write(tr.record())
+        return run
+    return wrap
+
+def traced_request(**kwargs):
+    """HTTPXRequest whose Bot API calls are spanned as "bot.<method>"; telegram is only
+    imported here so that importing this module stays cheap."""
+    from telegram.request import HTTPXRequest
+
+    class TracedRequest(HTTPXRequest):
+        async def do_request(self, url: str, method: str, request_data=None, **kw):
+            tr = _trace.get()
+            if tr is None:
+                return await super().do_request(url, method, request_data, **kw)
+            with Span(tr, "bot." + url.rsplit("/", 1)[-1]):
+                return await super().do_request(url, method, request_data, **kw)
+
+    return TracedRequest(**kwargs)
+
+# ---------------- CLI: summarize the slowest traces ----------------
+def load(path: str, since: float = 0.0) -> List[Dict[str, Any]]:
+    import json
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if rec.get("ts", 0) >= since:
+                out.append(rec)
+    return out
+
+def pct(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+def summarize(records: List[Dict[str, Any]], top: int) -> str:
+    if not records:
+        return "no traces"
+    lines = [f"{len(records)} traces, p50 {pct([r['ms'] for r in records], .5):.1f} ms, "
+             f"p95 {pct([r['ms'] for r in records], .95):.1f} ms", "", f"slowest {top}:"]
+    for r in sorted(records, key=lambda r: -r["ms"])[:top]:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(r["ts"]))
+        lines.append(f"{r['ms']:9.1f} ms  {r['name']}  update {r.get('update_id')}  user {r.get('user')}  {when}"
+                     + (f"  ERROR {r['err']}" if r.get("err") else ""))
+        for s in sorted(r["spans"], key=lambda s: -(s["ms"] or 0))[:5]:
+            lines.append(f"{'':12}{s['ms'] or 0:8.1f} ms  {s['name']}" + (f"  ({s['err']})" if s.get("err") else ""))
+    by_name: Dict[str, List[float]] = {}
+    for r in records:
+        for s in r["spans"]:
+            by_name.setdefault(s["name"], []).append(s["ms"] or 0.0)
+    lines += ["", f"{'span':<32}{'count':>8}{'p50':>9}{'p95':>9}{'max':>9}{'total':>11}"]
+    for name, v in sorted(by_name.items(), key=lambda kv: -sum(kv[1])):
+        lines.append(f"{name:<32}{len(v):>8}{pct(v, .5):>9.1f}{pct(v, .95):>9.1f}{max(v):>9.1f}{sum(v):>11.1f}")
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+    ap = argparse.ArgumentParser(description="Summarize the slowest traces in a JSON-lines trace file.")
+    ap.add_argument("path", nargs="?", default=TRACE_PATH)
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument("--since-hours", type=float, default=0, help="only traces from the last N hours")
+    args = ap.parse_args(argv)
+    since = time.time() - args.since_hours * 3600 if args.since_hours else 0.0
+    print(summarize(load(args.path, since), args.top))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Update processor for the bot: concurrent across users, ordered per user.
+
+Kept out of main so that importing main does not pull in telegram.ext. Counters go into the
+`metrics` dict handed in by the caller (main.METRICS, served on /metrics).
+"""
+import asyncio, time
+from typing import Callable, Dict, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+def update_key(update: object) -> Optional[int]:
+    user = getattr(update, "effective_user", None)
+    if user:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes different users' updates concurrently, each user's strictly in arrival order.
+
+    Every update waits for the previous pending update with the same key (user_data holds the
+    flow/debts/budget FSMs and undo state), and only then competes for one of `max_running`
+    slots, so one user's backlog never occupies the whole pool. The base-class semaphore caps
+    the total number of accepted-but-unfinished updates at `pending_limit`. `observe`, if
+    given, is called with each update and its handling time in seconds (slot wait excluded).
+    """
+    def __init__(self, max_running: int, pending_limit: int, metrics: Dict[str, float],
+                 observe: Optional[Callable[[object, float], None]] = None):
+        super().__init__(max_concurrent_updates=max(pending_limit, max_running))
+        self.metrics = metrics
+        self.observe = observe
+        self.max_running = max_running
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.tails: Dict[int, asyncio.Future] = {}
+        self.depth: Dict[int, int] = {}
+        self.watched: Dict[int, asyncio.Future] = {}
+        self.pending = self.running = self.waiting = 0
+
+    async def initialize(self):
+        self.slots = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self):
+        pass
+
+    def watch(self, update_id: int) -> asyncio.Future:
+        """A future resolved once the update with this id has been handled (or dropped).
+        Register it before the update is queued."""
+        fut = self.watched.get(update_id)
+        if fut is None:
+            fut = self.watched[update_id] = asyncio.get_running_loop().create_future()
+        return fut
+
+    def set(self, name: str, value: float):
+        self.metrics[name] = value
+
+    def inc(self, name: str, value: float = 1.0):
+        self.metrics[name] = self.metrics.get(name, 0.0) + value
+
+    def _publish(self):
+        self.set("updates_pending", self.pending)
+        self.set("updates_running", self.running)
+        self.set("updates_waiting_slot", self.waiting)
+        self.set("update_keys_pending", len(self.depth))
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = update_key(update)
+        done = asyncio.get_running_loop().create_future()
+        prev = None
+        if key is not None:
+            prev = self.tails.get(key)
+            self.tails[key] = done
+            d = self.depth[key] = self.depth.get(key, 0) + 1
+            if d > self.metrics.get("user_queue_depth_max", 0):
+                self.set("user_queue_depth_max", d)
+        self.pending += 1; self._publish()
+        started = False
+        try:
+            if prev is not None:
+                await prev
+            self.waiting += 1; self._publish()
+            t0 = time.perf_counter()
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+            self.inc("update_slot_wait_seconds_total", time.perf_counter() - t0)
+            self.running += 1; self._publish()
+            t0 = time.perf_counter()
+            try:
+                started = True
+                await coroutine
+            finally:
+                self.running -= 1
+                self.slots.release()
+                if self.observe:
+                    self.observe(update, time.perf_counter() - t0)
+        finally:
+            if not started:
+                coroutine.close()
+            done.set_result(None)
+            watched = self.watched.pop(getattr(update, "update_id", None), None)
+            if watched is not None and not watched.done():
+                watched.set_result(None)
+            self.pending -= 1
+            if key is not None:
+                self.depth[key] -= 1
+                if not self.depth[key]:
+                    del self.depth[key]
+                if self.tails.get(key) is done:
+                    del self.tails[key]
+            self.inc("updates_processed_total")
+            self._publish()